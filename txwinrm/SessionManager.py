@@ -22,10 +22,20 @@ and handle responses
 A Client should always have a key property.  This will be unique to the types
 of transactions/requests being made through a single Session
 
+A client that is done with a session releases it.  The session stays open
+for idle_timeout seconds after its last client released it so that other
+clients can keep using it, then it is closed by the idle reaper.
+
 """
 
+import math
+
+from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
 
+# seconds a session stays open after its last client released it
+DEFAULT_IDLE_TIMEOUT = 60
+
 
 class Session(object):
 
@@ -48,6 +58,11 @@ class Session(object):
         # Error from last login if applicable.
         self._login_error = None
 
+        # When the last client released the session, and that client, which
+        # is used to log out once the session has been idle long enough.
+        self._last_used = None
+        self._last_client = None
+
     @inlineCallbacks
     def deferred_login(self, client):
         """Kick off a deferred login to a device from the first
@@ -130,14 +145,87 @@ class Session(object):
         returnValue(None)
 
 
+class _IdleReaper(object):
+
+    """Timer wheel calling reap(key) once a key is due.
+
+    Keys are kept in buckets of tick seconds, so scheduling a key is O(1)
+    however many keys are scheduled, and a single delayed call runs while
+    any key is.  A key is reaped up to tick seconds late.  A key due beyond
+    the wheel waits in its last bucket, reap is expected to check whether
+    the key is due and schedule it again if not.
+    """
+
+    def __init__(self, reap, clock=reactor, tick=1.0, buckets=64):
+        self._reap = reap
+        self._clock = clock
+        self._tick = tick
+        self._buckets = [set() for i in xrange(buckets)]
+        # the bucket reaped at _next_time
+        self._position = 0
+        self._next_time = None
+        # key -> index of its bucket
+        self._scheduled = {}
+        self._call = None
+
+    def __len__(self):
+        return len(self._scheduled)
+
+    def __contains__(self, key):
+        return key in self._scheduled
+
+    def schedule(self, key, due):
+        """Reap key at due.  Does nothing if key is already scheduled."""
+        if key in self._scheduled:
+            return
+        if self._call is None:
+            self._next_time = self._clock.seconds() + self._tick
+            self._call = self._clock.callLater(self._tick, self._advance)
+        ticks = int(math.ceil((due - self._next_time) / self._tick))
+        ticks = min(max(ticks, 0), len(self._buckets) - 1)
+        index = (self._position + ticks) % len(self._buckets)
+        self._buckets[index].add(key)
+        self._scheduled[key] = index
+
+    def cancel(self, key):
+        index = self._scheduled.pop(key, None)
+        if index is not None:
+            self._buckets[index].discard(key)
+
+    def _advance(self):
+        self._call = None
+        bucket = self._buckets[self._position]
+        self._buckets[self._position] = set()
+        self._position = (self._position + 1) % len(self._buckets)
+        for key in bucket:
+            del self._scheduled[key]
+        if self._scheduled:
+            self._next_time += self._tick
+            self._call = self._clock.callLater(
+                max(self._next_time - self._clock.seconds(), 0),
+                self._advance)
+        for key in bucket:
+            self._reap(key)
+
+
 class SessionManager(object):
 
     """Class to manage open sessions to devices."""
 
-    def __init__(self):
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, clock=reactor):
         # Used to keep track of sessions.
         self._sessions = {}
 
+        # Seconds a released session stays open.
+        self.idle_timeout = idle_timeout
+        self._clock = clock
+        self._reaper = _IdleReaper(self._reap, clock)
+
+    def configure(self, idle_timeout=None):
+        """Change the idle timeout of released sessions."""
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+
     def get_connection(self, key):
         """Return the session for a given key."""
         if key is None:
@@ -195,10 +283,43 @@ class SessionManager(object):
         if not session:
             returnValue(None)
         yield session.deferred_logout(client)
-        if not session._clients:
+        if not session._clients and \
+                self._sessions.get(client.key) is session:
             # No more clients so we don't need to keep the session.
             self._sessions.pop(client.key)
+            self._reaper.cancel(client.key)
         returnValue(None)
 
+    def release_connection(self, client):
+        """Release a client's session.
+
+        The session is closed once it has had no clients for idle_timeout
+        seconds.  Releasing only records the time, so it is cheap however
+        often clients come and go.
+
+        :param client: Client done with its connection
+        :type client: ZenPack defined class
+        """
+        session = self.get_connection(client.key)
+        if not session:
+            return
+        session._clients.discard(client)
+        session._last_used = self._clock.seconds()
+        session._last_client = client
+        if not session._clients:
+            self._reaper.schedule(
+                client.key, session._last_used + self.idle_timeout)
+
+    def _reap(self, key):
+        session = self._sessions.get(key)
+        if session is None or session._clients:
+            # in use again, released sessions are scheduled again
+            return
+        due = session._last_used + self.idle_timeout
+        if due > self._clock.seconds():
+            self._reaper.schedule(key, due)
+            return
+        self.close_connection(session._last_client)
+
 
 SESSION_MANAGER = SessionManager()
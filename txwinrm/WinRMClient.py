@@ -9,7 +9,7 @@
 
 import copy
 import logging
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from httplib import BAD_REQUEST, UNAUTHORIZED, FORBIDDEN, OK
 import shlex
 from cStringIO import StringIO
@@ -18,10 +18,12 @@ from twisted.internet import reactor
 from twisted.internet.defer import (
     inlineCallbacks,
     returnValue,
+    Deferred,
+    DeferredList,
     DeferredSemaphore,
-    succeed
 )
 from twisted.internet.error import TimeoutError
+from twisted.internet.task import LoopingCall
 
 try:
     from twisted.web.client import ResponseFailed
@@ -34,12 +36,14 @@ from . import constants as c
 from .util import (
     _authenticate_with_kerberos,
     _get_agent,
+    _close_agent_connections,
+    SECURITY_CONTEXT_CACHE,
     verify_conn_info,
     _CONTENT_TYPE,
     _ENCRYPTED_CONTENT_TYPE,
     Headers,
     _get_basic_auth_header,
-    _get_request_template,
+    _render_request_template,
     _StringProducer,
     get_auth_details,
     UnauthorizedError,
@@ -62,13 +66,283 @@ from .shell import (
 from .enumerate import (
     DEFAULT_RESOURCE_URI,
     SaxResponseHandler,
+    merge_columns,
     _MAX_REQUESTS_PER_ENUMERATION
 )
-from .SessionManager import SESSION_MANAGER, Session
+from .SessionManager import SESSION_MANAGER, Session, DEFAULT_IDLE_TIMEOUT
+from .scheduler import RequestScheduler, PRIORITY_NORMAL, PRIORITY_LOW
 kerberos = None
 LOG = logging.getLogger('winrm')
 
-EnumInfo = namedtuple('EnumInfo', ['wql', 'resource_uri'])
+_MAX_PAGE_SIZES = 10000
+_MAX_IDLE_SHELLS_PER_HOST = 4
+_MAX_CONCURRENT_ASSOCIATIONS = 10
+# well below the default WinRS IdleTimeout of two hours, and below the
+# session idle timeout so an idle shell is deleted in the session that
+# created it
+_SHELL_IDLE_TTL = DEFAULT_IDLE_TIMEOUT / 2
+
+# (hostname, wql) -> (largest MaxElements that fit the envelope, smallest
+# that did not)
+_page_sizes = OrderedDict()
+
+
+class EnumInfo(namedtuple('EnumInfo', [
+        'wql',
+        'resource_uri',
+        'max_elements',
+        'operation_timeout'])):
+    """A query for do_collect.  max_elements and operation_timeout default
+    to the connection info's when None.
+    """
+    def __new__(cls, wql, resource_uri, max_elements=None,
+                operation_timeout=None):
+        return super(EnumInfo, cls).__new__(
+            cls, wql, resource_uri, max_elements, operation_timeout)
+
+
+class _PageSize(object):
+    """Searches for the largest MaxElements whose pages fit the envelope.
+
+    Only the bounds learned from envelope size faults are remembered
+    between enumerations of the same host and query.
+    """
+
+    def __init__(self, key, limit):
+        self._key = key
+        self._limit = limit
+        self.fits, self.too_large = _page_sizes.get(key, (0, None))
+        if self.too_large is None or self.too_large > limit:
+            self.fits, self.too_large = 0, None
+            self.size = limit
+        else:
+            self.size = self.fits or self.too_large // 2
+
+    def fault(self):
+        """The page faulted.  Returns False if it can't get smaller."""
+        self.too_large = self.size
+        if self.fits >= self.too_large:
+            # the items have grown since the size was learned
+            self.fits = 0
+        self.size = (self.fits + self.too_large) // 2
+        self._save()
+        return self.size > 0
+
+    def full_page(self):
+        """A page with size items fit.  Try a larger one."""
+        self.fits = max(self.fits, self.size)
+        if self.too_large is None:
+            self.size = min(self.size * 2, self._limit)
+        else:
+            self.size = (self.fits + self.too_large) // 2
+            self._save()
+
+    def _save(self):
+        _page_sizes.pop(self._key, None)
+        _page_sizes[self._key] = (self.fits, self.too_large)
+        if len(_page_sizes) > _MAX_PAGE_SIZES:
+            _page_sizes.popitem(last=False)
+
+
+def _is_envelope_size_fault(error):
+    message = str(error).lower()
+    return 'envelope size' in message or 'maxenvelopesize' in message
+
+
+def _is_shell_gone_fault(error):
+    """Did the server reject a request because the shell does not exist?"""
+    message = str(error).lower()
+    return 'shell was not found' in message or \
+        'invalidselectors' in message or \
+        ('shellid' in message and 'not valid' in message)
+
+
+class _PooledShell(object):
+    """An idle remote shell and the client that deletes it on expiry."""
+
+    def __init__(self, shell_id, client):
+        self.shell_id = shell_id
+        self.client = client
+        self.expire_call = None
+
+
+class ShellPool(object):
+    """Idle remote shells per host and user for SingleCommandClient.
+
+    Creating a shell starts a new winrshost.exe on Windows and costs two
+    round trips with deleting it, so consecutive commands reuse shells.  A
+    shell is deleted when it has been idle for idle_ttl seconds, and at most
+    max_shells idle shells are kept per host.  An idle_ttl of 0 disables
+    pooling.  idle_ttl is kept below the idle timeout of the client's
+    session manager, so a shell expires before its session is closed.
+    """
+
+    def __init__(self, max_shells=_MAX_IDLE_SHELLS_PER_HOST,
+                 idle_ttl=_SHELL_IDLE_TTL, clock=reactor):
+        self.max_shells = max_shells
+        self.idle_ttl = idle_ttl
+        self._clock = clock
+        # key -> list of _PooledShell, most recently used last
+        self._shells = {}
+
+    def configure(self, max_shells=None, idle_ttl=None):
+        if max_shells is not None:
+            self.max_shells = max_shells
+        if idle_ttl is not None:
+            self.idle_ttl = idle_ttl
+
+    def checkout(self, key):
+        """Return the id of an idle shell for key, or None."""
+        shells = self._shells.get(key)
+        if not shells:
+            return None
+        shell = shells.pop()
+        if not shells:
+            del self._shells[key]
+        if shell.expire_call.active():
+            shell.expire_call.cancel()
+        return shell.shell_id
+
+    def checkin(self, key, shell_id, client):
+        """Keep an idle shell.  Returns False if the caller must delete it
+        because the pool is full or disabled.
+        """
+        if self.idle_ttl <= 0:
+            return False
+        shells = self._shells.setdefault(key, [])
+        if len(shells) >= self.max_shells:
+            if not shells:
+                del self._shells[key]
+            return False
+        shell = _PooledShell(shell_id, client)
+        idle_ttl = min(self.idle_ttl,
+                       client.session_manager.idle_timeout / 2.0)
+        shell.expire_call = self._clock.callLater(
+            idle_ttl, self._expire, key, shell)
+        shells.append(shell)
+        return True
+
+    def close(self):
+        """Delete all idle shells."""
+        ds = []
+        for key, shells in self._shells.items():
+            for shell in list(shells):
+                if shell.expire_call.active():
+                    shell.expire_call.cancel()
+                ds.append(self._expire(key, shell))
+        return DeferredList(ds, consumeErrors=True)
+
+    def __len__(self):
+        return sum(len(shells) for shells in self._shells.itervalues())
+
+    def _expire(self, key, shell):
+        shells = self._shells.get(key, [])
+        if shell in shells:
+            shells.remove(shell)
+        if not shells:
+            self._shells.pop(key, None)
+        LOG.debug('{0} deleting idle shell {1}'.format(key[0], shell.shell_id))
+        d = shell.client._delete_idle_shell(shell.shell_id)
+        d.addErrback(lambda failure: LOG.debug(
+            '{0} unable to delete idle shell {1}: {2}'.format(
+                key[0], shell.shell_id, failure.getErrorMessage())))
+        return d
+
+
+SHELL_POOL = ShellPool()
+
+
+class _ReceivePoller(object):
+    """Polls the MultiCommandClients of one host from one timer.
+
+    Each cycle sends the Receives of all clients and the next cycle starts
+    once they have returned.  A client whose receive fails is no longer
+    polled.
+    """
+
+    def __init__(self, key, interval, clock):
+        self._key = key
+        # client -> (on_output, Deferred that fires when polling stops)
+        self._clients = OrderedDict()
+        self._call = LoopingCall(self._poll)
+        self._call.clock = clock
+        self._interval = interval
+
+    def add(self, client, on_output):
+        d = Deferred()
+        self._clients[client] = (on_output, d)
+        if not self._call.running:
+            self._call.start(self._interval, now=False)
+        return d
+
+    def remove(self, client, failure=None):
+        if client not in self._clients:
+            return
+        on_output, d = self._clients.pop(client)
+        if not self._clients:
+            if self._call.running:
+                self._call.stop()
+            _RECEIVE_POLLERS.pop(self._key, None)
+        if failure is None:
+            d.callback(None)
+        else:
+            d.errback(failure)
+
+    def _poll(self):
+        ds = []
+        for client, (on_output, d) in self._clients.items():
+            receive_d = client.receive()
+            receive_d.addCallback(on_output)
+            receive_d.addErrback(self._failed, client)
+            ds.append(receive_d)
+        return DeferredList(ds)
+
+    def _failed(self, failure, client):
+        self.remove(client, failure)
+
+
+# (hostname, interval) -> _ReceivePoller
+_RECEIVE_POLLERS = {}
+
+
+def _unique_values(items, name):
+    """Values of property name of items in order without duplicates."""
+    values = OrderedDict()
+    for item in items:
+        try:
+            values[getattr(item, name)] = None
+        except AttributeError:
+            continue
+    return values.keys()
+
+
+def _join_items(values, items, name):
+    """Map each of values to the items whose property name has the value."""
+    index = {}
+    for item in items:
+        try:
+            value = getattr(item, name)
+        except AttributeError:
+            continue
+        index.setdefault(value, []).append(item)
+    return dict((value, index.get(value, [])) for value in values)
+
+
+def _select_all(association):
+    wql = 'Select * from {}'.format(association['return_class'])
+    if association.get('where'):
+        wql += ' where {}'.format(association['where'])
+    return wql
+
+
+def _discard_response(response):
+    # read the body so the connection can be reused
+    response.deliverBody(_StringProtocol())
+
+
+def _ignore_failure(failure):
+    LOG.debug('ignoring unneeded request: {0}'.format(
+        failure.getErrorMessage()))
 
 
 def _build_ps_command_line_elem(ps_command, ps_script):
@@ -118,8 +392,9 @@ class WinRMSession(Session):
     def __init__(self):
         super(WinRMSession, self).__init__()
 
-        # twisted agent to send http/https requests
-        self._agent = _get_agent()
+        # twisted agent to send http/https requests.  set on login once the
+        # connection info is known
+        self._agent = None
 
         # our kerberos context for encryption/decryption
         self._gssclient = None
@@ -133,12 +408,14 @@ class WinRMSession(Session):
         # connection info.  see util.ConnectionInfo
         self._conn_info = None
 
-        # DeferredSemaphore so that we complete one transaction/conversation
-        # at a time.  Windows cannot handle mixed transaction types on one
-        # connection.
-        self.sem = DeferredSemaphore(1)
+        # Runs the transactions/conversations of the clients.  A
+        # conversation keeps its slot until it completes because Windows
+        # cannot handle mixed transaction types on one connection.  Login
+        # sets the number of slots.
+        self.sem = RequestScheduler(1)
 
-        self._refresh_dc = None
+        # whether login may reuse a cached kerberos context
+        self._use_cached_context = True
 
     def is_kerberos(self):
         return self._conn_info.auth_type == 'kerberos'
@@ -146,6 +423,9 @@ class WinRMSession(Session):
     def decrypt_body(self, body):
         return self._gssclient.decrypt_body(body)
 
+    def decrypt_payload(self, payload):
+        return self._gssclient.decrypt_payload(payload)
+
     def _set_headers(self):
         if self._headers:
             return self._headers
@@ -163,27 +443,39 @@ class WinRMSession(Session):
     def _deferred_login(self, client=None):
         if client:
             self._conn_info = client._conn_info
+        if self.is_kerberos():
+            # the security context is established on a single connection
+            self.sem.configure(slots=1)
+        else:
+            self.sem.configure(slots=getattr(
+                self._conn_info, 'max_conversations', 1))
         self._url = "{c.scheme}://{c.ipaddress}:{c.port}/wsman".format(c=self._conn_info)
+        use_cached_context = self._use_cached_context
+        self._use_cached_context = True
+        if self.is_kerberos() and use_cached_context:
+            cached = SECURITY_CONTEXT_CACHE.checkout(self._conn_info)
+            if cached:
+                self._agent, self._gssclient = cached
+                returnValue(self._gssclient)
+        if self._agent is None:
+            self._agent = _get_agent(self._conn_info)
         if self.is_kerberos():
             self._gssclient = yield _authenticate_with_kerberos(self._conn_info, self._url, self._agent)
             returnValue(self._gssclient)
         else:
             returnValue('basic_auth_token')
 
-    @inlineCallbacks
-    def _deferred_logout(self):
+    def _deferred_logout(self, client=None):
         # close connections so we do not end up with orphans
         # return a Deferred()
         self.loggedout = True
-        if self._agent and hasattr(self._agent, 'closeCachedConnections'):
-            # twisted 11 has no return and is part of the Agent
-            return succeed(self._agent.closeCachedConnections())
-        elif self._agent:
-            # twisted 12 returns a Deferred
-            return self._agent._pool.closeCachedConnections()
-        else:
-            # no agent
-            return succeed(None)
+        if self._gssclient is not None:
+            # keep the established context for the next session
+            d = SECURITY_CONTEXT_CACHE.checkin(
+                self._conn_info, self._agent, self._gssclient)
+            self._agent = self._gssclient = None
+            return d
+        return _close_agent_connections(self._agent)
 
     @inlineCallbacks
     def handle_response(self, request, response, client):
@@ -193,7 +485,10 @@ class WinRMSession(Session):
                 self._gssclient.cleanup()
                 self._gssclient = None
                 self._token = None
-                self._agent = _get_agent()
+                # the context is no longer accepted on this connection
+                _close_agent_connections(self._agent)
+                self._agent = _get_agent(self._conn_info)
+                self._use_cached_context = False
                 self._login_d = None
                 yield SESSION_MANAGER.init_connection(client, WinRMSession)
                 try:
@@ -257,17 +552,22 @@ class WinRMSession(Session):
 
     @inlineCallbacks
     def _send_request(self, request_template_name, client, envelope_size=None,
-                      locale=None, code_page=None, **kwargs):
+                      locale=None, code_page=None, max_elements=None,
+                      operation_timeout=None, **kwargs):
         kwargs['envelope_size'] = envelope_size or client._conn_info.envelope_size
         kwargs['locale'] = locale or client._conn_info.locale
         kwargs['code_page'] = code_page or client._conn_info.code_page
+        kwargs['max_elements'] = max_elements or \
+            getattr(client._conn_info, 'max_elements', 32000)
+        kwargs['operation_timeout'] = operation_timeout or \
+            getattr(client._conn_info, 'operation_timeout', 60)
         if self._login_d and not self._login_d.called:
             # check for a reconnection attempt so we do not send any requests
             # to a dead connection
             yield self._login_d
         LOG.debug('sending request: {0} {1}'.format(
             request_template_name, kwargs))
-        request = _get_request_template(request_template_name).format(**kwargs)
+        request = _render_request_template(request_template_name, **kwargs)
         self._headers = self._set_headers()
         if self.is_kerberos():
             encrypted_request = self._gssclient.encrypt_body(request)
@@ -287,14 +587,10 @@ class WinRMSession(Session):
         returnValue(response)
 
     def close_connection(self, client):
-        try:
-            self._refresh_dc.cancel()
-        except Exception:
-            pass
-
-        # Close the connection after 60 seconds.  This will give other clients
-        # enough time to keep the connection alive and continue using the same session.
-        self._refresh_dc = reactor.callLater(60, SESSION_MANAGER.close_connection, client)
+        # The session is closed once it has been idle for the session
+        # manager's idle_timeout.  This will give other clients enough time
+        # to keep the connection alive and continue using the same session.
+        SESSION_MANAGER.release_connection(client)
 
 
 class WinRMClient(object):
@@ -309,15 +605,13 @@ class WinRMClient(object):
         self.session_manager = SESSION_MANAGER
         self._session = None
         self.ps_script = None
+        # the priority of the client's conversations in the session's
+        # scheduler, e.g. PRIORITY_HIGH for availability checks
+        self.priority = PRIORITY_NORMAL
 
     @inlineCallbacks
     def init_connection(self):
         """Initialize a connection through the session_manager"""
-        if self._session:
-            try:
-                self._refresh_dc.cancel()
-            except Exception:
-                pass
         yield self.session_manager.init_connection(self, WinRMSession)
         self._session = self.session_manager.get_connection(self.key)
         returnValue(None)
@@ -328,6 +622,9 @@ class WinRMClient(object):
     def decrypt_body(self, body):
         return self._session.decrypt_body(body)
 
+    def decrypt_payload(self, payload):
+        return self._session.decrypt_payload(payload)
+
     @inlineCallbacks
     def send_request(self, request, **kwargs):
         if not self._session:
@@ -392,10 +689,17 @@ class WinRMClient(object):
 
 
 class SingleCommandClient(WinRMClient):
-    """Client to send a single command to a winrm device"""
-    def __init__(self, conn_info):
+    """Client to send a single command to a winrm device
+
+    Shells are reused from shell_pool between commands.  Pass
+    shell_pool=None to create and delete a shell for every command.
+    """
+    def __init__(self, conn_info, shell_pool=SHELL_POOL):
         super(SingleCommandClient, self).__init__(conn_info)
         self.key = (self._conn_info.ipaddress, 'short')
+        self._shell_pool = shell_pool
+        self._shell_key = (self._conn_info.ipaddress,
+                           self._conn_info.username)
 
     @inlineCallbacks
     def run_command(self, command_line, ps_script=None):
@@ -411,8 +715,8 @@ class SingleCommandClient(WinRMClient):
         self.ps_script = ps_script
         yield self.init_connection()
         try:
-            cmd_response = yield self._session.sem.run(self.run_single_command,
-                                                       command_line)
+            cmd_response = yield self._session.sem.submit(
+                self.priority, self, self.run_single_command, command_line)
         except Exception:
             yield self.close_connection()
             raise
@@ -429,16 +733,45 @@ class SingleCommandClient(WinRMClient):
                 .stderr = [<non-empty, stripped line>, ...]
                 .exit_code = <int>
         """
-        shell_id = yield self._create_shell()
+        shell_id = None
+        if self._shell_pool is not None:
+            shell_id = self._shell_pool.checkout(self._shell_key)
+        reused = shell_id is not None
+        if not reused:
+            shell_id = yield self._create_shell()
         cmd_response = None
+        pooled = False
         try:
-            cmd_response = yield self._run_command(shell_id, command_line)
+            try:
+                cmd_response = yield self._run_command(shell_id, command_line)
+            except RequestError as e:
+                if not reused or not _is_shell_gone_fault(e):
+                    raise
+                # the shell timed out or was closed on the server
+                LOG.debug('{0} shell {1} is gone, creating a new one'.format(
+                    self._conn_info.hostname, shell_id))
+                shell_id = yield self._create_shell()
+                cmd_response = yield self._run_command(shell_id, command_line)
+            if self._shell_pool is not None:
+                pooled = self._shell_pool.checkin(
+                    self._shell_key, shell_id, self)
         except TimeoutError:
             yield self.close_connection()
-        yield self._delete_shell(shell_id)
+        if not pooled:
+            yield self._delete_shell(shell_id)
         yield self.close_connection()
         returnValue(cmd_response)
 
+    @inlineCallbacks
+    def _delete_idle_shell(self, shell_id):
+        """Delete a pooled shell in a conversation of its own."""
+        yield self.init_connection()
+        try:
+            yield self._session.sem.submit(
+                PRIORITY_LOW, self, self._delete_shell, shell_id)
+        finally:
+            yield self.close_connection()
+
     @inlineCallbacks
     def _run_command(self, shell_id, command_line):
         command_elem = yield self._send_command(shell_id, command_line)
@@ -522,41 +855,277 @@ class LongCommandClient(WinRMClient):
         returnValue(CommandResponse(stdout, stderr, self._exit_code))
 
 
+class MultiCommandClient(WinRMClient):
+    """Client to run several long running commands in one remote shell
+
+    Each command would otherwise need its own shell, winrshost.exe and
+    session.  One timer polls the commands of all clients of a host, see
+    start_polling.
+    """
+    def __init__(self, conn_info):
+        super(MultiCommandClient, self).__init__(conn_info)
+        self.key = (self._conn_info.ipaddress, 'multi')
+        self._shell_id = None
+        # command id -> exit code, None while running
+        self.exit_codes = OrderedDict()
+        self._poller = None
+
+    @inlineCallbacks
+    def start(self, commands):
+        """Start the commands in one shell.
+
+        commands is a list of command lines or (command_line, ps_script)
+        pairs, see LongCommandClient.start.  Returns the command ids in the
+        same order.
+        """
+        yield self.init_connection()
+        if self._shell_id is None:
+            self._shell_id = yield self._create_shell()
+        command_ids = []
+        for command in commands:
+            if isinstance(command, basestring):
+                command_line, ps_script = command, None
+            else:
+                command_line, ps_script = command
+            LOG.debug("MultiCommandClient start: {0}".format(command_line))
+            self.ps_script = ps_script
+            try:
+                command_elem = yield self._send_command(self._shell_id,
+                                                        command_line)
+            except TimeoutError:
+                yield self.close_connection()
+                raise
+            command_id = _find_command_id(command_elem)
+            self.exit_codes[command_id] = None
+            command_ids.append(command_id)
+        returnValue(command_ids)
+
+    @inlineCallbacks
+    def receive(self):
+        """Send one Receive for each running command.
+
+        The Receives are conversations of the session's scheduler, so they
+        run one after another on a session with one slot, e.g. a Kerberos
+        session whose security context is bound to one connection.
+
+        Returns a dict of command id to (stdout, stderr).  Commands that
+        exit are no longer received from, their exit codes are in
+        exit_codes.
+        """
+        command_ids = [command_id for command_id, exit_code
+                       in self.exit_codes.iteritems() if exit_code is None]
+        sem = self._session.sem
+        results = yield DeferredList(
+            [sem.submit(self.priority, self, self._send_receive,
+                        self._shell_id, command_id)
+             for command_id in command_ids], consumeErrors=True)
+        output = {}
+        for command_id, (success, result) in zip(command_ids, results):
+            if not success:
+                if result.check(TimeoutError):
+                    yield self.close_connection()
+                result.raiseException()
+            stdout_parts = _find_stream(result, command_id, 'stdout')
+            stderr_parts = _find_stream(result, command_id, 'stderr')
+            self.exit_codes[command_id] = _find_exit_code(result, command_id)
+            output[command_id] = (_stripped_lines(stdout_parts),
+                                  _stripped_lines(stderr_parts))
+        returnValue(output)
+
+    def start_polling(self, interval, on_output, clock=reactor):
+        """Call on_output with the result of receive every interval seconds.
+
+        The clients of a host polled at the same interval share one timer.
+        The next cycle starts once the Receives of the previous one have
+        returned, and polling stops when receive fails.  Returns a Deferred
+        that fires when polling stops, or fails with the receive failure.
+        """
+        self.stop_polling()
+        key = (self._conn_info.ipaddress, interval)
+        poller = _RECEIVE_POLLERS.get(key)
+        if poller is None:
+            poller = _RECEIVE_POLLERS[key] = _ReceivePoller(
+                key, interval, clock)
+        self._poller = poller
+        return poller.add(self, on_output)
+
+    def stop_polling(self):
+        if self._poller is not None:
+            self._poller.remove(self)
+        self._poller = None
+
+    @inlineCallbacks
+    def stop(self, close=False):
+        """Stop all commands and delete the shell.  Returns a dict of
+        command id to CommandResponse.
+        """
+        self.stop_polling()
+        responses = {}
+        running = [command_id for command_id, exit_code
+                   in self.exit_codes.iteritems() if exit_code is None]
+        for command_id in running:
+            yield self._signal_ctrl_c(self._shell_id, command_id)
+        try:
+            output = yield self.receive()
+        except TimeoutError:
+            output = {}
+        for command_id in self.exit_codes:
+            if command_id in running:
+                yield self._signal_terminate(self._shell_id, command_id)
+            stdout, stderr = output.get(command_id, ([], []))
+            responses[command_id] = CommandResponse(
+                stdout, stderr, self.exit_codes[command_id])
+        yield self._delete_shell(self._shell_id)
+        self._shell_id = None
+        self.exit_codes.clear()
+        if close:
+            yield self.close_connection()
+        returnValue(responses)
+
+
 class EnumerateClient(WinRMClient):
     """Client to send a single wmi query(WQL) to a winrm device
 
     Sends enumerate requests to a host running the WinRM service and returns
     a list of items.
+
+    With pipeline=True the Pull for the next page is sent as soon as the
+    enumeration context of the current page has been parsed, so its round
+    trip overlaps with decrypting and parsing the items of the current page.
+
+    parser_backend selects the XML parser and lazy_datetimes defers parsing
+    Datetime properties until they are read, see
+    txwinrm.enumerate.create_parser_and_factory.
     """
 
-    def __init__(self, conn_info):
+    def __init__(self, conn_info, pipeline=False, parser_backend=None,
+                 lazy_datetimes=False):
         super(EnumerateClient, self).__init__(conn_info)
-        self._handler = SaxResponseHandler(self)
+        self._handler = SaxResponseHandler(
+            self, parser_backend, lazy_datetimes)
         self._hostname = conn_info.ipaddress
         self.key = (conn_info.ipaddress, 'short')
+        self._pipeline = pipeline
+
+    @inlineCallbacks
+    def enumerate(self, wql, resource_uri=DEFAULT_RESOURCE_URI,
+                  max_elements=None, operation_timeout=None, columnar=False,
+                  column_types=None):
+        """Runs a remote WQL query.
+
+        With columnar=True the result is a Columns instance holding one
+        column per property instead of a list of items, which suits large
+        numeric results such as performance counters.  column_types maps
+        property names to their CIM types, and the properties of numeric
+        types are typed arrays, see merge_columns.
+
+        The enumeration takes a slot of the session's scheduler itself, see
+        enumerate_iter.
+        """
+        items = []
+        on_items = items.append if columnar else items.extend
+        yield self.enumerate_iter(wql, resource_uri, on_items=on_items,
+                                  max_elements=max_elements,
+                                  operation_timeout=operation_timeout,
+                                  columnar=columnar)
+        if columnar:
+            items = merge_columns(items, column_types)
+        returnValue(items)
 
     @inlineCallbacks
-    def enumerate(self, wql, resource_uri=DEFAULT_RESOURCE_URI):
-        """Runs a remote WQL query."""
+    def enumerate_iter(self, wql, resource_uri=DEFAULT_RESOURCE_URI,
+                       on_items=None, max_elements=None,
+                       operation_timeout=None, columnar=False):
+        """Runs a remote WQL query and hands the items of each Enumerate/Pull
+        response to on_items as soon as the response has been parsed.
+
+        Only one page of items is referenced at a time, so peak memory scales
+        with the envelope size instead of the whole result set.  If on_items
+        returns a Deferred, the next Pull is not sent until it fires.  When
+        pipelining, at most one Pull is sent ahead of on_items.
+
+        max_elements and operation_timeout default to the connection info's.
+        max_elements is the most items asked for per page.  WinRM already
+        stops a page at the envelope size, but when a page faults because it
+        exceeds the envelope size it is retried with fewer items, searching
+        for the largest page size that fits.  The result is remembered for
+        this host and query.
+
+        With columnar=True on_items is handed the ColumnAccumulator of each
+        page instead of a list of items, see merge_columns.
+
+        The enumeration waits for its turn in the session's scheduler,
+        unless it is called from self._session.sem.run(self.enumerate, ...)
+        which already holds a slot for this client.
+
+        Returns the total number of items handed to on_items.
+        """
+        if on_items is None:
+            raise ValueError('on_items callback is required')
         yield self.init_connection()
+        item_count = yield self._session.sem.submit(
+            self.priority, self, self._enumerate_iter, wql, resource_uri,
+            on_items, max_elements, operation_timeout, columnar)
+        returnValue(item_count)
+
+    @inlineCallbacks
+    def _enumerate_iter(self, wql, resource_uri, on_items, max_elements,
+                        operation_timeout, columnar):
         request_template_name = 'enumerate'
         enumeration_context = None
-        items = []
+        item_count = 0
+        # enumeration context -> Deferred response of a Pull sent ahead
+        pulls = {}
+        limit = max_elements or getattr(self._conn_info, 'max_elements', 32000)
+        page_size = _PageSize((self._hostname, wql), limit)
+
+        def send_request(request_template_name, enumeration_context):
+            LOG.info('{0} "{1}" {2}'.format(
+                self._hostname, wql, request_template_name))
+            return self._session._send_request(
+                request_template_name,
+                self,
+                resource_uri=resource_uri,
+                wql=wql,
+                enumeration_context=enumeration_context,
+                max_elements=page_size.size,
+                operation_timeout=operation_timeout)
+
+        def send_pull(enumeration_context):
+            if enumeration_context not in pulls:
+                pulls[enumeration_context] = send_request(
+                    'pull', enumeration_context)
+
+        handler_kwargs = dict(columnar=True) if columnar else {}
+        if self._pipeline:
+            handler_kwargs['on_enumeration_context'] = send_pull
+
         try:
             for i in xrange(_MAX_REQUESTS_PER_ENUMERATION):
-                LOG.info('{0} "{1}" {2}'.format(
-                    self._hostname, wql, request_template_name))
-                response = yield self._session._send_request(
-                    request_template_name,
-                    self,
-                    resource_uri=resource_uri,
-                    wql=wql,
-                    enumeration_context=enumeration_context)
+                response_d = pulls.pop(enumeration_context, None)
+                if response_d is None:
+                    response_d = send_request(
+                        request_template_name, enumeration_context)
+                try:
+                    response = yield response_d
+                except RequestError as e:
+                    if not _is_envelope_size_fault(e) or \
+                            not page_size.fault():
+                        raise
+                    LOG.info('{0} "{1}" retrying with MaxElements {2}'.format(
+                        self._hostname, wql, page_size.size))
+                    continue
                 LOG.info("{0} {1} HTTP status: {2}".format(
                     self._hostname, wql, response.code))
                 enumeration_context, new_items = \
-                    yield self._handler.handle_response(response)
-                items.extend(new_items)
+                    yield self._handler.handle_response(
+                        response, **handler_kwargs)
+                item_count += len(new_items)
+                if len(new_items) >= page_size.size:
+                    page_size.full_page()
+                # on_items may return a Deferred to hold off the next Pull
+                yield on_items(new_items)
+                new_items = None
                 if not enumeration_context:
                     break
                 request_template_name = 'pull'
@@ -569,11 +1138,25 @@ class EnumerateClient(WinRMClient):
             else:
                 LOG.info('{0} {1}'.format(self._hostname, e))
             raise
+        finally:
+            # a Pull sent ahead of an end-of-sequence or an error
+            for response_d in pulls.itervalues():
+                response_d.addCallbacks(_discard_response, _ignore_failure)
+        returnValue(item_count)
+
+    @inlineCallbacks
+    def _enumerate_or_empty(self, wql, resource_uri):
+        try:
+            items = yield self.enumerate(wql, resource_uri)
+        except RequestError as e:
+            # like do_collect, a query-specific error has no results
+            LOG.warn('{0} "{1}" failed: {2}'.format(self._hostname, wql, e))
+            items = []
         returnValue(items)
 
     @inlineCallbacks
     def do_collect(self, enum_infos):
-        """Run enumerations in the session's semaphore.  Windows must finish
+        """Run enumerations in the session's scheduler.  Windows must finish
         an enumeration before a new command or enumeration can start
         """
         items = {}
@@ -581,9 +1164,11 @@ class EnumerateClient(WinRMClient):
         self._session = self.session_manager.get_connection(self.key)
         for enum_info in enum_infos:
             try:
-                items[enum_info] = yield self._session.sem.run(self.enumerate,
-                                                               enum_info.wql,
-                                                               enum_info.resource_uri)
+                items[enum_info] = yield self.enumerate(
+                    enum_info.wql,
+                    enum_info.resource_uri,
+                    max_elements=enum_info.max_elements,
+                    operation_timeout=enum_info.operation_timeout)
             except (UnauthorizedError, ForbiddenError):
                 # Fail the collection for general errors.
                 raise
@@ -613,7 +1198,8 @@ class AssociatorClient(EnumerateClient):
                   associations,
                   where=None,
                   resource_uri=DEFAULT_RESOURCE_URI,
-                  fields=['*']):
+                  fields=['*'],
+                  max_concurrent=_MAX_CONCURRENT_ASSOCIATIONS):
         """Method to retrieve associated wmi classes based upon a
         property from a given class
 
@@ -632,10 +1218,22 @@ class AssociatorClient(EnumerateClient):
                     ResultClass = ClassName
                     ResultRole = PropertyName
                     Role = PropertyName
+                join_property - optional property of return_class holding
+                    the search_property value.  return_class is then
+                    selected once and joined with the previous results
+                    instead of running one query per item
         where - wql where clause to narrow scope of initial query
         resource_uri - uri of resource.  this will be the same for both
             input and result classes.  Limitation of WQL
         fields - fields to return from seed_class on initial query
+        max_concurrent - most association queries run at once
+
+        All queries share one session, so at most as many run at once as
+        the session has slots: 1 for kerberos, else the max_conversations
+        of the connection info, which must be raised for the queries of an
+        association to run concurrently.  Identical queries are only run
+        once.  A query that fails with a RequestError is logged and has no
+        results.
 
         returns dict of seed_class and all return_class results
             mapped by search_property
@@ -647,36 +1245,135 @@ class AssociatorClient(EnumerateClient):
         wql = 'Select {} from {}'.format(','.join(fields), seed_class)
         if where:
             wql += ' where {}'.format(where)
-        enum_info = EnumInfo(wql, resource_uri)
-        results = yield self.do_collect([enum_info])
-
+        # wql -> items of the queries run so far
+        results = {}
+        yield self.init_connection()
+        # more queries in flight would only wait in the session's scheduler
+        sem = DeferredSemaphore(
+            max(1, min(max_concurrent, self._session.sem.slots)))
         try:
-            input_results = results[enum_info]
-        except KeyError:
-            raise Exception('No results for seed class {}.'.format(seed_class))
-
-        items[seed_class] = input_results
-        while associations_copy:
-            association = associations_copy.pop(0)
-            associate_results = []
-            prop_results = {}
-            for item in input_results:
-                try:
-                    prop = getattr(item, association['search_property'])
-                except AttributeError:
-                    continue
+            try:
+                input_results = yield self.enumerate(wql, resource_uri)
+            except RequestError:
+                raise Exception(
+                    'No results for seed class {}.'.format(seed_class))
+
+            items[seed_class] = input_results
+            while associations_copy:
+                association = associations_copy.pop(0)
+                props = _unique_values(
+                    input_results, association['search_property'])
+                if association.get('join_property'):
+                    prop_results = yield self._join(
+                        association, props, resource_uri, results)
                 else:
-                    wql = "ASSOCIATORS of {{{}.{}='{}'}} WHERE {}={}".format(
-                        association['search_class'],
-                        association['search_property'],
-                        prop,
-                        association['where_type'],
-                        association['return_class'])
-                    enum_info = EnumInfo(wql, resource_uri)
-                    result = yield self.do_collect([enum_info])
-                    associate_results.extend(result[enum_info])
-                    prop_results[prop] = result[enum_info]
-
-            items[association['return_class']] = prop_results
-            input_results = associate_results
+                    prop_results = yield self._associators(
+                        association, props, resource_uri, results, sem)
+                items[association['return_class']] = prop_results
+                input_results = [item for prop in props
+                                 for item in prop_results[prop]]
+        finally:
+            yield self.close_connection()
+        returnValue(items)
+
+    @inlineCallbacks
+    def _associators(self, association, props, resource_uri, results, sem):
+        wqls = []
+        for prop in props:
+            wqls.append("ASSOCIATORS of {{{}.{}='{}'}} WHERE {}={}".format(
+                association['search_class'],
+                association['search_property'],
+                prop,
+                association['where_type'],
+                association['return_class']))
+        new_wqls = [wql for wql in OrderedDict.fromkeys(wqls)
+                    if wql not in results]
+        responses = yield DeferredList(
+            [sem.run(self._enumerate_or_empty, wql, resource_uri)
+             for wql in new_wqls], consumeErrors=True)
+        for wql, (success, result) in zip(new_wqls, responses):
+            if not success:
+                result.raiseException()
+            results[wql] = result
+        returnValue(dict(
+            (prop, results[wql]) for prop, wql in zip(props, wqls)))
+
+    @inlineCallbacks
+    def _join(self, association, props, resource_uri, results):
+        wql = _select_all(association)
+        if wql not in results:
+            results[wql] = yield self._enumerate_or_empty(wql, resource_uri)
+        returnValue(_join_items(
+            props, results[wql], association['join_property']))
+
+
+class JoinClient(EnumerateClient):
+    """WinRM Client that returns wmi classes joined on their properties.
+
+    Where associated classes share a key, e.g. the PNPDeviceID of a
+    Win32_NetworkAdapter is the DeviceID of its Win32_PnPEntity, each class
+    is selected once and the results are joined on the client instead of
+    running one ASSOCIATORS query per item as AssociatorClient does.
+    """
+
+    @inlineCallbacks
+    def join(self,
+             seed_class,
+             joins,
+             where=None,
+             resource_uri=DEFAULT_RESOURCE_URI,
+             fields=['*']):
+        """Method to retrieve wmi classes joined to a given class
+
+        seed_class - wmi class which will be initially queried
+        joins - list of dicts, each joining the results of the previous
+            one (the seed_class results for the first) to a class:
+                search_property - property of the previous results
+                return_class - class which will be returned
+                join_property - property of return_class matching
+                    search_property
+                where - optional wql where clause for return_class
+        where - wql where clause to narrow scope of initial query
+        resource_uri - uri of resource for all classes
+        fields - fields to return from seed_class on initial query
+
+        All classes are selected concurrently in one session.  A class that
+        fails with a RequestError has no results.
+
+        returns dict of seed_class and all return_class results
+            mapped by search_property, like AssociatorClient.associate
+        """
+        wql = 'Select {} from {}'.format(','.join(fields), seed_class)
+        if where:
+            wql += ' where {}'.format(where)
+        wqls = [_select_all(j) for j in joins]
+        unique_wqls = [w for w in OrderedDict.fromkeys(wqls) if w != wql]
+        yield self.init_connection()
+        try:
+            ds = [self.enumerate(wql, resource_uri)]
+            ds.extend(self._enumerate_or_empty(w, resource_uri)
+                      for w in unique_wqls)
+            responses = yield DeferredList(ds, consumeErrors=True)
+        finally:
+            yield self.close_connection()
+        success, input_results = responses[0]
+        if not success:
+            if input_results.check(RequestError):
+                raise Exception(
+                    'No results for seed class {}.'.format(seed_class))
+            input_results.raiseException()
+        results = {wql: input_results}
+        for w, (success, result) in zip(unique_wqls, responses[1:]):
+            if not success:
+                result.raiseException()
+            results[w] = result
+
+        items = {seed_class: input_results}
+        for j, w in zip(joins, wqls):
+            props = _unique_values(input_results, j['search_property'])
+            prop_results = _join_items(
+                props, results[w], j['join_property'])
+            items[j['return_class']] = prop_results
+            input_results = [item for prop in props
+                             for item in prop_results[prop]]
         returnValue(items)
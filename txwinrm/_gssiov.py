@@ -0,0 +1,180 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2017, all rights reserved.
+#
+# This content is made available according to terms specified in the LICENSE
+# file at the top-level directory of this package.
+#
+##############################################################################
+
+"""
+Binary-safe gss_wrap_iov/gss_unwrap_iov for the kerberos module's contexts.
+
+kerberos.authGSSClientWrapIov and authGSSClientUnwrapIov only accept and
+return base64 strings, which costs two codec passes and four full-size copies
+per message.  This shim calls the GSSAPI library directly through ctypes on
+the gss_ctx_id_t held by a kerberos client context, so messages stay raw
+bytes.  It is only used when available() is True; AuthGSSClient keeps the
+base64 path as a fallback.
+
+Set TXWINRM_GSS_IOV=0 in the environment to disable the shim.
+"""
+
+import os
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+log = logging.getLogger('winrm')
+
+GSS_IOV_BUFFER_TYPE_DATA = 1
+GSS_IOV_BUFFER_TYPE_HEADER = 2
+GSS_IOV_BUFFER_TYPE_PADDING = 9
+GSS_IOV_BUFFER_FLAG_ALLOCATE = 0x10000
+GSS_C_QOP_DEFAULT = 0
+_GSS_ERROR_MASK = 0xffff0000
+
+_LIBRARY_NAMES = ('libgssapi_krb5.so.2', 'libgssapi_krb5.so')
+_HEADER_LENGTH = struct.Struct('<I')
+
+
+class _Buffer(ctypes.Structure):
+    _fields_ = [('length', ctypes.c_size_t),
+                ('value', ctypes.c_void_p)]
+
+
+class _IovBuffer(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_uint32),
+                ('buffer', _Buffer)]
+
+
+class GSSIovError(Exception):
+    pass
+
+
+def _load_library():
+    if os.environ.get('TXWINRM_GSS_IOV', '1') == '0':
+        return None
+    names = list(_LIBRARY_NAMES)
+    found = ctypes.util.find_library('gssapi_krb5')
+    if found:
+        names.insert(0, found)
+    for name in names:
+        try:
+            lib = ctypes.CDLL(name)
+        except OSError:
+            continue
+        try:
+            for func_name in ('gss_wrap_iov', 'gss_unwrap_iov',
+                              'gss_release_iov_buffer'):
+                getattr(lib, func_name).restype = ctypes.c_uint32
+        except AttributeError:
+            return None
+        return lib
+    return None
+
+
+_lib = _load_library()
+
+
+def available():
+    """Is the GSSAPI library loaded with IOV support?"""
+    return _lib is not None
+
+
+def _get_capsule_pointer(obj):
+    pythonapi = ctypes.pythonapi
+    py_obj = ctypes.py_object(obj)
+    type_name = type(obj).__name__
+    if type_name == 'PyCapsule':
+        pythonapi.PyCapsule_GetName.restype = ctypes.c_char_p
+        pythonapi.PyCapsule_GetName.argtypes = [ctypes.py_object]
+        pythonapi.PyCapsule_GetPointer.restype = ctypes.c_void_p
+        pythonapi.PyCapsule_GetPointer.argtypes = [
+            ctypes.py_object, ctypes.c_char_p]
+        name = pythonapi.PyCapsule_GetName(py_obj)
+        return pythonapi.PyCapsule_GetPointer(py_obj, name)
+    if type_name == 'PyCObject':
+        pythonapi.PyCObject_AsVoidPtr.restype = ctypes.c_void_p
+        pythonapi.PyCObject_AsVoidPtr.argtypes = [ctypes.py_object]
+        return pythonapi.PyCObject_AsVoidPtr(py_obj)
+    return None
+
+
+def get_gss_context(client_context):
+    """
+    Return the gss_ctx_id_t of a kerberos.authGSSClientInit context, or None
+    if it can't be located.  The kerberos module keeps a gss_client_state
+    struct behind the capsule whose first member is the gss_ctx_id_t.
+    """
+    if _lib is None or client_context is None:
+        return None
+    try:
+        state = _get_capsule_pointer(client_context)
+    except Exception as e:
+        log.debug('Unable to read kerberos context: {0}'.format(e))
+        return None
+    if not state:
+        return None
+    return ctypes.c_void_p.from_address(state).value
+
+
+def _check(major, minor, func_name):
+    if major & _GSS_ERROR_MASK:
+        raise GSSIovError('{0} failed: major 0x{1:08x} minor 0x{2:08x}'
+                          .format(func_name, major, minor.value))
+
+
+def wrap(gss_context, data):
+    """
+    Encrypt data and return (payload, pad_len) where payload is the WinRM
+    framing of the header length, header, ciphertext and padding.
+    """
+    iov = (_IovBuffer * 3)()
+    iov[0].type = GSS_IOV_BUFFER_TYPE_HEADER | GSS_IOV_BUFFER_FLAG_ALLOCATE
+    data_buffer = ctypes.create_string_buffer(data, len(data))
+    iov[1].type = GSS_IOV_BUFFER_TYPE_DATA
+    iov[1].buffer.length = len(data)
+    iov[1].buffer.value = ctypes.cast(data_buffer, ctypes.c_void_p)
+    iov[2].type = GSS_IOV_BUFFER_TYPE_PADDING | GSS_IOV_BUFFER_FLAG_ALLOCATE
+    minor = ctypes.c_uint32()
+    conf_state = ctypes.c_int()
+    major = _lib.gss_wrap_iov(
+        ctypes.byref(minor), ctypes.c_void_p(gss_context), 1,
+        GSS_C_QOP_DEFAULT, ctypes.byref(conf_state), iov, 3)
+    _check(major, minor, 'gss_wrap_iov')
+    try:
+        header = ctypes.string_at(iov[0].buffer.value, iov[0].buffer.length)
+        pad_len = iov[2].buffer.length
+        parts = [_HEADER_LENGTH.pack(len(header)), header, data_buffer.raw]
+        if pad_len:
+            parts.append(ctypes.string_at(iov[2].buffer.value, pad_len))
+    finally:
+        _lib.gss_release_iov_buffer(ctypes.byref(minor), iov, 3)
+    return ''.join(parts), pad_len
+
+
+def unwrap(gss_context, payload):
+    """Decrypt a payload framed as returned by wrap."""
+    header_len = _HEADER_LENGTH.unpack_from(payload)[0]
+    data_offset = _HEADER_LENGTH.size + header_len
+    if data_offset > len(payload):
+        raise GSSIovError('Malformed encrypted payload')
+    payload_buffer = ctypes.create_string_buffer(payload, len(payload))
+    address = ctypes.addressof(payload_buffer)
+    iov = (_IovBuffer * 2)()
+    iov[0].type = GSS_IOV_BUFFER_TYPE_HEADER
+    iov[0].buffer.length = header_len
+    iov[0].buffer.value = address + _HEADER_LENGTH.size
+    iov[1].type = GSS_IOV_BUFFER_TYPE_DATA
+    iov[1].buffer.length = len(payload) - data_offset
+    iov[1].buffer.value = address + data_offset
+    minor = ctypes.c_uint32()
+    conf_state = ctypes.c_int()
+    qop_state = ctypes.c_uint32()
+    major = _lib.gss_unwrap_iov(
+        ctypes.byref(minor), ctypes.c_void_p(gss_context),
+        ctypes.byref(conf_state), ctypes.byref(qop_state), iov, 2)
+    _check(major, minor, 'gss_unwrap_iov')
+    return ctypes.string_at(iov[1].buffer.value, iov[1].buffer.length)
@@ -22,6 +22,12 @@ interface_map = [{'return_class': 'Win32_PnPEntity',
                   'search_property': 'DeviceID',
                   'where_type': 'ResultClass'
                   }]
+# the same for JoinClient.join, a PnP entity's DeviceID is the adapter's
+# PNPDeviceID
+interface_join_map = [{'return_class': 'Win32_PnPEntity',
+                       'search_property': 'PNPDeviceID',
+                       'join_property': 'DeviceID'
+                       }]
 # for use with seed_class of Win32_DiskDrive
 disk_map = [{'return_class': 'Win32_DiskDriveToDiskPartition',
              'search_class': 'Win32_DiskDrive',
@@ -9,8 +9,9 @@
 
 import logging
 
-from collections import namedtuple
-from twisted.internet import defer
+from collections import namedtuple, deque
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
 from .enumerate import create_winrm_client, DEFAULT_RESOURCE_URI
 from .util import (
     ConnectionInfo,
@@ -18,14 +19,15 @@ from .util import (
     RequestError,
     UnauthorizedError,
     )
+from .WinRMClient import EnumInfo
 
 
-EnumInfo = namedtuple('EnumInfo', ['wql', 'resource_uri'])
 log = logging.getLogger('winrm')
 
 
-def create_enum_info(wql, resource_uri=DEFAULT_RESOURCE_URI):
-    return EnumInfo(wql, resource_uri)
+def create_enum_info(wql, resource_uri=DEFAULT_RESOURCE_URI,
+                     max_elements=None, operation_timeout=None):
+    return EnumInfo(wql, resource_uri, max_elements, operation_timeout)
 
 
 class WinrmCollectClient(object):
@@ -46,7 +48,9 @@ class WinrmCollectClient(object):
         for enum_info in enum_infos:
             try:
                 items[enum_info] = yield client.enumerate(
-                    enum_info.wql, enum_info.resource_uri)
+                    enum_info.wql, enum_info.resource_uri,
+                    max_elements=enum_info.max_elements,
+                    operation_timeout=enum_info.operation_timeout)
             except (UnauthorizedError, ForbiddenError):
                 # Fail the collection for general errors.
                 raise
@@ -57,6 +61,136 @@ class WinrmCollectClient(object):
         defer.returnValue(items)
 
 
+class HostResult(namedtuple('HostResult', [
+        'conn_info',
+        'items',
+        'error',
+        'latency'])):
+    """
+    The outcome of collecting one host. items maps EnumInfo to the items of
+    the enumerations that succeeded. error is the Failure that stopped the
+    collection of the host, or None. latency is the seconds from starting
+    the host's first enumeration to finishing its last.
+    """
+
+
+def _get_realm(conn_info):
+    if conn_info.auth_type == 'kerberos' and '@' in conn_info.username:
+        return conn_info.username.split('@')[1].upper()
+    return None
+
+
+class FleetCollectClient(object):
+    """
+    Collects the enumerations of many hosts with bounded concurrency.
+
+    max_concurrent is the most enumerations in flight across all hosts,
+    which bounds the open connections. max_per_host is the most
+    enumerations in flight for one host, each with its own client.
+    max_per_realm is the most hosts of one Kerberos realm collected at the
+    same time, which bounds concurrent ticket requests to its KDCs.
+
+    Errors are handled like WinrmCollectClient.do_collect: a RequestError
+    skips its query, any other error stops the collection of its host.
+    """
+
+    def __init__(self, max_concurrent=100, max_per_host=1,
+                 max_per_realm=20, client_factory=create_winrm_client,
+                 clock=reactor):
+        self._global_sem = defer.DeferredSemaphore(max_concurrent)
+        self._max_per_host = max_per_host
+        self._max_per_realm = max_per_realm
+        # realm -> DeferredSemaphore
+        self._realm_sems = {}
+        self._client_factory = client_factory
+        self._clock = clock
+
+    def do_collect(self, enum_infos_by_conn_info, on_result=None):
+        """
+        Collect each ConnectionInfo's list of EnumInfo.
+
+        on_result is called with the HostResult of each host as soon as the
+        host is done. Returns a Deferred that fires with a dict of
+        ConnectionInfo to HostResult once all hosts are done.
+        """
+        results = {}
+        ds = []
+        for conn_info, enum_infos in enum_infos_by_conn_info.iteritems():
+            d = self._collect_host(conn_info, enum_infos)
+            d.addCallback(self._host_done, results, on_result)
+            ds.append(d)
+        d = defer.DeferredList(ds, consumeErrors=True)
+        d.addCallback(lambda ignored: results)
+        return d
+
+    def _host_done(self, result, results, on_result):
+        results[result.conn_info] = result
+        if result.error is not None:
+            log.info('{0} collection failed after {1:.3f}s: {2}'.format(
+                result.conn_info.hostname, result.latency,
+                result.error.getErrorMessage()))
+        else:
+            log.debug('{0} collected in {1:.3f}s'.format(
+                result.conn_info.hostname, result.latency))
+        if on_result is not None:
+            try:
+                on_result(result)
+            except Exception:
+                log.exception('Error handling the result of {0}'.format(
+                    result.conn_info.hostname))
+
+    def _collect_host(self, conn_info, enum_infos):
+        realm = _get_realm(conn_info)
+        if realm is None:
+            return self._run_host(conn_info, enum_infos)
+        sem = self._realm_sems.get(realm)
+        if sem is None:
+            sem = self._realm_sems[realm] = \
+                defer.DeferredSemaphore(self._max_per_realm)
+        d = sem.run(self._run_host, conn_info, enum_infos)
+
+        def release_realm(result):
+            if not sem.waiting and sem.tokens == sem.limit:
+                self._realm_sems.pop(realm, None)
+            return result
+        return d.addBoth(release_realm)
+
+    @defer.inlineCallbacks
+    def _run_host(self, conn_info, enum_infos):
+        start = self._clock.seconds()
+        items = {}
+        queue = deque(enum_infos)
+        errors = []
+        workers = [self._run_worker(conn_info, queue, items, errors)
+                   for i in xrange(min(self._max_per_host, len(queue)))]
+        yield defer.DeferredList(workers)
+        latency = self._clock.seconds() - start
+        defer.returnValue(HostResult(
+            conn_info, items, errors[0] if errors else None, latency))
+
+    @defer.inlineCallbacks
+    def _run_worker(self, conn_info, queue, items, errors):
+        try:
+            client = self._client_factory(conn_info)
+        except Exception:
+            errors.append(Failure())
+            return
+        while queue and not errors:
+            enum_info = queue.popleft()
+            try:
+                items[enum_info] = yield self._global_sem.run(
+                    client.enumerate,
+                    enum_info.wql, enum_info.resource_uri,
+                    max_elements=enum_info.max_elements,
+                    operation_timeout=enum_info.operation_timeout)
+            except (UnauthorizedError, ForbiddenError):
+                errors.append(Failure())
+            except RequestError:
+                continue
+            except Exception:
+                errors.append(Failure())
+
+
 # ----- An example of useage...
 
 if __name__ == '__main__':
@@ -27,11 +27,12 @@ attributes of the returned item objects follow these rules
 """
 
 import logging
-from cStringIO import StringIO
-from collections import deque
+from array import array
+from collections import deque, OrderedDict
 from pprint import pformat
 from xml import sax
-from twisted.internet import defer
+from xml.parsers import expat
+from twisted.internet import defer, reactor
 from twisted.internet.protocol import Protocol
 
 try:
@@ -41,13 +42,20 @@ except ImportError:
     class ResponseFailed(Exception):
         pass
 
+try:
+    from lxml import etree as _etree
+except ImportError:
+    _etree = None
+
 from . import constants as c
-from .util import RequestSender, get_datetime, RequestError
+from .util import RequestSender, get_datetime, RequestError, \
+    _EncryptedBodyReader
 
 log = logging.getLogger('winrm')
 _MAX_REQUESTS_PER_ENUMERATION = 9999
 DEFAULT_RESOURCE_URI = '{0}/*'.format(c.WMICIMV2)
 _MARKER = object()
+DEFAULT_PARSER_BACKEND = 'sax'
 
 
 class WinrmClient(object):
@@ -62,13 +70,19 @@ class WinrmClient(object):
         self._hostname = sender.hostname
 
     @defer.inlineCallbacks
-    def enumerate(self, wql, resource_uri=DEFAULT_RESOURCE_URI):
+    def enumerate(self, wql, resource_uri=DEFAULT_RESOURCE_URI,
+                  max_elements=None, operation_timeout=None, columnar=False,
+                  column_types=None):
         """
-        Runs a remote WQL query.
+        Runs a remote WQL query. max_elements and operation_timeout default
+        to the connection info's. With columnar=True a Columns instance is
+        returned instead of a list of items, with the numeric properties
+        named in column_types typed, see merge_columns.
         """
         request_template_name = 'enumerate'
         enumeration_context = None
         items = []
+        kwargs = dict(columnar=True) if columnar else {}
         try:
             for i in xrange(_MAX_REQUESTS_PER_ENUMERATION):
                 log.debug('{0} "{1}" {2}'.format(
@@ -77,12 +91,17 @@ class WinrmClient(object):
                     request_template_name,
                     resource_uri=resource_uri,
                     wql=wql,
-                    enumeration_context=enumeration_context)
+                    enumeration_context=enumeration_context,
+                    max_elements=max_elements,
+                    operation_timeout=operation_timeout)
                 log.debug("{0} HTTP status: {1}".format(
                     self._hostname, response.code))
                 enumeration_context, new_items = \
-                    yield self._handler.handle_response(response)
-                items.extend(new_items)
+                    yield self._handler.handle_response(response, **kwargs)
+                if columnar:
+                    items.append(new_items)
+                else:
+                    items.extend(new_items)
                 if not enumeration_context:
                     break
                 request_template_name = 'pull'
@@ -96,27 +115,62 @@ class WinrmClient(object):
                 log.debug('{0} {1}'.format(self._hostname, e))
             raise
         yield self._sender.close_connections()
+        if columnar:
+            items = merge_columns(items, column_types)
         defer.returnValue(items)
 
 
-def create_winrm_client(conn_info):
+def create_winrm_client(conn_info, parser_backend=None,
+                        lazy_datetimes=False):
     """
     Constructs a WinRM client with the default response handler.
+    parser_backend and lazy_datetimes are passed to
+    create_parser_and_factory.
     """
     sender = RequestSender(conn_info)
-    return WinrmClient(sender, SaxResponseHandler(sender))
+    return WinrmClient(sender, SaxResponseHandler(
+        sender, parser_backend, lazy_datetimes))
 
 
-def create_parser_and_factory():
+def create_parser_and_factory(on_enumeration_context=None, columnar=False,
+                              backend=None, lazy_datetimes=False):
     """
-    Sets up the SAX XML parser and returns it along with an
+    Sets up the XML parser and returns it along with an
     EnvelopeHandlerFactory instance that has access to the enumeration-context
-    and items of each WinRM response.
+    and items of each WinRM response. The parser only needs to be fed.
+
+    on_enumeration_context is called with the enumeration context as soon as
+    it has been parsed, before the items that follow it. With columnar=True
+    the items are a ColumnAccumulator instead of a list of Item.
+
+    backend is one of get_parser_backends() and defaults to
+    DEFAULT_PARSER_BACKEND. All backends give the same results. 'lxml' falls
+    back to 'expat' if lxml is not installed.
+
+    With lazy_datetimes the Datetime properties of items are parsed when
+    they are first read. It does not apply to columnar results.
     """
+    if backend is None:
+        backend = DEFAULT_PARSER_BACKEND
+    if backend == 'lxml' and _etree is None:
+        backend = 'expat'
+    try:
+        create_parser = _PARSER_BACKENDS[backend]
+    except KeyError:
+        raise ValueError('Unknown XML parser backend: {0}'.format(backend))
+    if columnar:
+        accumulator = ColumnAccumulator()
+    else:
+        accumulator = ItemsAccumulator(lazy_datetimes)
+    return create_parser(on_enumeration_context, accumulator)
+
+
+def _create_sax_parser(on_enumeration_context, accumulator):
     parser = sax.make_parser()
     parser.setFeature(sax.handler.feature_namespaces, True)
     text_buffer = TextBufferingContentHandler()
-    factory = EnvelopeHandlerFactory(text_buffer)
+    factory = EnvelopeHandlerFactory(
+        text_buffer, on_enumeration_context, accumulator)
     content_handler = ChainingContentHandler([
         text_buffer,
         DispatchingContentHandler(factory)])
@@ -124,21 +178,49 @@ def create_parser_and_factory():
     return parser, factory
 
 
+def _create_direct_parser(parser_class):
+    def create_parser(on_enumeration_context, accumulator):
+        parser = parser_class(on_enumeration_context, accumulator)
+        return parser, parser.factory
+    return create_parser
+
+
+def get_parser_backends():
+    """Return the names of the XML parser backends that are available."""
+    return [name for name in _PARSER_BACKENDS
+            if name != 'lxml' or _etree is not None]
+
+
 class SaxResponseHandler(object):
     """
-    The default response handler.
+    The default response handler. parser_backend and lazy_datetimes are
+    passed to create_parser_and_factory.
     """
-    def __init__(self, sender):
+    def __init__(self, sender, parser_backend=None, lazy_datetimes=False):
         self._sender = sender
+        self._parser_backend = parser_backend
+        self._lazy_datetimes = lazy_datetimes
 
     @defer.inlineCallbacks
-    def handle_response(self, response):
+    def handle_response(self, response, on_enumeration_context=None,
+                        columnar=False):
         """
         Given a Twisted response object, parse it and return the
-        enumeration-context and items.
+        enumeration-context and items. With columnar=True the items are
+        returned as the ColumnAccumulator of the page, see merge_columns.
+
+        If on_enumeration_context is given it is called with the enumeration
+        context as soon as it is parsed so the next Pull can be sent while
+        the rest of the response is processed. Kerberos responses are then
+        parsed only after the connection has been released, so that Pull
+        can reuse the authenticated connection.
         """
-        parser, factory = create_parser_and_factory()
-        proto = ParserFeedingProtocol(parser, self._sender)
+        parser, factory = create_parser_and_factory(
+            on_enumeration_context, columnar, self._parser_backend,
+            self._lazy_datetimes)
+        proto = ParserFeedingProtocol(
+            parser, self._sender,
+            defer_parsing=on_enumeration_context is not None)
         response.deliverBody(proto)
         yield proto.d
         defer.returnValue((factory.enumeration_context, factory.items))
@@ -152,24 +234,54 @@ def safe_lower_equals(left, right):
     return left_l == right_l
 
 
-class TagComparer(object):
+_MAX_LOWERED_NAMES = 10000
+_lowered_names = {}
+
+
+def _lower_name(name):
+    """
+    Return the uri/localname pair name lowered for case-insensitive
+    comparison. The result is cached because responses repeat the same few
+    hundred names.
     """
-    Compares namespaced XML tags.
+    lowered = _lowered_names.get(name)
+    if lowered is None:
+        if len(_lowered_names) >= _MAX_LOWERED_NAMES:
+            _lowered_names.clear()
+        uri, localname = name
+        lowered = _lowered_names[name] = (
+            None if uri is None else uri.lower(),
+            None if localname is None else localname.lower())
+    return lowered
+
+
+class TagComparer(tuple):
     """
+    Compares namespaced XML tags. It is the uri/localname pair the SAX
+    parser reports for a tag.
+    """
+
+    __slots__ = ()
 
-    def __init__(self, uri, localname):
-        self.uri = uri
-        self.localname = localname
+    def __new__(cls, uri, localname):
+        return tuple.__new__(cls, (uri, localname))
+
+    @property
+    def uri(self):
+        return self[0]
+
+    @property
+    def localname(self):
+        return self[1]
 
     def matches(self, uri, localname):
         """
         Does this tag match the uri/localname passed in?
         """
-        return safe_lower_equals(self.uri, uri) \
-            and safe_lower_equals(self.localname, localname)
+        return _lower_name(self) == _lower_name((uri, localname))
 
     def __repr__(self):
-        return str((self.uri, self.localname))
+        return str((self[0], self[1]))
 
 
 def create_tag_comparer(name):
@@ -180,6 +292,24 @@ def create_tag_comparer(name):
     return TagComparer(uri, localname)
 
 
+def _lowered_tags(*names):
+    return frozenset(_lower_name(name) for name in names)
+
+
+_ENUMERATION_CONTEXT_TAGS = _lowered_tags(
+    (c.XML_NS_ENUMERATION, c.WSENUM_ENUMERATION_CONTEXT))
+_END_OF_SEQUENCE_TAGS = _lowered_tags(
+    (c.XML_NS_ENUMERATION, c.WSENUM_END_OF_SEQUENCE),
+    (c.XML_NS_WS_MAN, c.WSENUM_END_OF_SEQUENCE))
+_ITEMS_TAGS = _lowered_tags(
+    (c.XML_NS_WS_MAN, c.WSENUM_ITEMS),
+    (c.XML_NS_ENUMERATION, c.WSENUM_ITEMS))
+_DATETIME_TAGS = _lowered_tags(
+    (c.XML_NS_CIM_SCHEMA, "Datetime"),
+    (None, "Datetime"))
+_NIL_ATTRIBUTE = (c.XML_NS_BUILTIN, c.BUILTIN_NIL)
+
+
 class ChainingProtocol(Protocol):
     """
     A Twisted Protocol that dispatches calls to all the sub-protocols in its
@@ -209,21 +339,37 @@ class ChainingProtocol(Protocol):
 class ParserFeedingProtocol(Protocol):
     """
     A Twisted Protocol that feeds an XML parser as data is received.
+
+    Kerberos-encrypted bodies are unwrapped as soon as the closing MIME
+    boundary arrives, without first joining the whole response. With
+    defer_parsing the unwrapped body is parsed in the next reactor
+    iteration, after the connection has gone back to the pool.
     """
 
-    def __init__(self, xml_parser, sender):
+    def __init__(self, xml_parser, sender, defer_parsing=False):
         self._xml_parser = xml_parser
         self.d = defer.Deferred()
         self._debug_data = ''
         self._sender = sender
-        self._data = []
+        self._error = None
+        self._defer_parsing = defer_parsing
+        self._decrypted = []
+        if sender.is_kerberos():
+            self._reader = _EncryptedBodyReader(
+                sender.decrypt_payload, self._feed_decrypted)
+        else:
+            self._reader = None
 
     def dataReceived(self, data):
         """
         Called from Twisted when data is received.
         """
-        if self._sender.is_kerberos():
-            self._data.append(data)
+        if self._reader is not None:
+            if self._error is None:
+                try:
+                    self._reader.feed(data)
+                except Exception as e:
+                    self._error = e
             return
 
         if log.isEnabledFor(logging.DEBUG):
@@ -232,19 +378,46 @@ class ParserFeedingProtocol(Protocol):
                       .format(data))
         self._xml_parser.feed(data)
 
+    def _feed_decrypted(self, data):
+        if data is None:
+            raise Exception('Unable to decrypt message body')
+        if self._defer_parsing:
+            self._decrypted.append(data)
+            return
+        if log.isEnabledFor(logging.DEBUG):
+            self._debug_data += data
+        try:
+            self._xml_parser.feed(data)
+        except Exception:
+            raise Exception('Could not parse SOAP message: {}'.format(data))
+
     def connectionLost(self, reason):
         """
         Called from Twisted indicating that dataReceived has been called for
         the last time.
         """
-        if self._sender.is_kerberos():
-            #  Decrypt data first
-            data = self._sender.decrypt_body(''.join(self._data))
-            self._debug_data = data
+        if self._reader is not None and self._error is None:
             try:
-                self._xml_parser.feed(data)
-            except Exception:
-                raise Exception('Could not parse SOAP message: {}'.format(data))
+                self._reader.close()
+            except Exception as e:
+                self._error = e
+        if self._decrypted:
+            reactor.callLater(0, self._parse_decrypted, reason)
+        else:
+            self._finish(reason)
+
+    def _parse_decrypted(self, reason):
+        self._defer_parsing = False
+        if self._error is None:
+            try:
+                for data in self._decrypted:
+                    self._feed_decrypted(data)
+            except Exception as e:
+                self._error = e
+        self._decrypted = None
+        self._finish(reason)
+
+    def _finish(self, reason):
         if self._debug_data and log.isEnabledFor(logging.DEBUG):
             try:
                 import xml.dom.minidom
@@ -255,7 +428,10 @@ class ParserFeedingProtocol(Protocol):
                           .format(self._debug_data))
         if isinstance(reason.value, ResponseFailed):
             log.error("Connection lost: {0}".format(reason.value.reasons[0]))
-        self.d.callback(None)
+        if self._error is not None:
+            self.d.errback(self._error)
+        else:
+            self.d.callback(None)
 
 
 class ChainingContentHandler(sax.handler.ContentHandler):
@@ -292,13 +468,24 @@ class ChainingContentHandler(sax.handler.ContentHandler):
             handler.characters(content)
 
 
+def _join_text(chunks):
+    """Return the text of chunks, as str unless it is not ASCII."""
+    if not chunks:
+        return ''
+    text = chunks[0] if len(chunks) == 1 else u''.join(chunks)
+    try:
+        return str(text)
+    except UnicodeEncodeError:
+        return text
+
+
 class TextBufferingContentHandler(sax.handler.ContentHandler):
     """
     Keeps track of the text in the current XML element.
     """
 
     def __init__(self):
-        self._buffer = StringIO()
+        self._chunks = []
         self._text = None
 
     @property
@@ -313,20 +500,22 @@ class TextBufferingContentHandler(sax.handler.ContentHandler):
         A SAX callback indicating the start of an element. Includes namespace
         information.
 
-        This implementation resets and truncates the buffer.
+        This implementation empties the buffer.
         """
-        self._reset_truncate()
+        if self._chunks:
+            del self._chunks[:]
 
     def endElementNS(self, name, qname):
         """
         A SAX callback indicating the end of an element. Includes namespace
         information.
 
-        This implementation saves the text from the buffer. Then it resets and
-        truncates the buffer.
+        This implementation saves the text from the buffer, as str unless it
+        is not ASCII. Then it empties the buffer.
         """
-        self._text = self._buffer.getvalue()
-        self._reset_truncate()
+        self._text = _join_text(self._chunks)
+        if self._chunks:
+            del self._chunks[:]
 
     def characters(self, content):
         """
@@ -335,11 +524,7 @@ class TextBufferingContentHandler(sax.handler.ContentHandler):
 
         This implementation writes to the buffer.
         """
-        self._buffer.write(content)
-
-    def _reset_truncate(self):
-        self._buffer.reset()
-        self._buffer.truncate()
+        self._chunks.append(content)
 
 
 class DispatchingContentHandler(sax.handler.ContentHandler):
@@ -354,6 +539,7 @@ class DispatchingContentHandler(sax.handler.ContentHandler):
         self._subhandler_factory = subhandler_factory
         self._subhandler_tag = None
         self._subhandler = None
+        self._debug = log.isEnabledFor(logging.DEBUG)
 
     def startElementNS(self, name, qname, attrs):
         """
@@ -362,14 +548,16 @@ class DispatchingContentHandler(sax.handler.ContentHandler):
 
         This implementation dispatches to the sub-handler based on the tag.
         """
-        log.debug('DispatchingContentHandler startElementNS {0} {1} {2}'
-                  .format(name, self._subhandler, self._subhandler_tag))
+        if self._debug:
+            log.debug('DispatchingContentHandler startElementNS {0} {1} {2}'
+                      .format(name, self._subhandler, self._subhandler_tag))
         if self._subhandler is None:
             self._subhandler, tag = self._get_subhandler_for(name)
             if self._subhandler is not None:
                 self._subhandler_tag = tag
-                log.debug('new subhandler {0} {1}'
-                          .format(self._subhandler, self._subhandler_tag))
+                if self._debug:
+                    log.debug('new subhandler {0} {1}'
+                              .format(self._subhandler, self._subhandler_tag))
 
         if self._subhandler is not None:
             self._subhandler.startElementNS(name, qname, attrs)
@@ -381,20 +569,149 @@ class DispatchingContentHandler(sax.handler.ContentHandler):
 
         This implementation dispatches to the sub-handler based on the tag.
         """
-        log.debug('DispatchingContentHandler endElementNS {0} {1}'
-                  .format(name, self._subhandler))
+        if self._debug:
+            log.debug('DispatchingContentHandler endElementNS {0} {1}'
+                      .format(name, self._subhandler))
         if self._subhandler is not None:
             self._subhandler.endElementNS(name, qname)
         if self._subhandler_tag is not None:
-            uri, localname = name
-            if self._subhandler_tag.matches(uri, localname):
+            if self._subhandler_tag == name:
                 self._subhandler_tag = None
                 self._subhandler = None
-                log.debug('removed subhandler')
+                if self._debug:
+                    log.debug('removed subhandler')
 
     def _get_subhandler_for(self, name):
-        tag = create_tag_comparer(name)
-        return self._subhandler_factory.get_handler_for(tag), tag
+        # The parser reports the same name for the start and end of an
+        # element, so the name itself is kept to recognize the end.
+        return self._subhandler_factory.get_handler_for(name), name
+
+
+class _DirectParser(object):
+    """
+    Base class of the parsers that drive the sub-handlers of an
+    EnvelopeHandlerFactory directly instead of through the xml.sax layers.
+    It does the work of DispatchingContentHandler and is the text buffer of
+    the sub-handlers. Subclasses implement feed and call _start and _end
+    with uri/localname pairs.
+    """
+
+    def __init__(self, on_enumeration_context, accumulator):
+        self.text = None
+        self.factory = EnvelopeHandlerFactory(
+            self, on_enumeration_context, accumulator)
+        self._subhandler = None
+        self._subhandler_tag = None
+        self._names = {}
+
+    def feed(self, data):
+        raise NotImplementedError
+
+    def _get_name(self, name, separator, prefix=''):
+        """Return the uri/localname pair of a name the parser reports."""
+        pair = self._names.get(name)
+        if pair is None:
+            uri, sep, localname = name.rpartition(separator)
+            if sep:
+                pair = (uri[len(prefix):], localname)
+            else:
+                pair = (None, name)
+            self._names[name] = pair
+        return pair
+
+    def _start(self, name, attrs):
+        subhandler = self._subhandler
+        if subhandler is None:
+            subhandler = self.factory.get_handler_for(name)
+            if subhandler is None:
+                return
+            self._subhandler = subhandler
+            self._subhandler_tag = name
+        subhandler.startElementNS(name, None, attrs)
+
+    def _end(self, name, text):
+        self.text = text
+        subhandler = self._subhandler
+        if subhandler is not None:
+            subhandler.endElementNS(name, None)
+            if self._subhandler_tag == name:
+                self._subhandler = None
+                self._subhandler_tag = None
+
+
+class _ExpatParser(_DirectParser):
+    """Parses with pyexpat."""
+
+    def __init__(self, on_enumeration_context, accumulator):
+        super(_ExpatParser, self).__init__(
+            on_enumeration_context, accumulator)
+        self._chunks = []
+        parser = expat.ParserCreate(namespace_separator=' ')
+        parser.buffer_text = True
+        parser.StartElementHandler = self._start_element
+        parser.EndElementHandler = self._end_element
+        parser.CharacterDataHandler = self._chunks.append
+        self._parser = parser
+
+    def feed(self, data):
+        self._parser.Parse(data, False)
+
+    def _start_element(self, name, attrs):
+        if self._chunks:
+            del self._chunks[:]
+        if attrs:
+            attrs = dict((self._get_name(key, ' '), value)
+                         for key, value in attrs.iteritems())
+        self._start(self._get_name(name, ' '), attrs)
+
+    def _end_element(self, name):
+        text = _join_text(self._chunks)
+        if self._chunks:
+            del self._chunks[:]
+        self._end(self._get_name(name, ' '), text)
+
+
+class _LxmlParser(_DirectParser):
+    """
+    Parses with lxml.etree.XMLPullParser. Elements are removed from the tree
+    once they have been handled, so it never holds more than the open
+    elements and their last children.
+    """
+
+    def __init__(self, on_enumeration_context, accumulator):
+        super(_LxmlParser, self).__init__(
+            on_enumeration_context, accumulator)
+        self._parser = _etree.XMLPullParser(events=('start', 'end'))
+
+    def feed(self, data):
+        self._parser.feed(data)
+        for event, elem in self._parser.read_events():
+            if event == 'start':
+                attrs = elem.attrib
+                if attrs:
+                    attrs = dict((self._get_name(key, '}', '{'), value)
+                                 for key, value in attrs.iteritems())
+                else:
+                    attrs = {}
+                self._start(self._get_name(elem.tag, '}', '{'), attrs)
+                continue
+            # the text since the last start or end, as with the SAX backend
+            if len(elem):
+                text = elem[-1].tail
+                del elem[:-1]
+            else:
+                text = elem.text
+            self._end(self._get_name(elem.tag, '}', '{'), text or '')
+            parent = elem.getparent()
+            if parent is not None:
+                del parent[:-1]
+
+
+_PARSER_BACKENDS = OrderedDict([
+    ('sax', _create_sax_parser),
+    ('expat', _create_direct_parser(_ExpatParser)),
+    ('lxml', _create_direct_parser(_LxmlParser)),
+])
 
 
 def is_end_of_sequence(tag):
@@ -402,8 +719,7 @@ def is_end_of_sequence(tag):
     Is this tag an enumeration end-of-sequence tag. The namespace varies
     between 'select *' queries and queries that explicitly list properties.
     """
-    return tag.matches(c.XML_NS_ENUMERATION, c.WSENUM_END_OF_SEQUENCE) \
-        or tag.matches(c.XML_NS_WS_MAN, c.WSENUM_END_OF_SEQUENCE)
+    return _lower_name(tag) in _END_OF_SEQUENCE_TAGS
 
 
 class EnvelopeHandlerFactory(object):
@@ -412,9 +728,11 @@ class EnvelopeHandlerFactory(object):
     handler.
     """
 
-    def __init__(self, text_buffer):
-        self._enumerate_handler = EnumerateContentHandler(text_buffer)
-        self._items_handler = ItemsContentHandler(text_buffer)
+    def __init__(self, text_buffer, on_enumeration_context=None,
+                 accumulator=None):
+        self._enumerate_handler = EnumerateContentHandler(
+            text_buffer, on_enumeration_context)
+        self._items_handler = ItemsContentHandler(text_buffer, accumulator)
 
     @property
     def enumeration_context(self):
@@ -433,17 +751,19 @@ class EnvelopeHandlerFactory(object):
 
     def get_handler_for(self, tag):
         """
-        Return the subhandler that should be activated for the given XML tag.
+        Return the subhandler that should be activated for the given XML tag,
+        a uri/localname pair.
         """
         handler = None
-        if tag.matches(c.XML_NS_ENUMERATION, c.WSENUM_ENUMERATION_CONTEXT) \
-                or is_end_of_sequence(tag):
+        lowered = _lower_name(tag)
+        if lowered in _ENUMERATION_CONTEXT_TAGS \
+                or lowered in _END_OF_SEQUENCE_TAGS:
             handler = self._enumerate_handler
-        elif tag.matches(c.XML_NS_WS_MAN, c.WSENUM_ITEMS) \
-                or tag.matches(c.XML_NS_ENUMERATION, c.WSENUM_ITEMS):
+        elif lowered in _ITEMS_TAGS:
             handler = self._items_handler
-        log.debug('EnvelopeHandlerFactory get_handler_for {0} {1}'
-                  .format(tag, handler))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('EnvelopeHandlerFactory get_handler_for {0} {1}'
+                      .format(tag, handler))
         return handler
 
 
@@ -453,10 +773,11 @@ class EnumerateContentHandler(sax.handler.ContentHandler):
     end-of-sequence elements in a WinRM response.
     """
 
-    def __init__(self, text_buffer):
+    def __init__(self, text_buffer, on_enumeration_context=None):
         self._text_buffer = text_buffer
         self._enumeration_context = None
         self._end_of_sequence = False
+        self._on_enumeration_context = on_enumeration_context
 
     @property
     def enumeration_context(self):
@@ -475,10 +796,12 @@ class EnumerateContentHandler(sax.handler.ContentHandler):
         This implementation records the enumeration-context and
         end-of-sequence values.
         """
-        tag = create_tag_comparer(name)
-        if tag.matches(c.XML_NS_ENUMERATION, c.WSENUM_ENUMERATION_CONTEXT):
+        lowered = _lower_name(name)
+        if lowered in _ENUMERATION_CONTEXT_TAGS:
             self._enumeration_context = self._text_buffer.text
-        if is_end_of_sequence(tag):
+            if self._enumeration_context and self._on_enumeration_context:
+                self._on_enumeration_context(self._enumeration_context)
+        elif lowered in _END_OF_SEQUENCE_TAGS:
             self._end_of_sequence = True
 
 
@@ -493,11 +816,123 @@ class AddPropertyWithoutItemError(Exception):
                                  " {0}".format(msg))
 
 
+class _Schema(object):
+    """
+    The property names of an item and their positions. Items with the same
+    properties in the same order share one schema.
+    """
+    __slots__ = ('names', 'positions')
+
+    def __init__(self, names):
+        self.names = names
+        self.positions = dict((name, i) for i, name in enumerate(names))
+
+
+_EMPTY_SCHEMA = _Schema(())
+_MAX_SCHEMAS = 1000
+_schemas = {(): _EMPTY_SCHEMA}
+
+
+def _get_schema(names):
+    schema = _schemas.get(names)
+    if schema is None:
+        if len(_schemas) >= _MAX_SCHEMAS:
+            _schemas.clear()
+        schema = _schemas[names] = _Schema(names)
+    return schema
+
+
+class _LazyDatetime(object):
+    """
+    The text of a Datetime property that is parsed when the property is
+    first read.
+    """
+    __slots__ = ('_text', '_value')
+
+    def __init__(self, text):
+        self._text = text
+        self._value = _MARKER
+
+    @property
+    def value(self):
+        if self._value is _MARKER:
+            self._value = get_datetime(self._text)
+        return self._value
+
+
+def _resolve(value):
+    """Return the value of a property with lazy datetimes parsed."""
+    cls = value.__class__
+    if cls is _LazyDatetime:
+        return value.value
+    if cls is list and value and value[0].__class__ is _LazyDatetime:
+        value[:] = [_resolve(v) for v in value]
+    return value
+
+
 class Item(object):
     """
     A flexible object for storing the properties of the items returned by a WQL
     query.
+
+    The values of the properties parsed from the response are kept in a
+    tuple laid out by a schema shared with the other items of the same
+    shape. Properties set later are kept in a dict. vars(item) returns a
+    new dict of all properties.
     """
+    __slots__ = ('_schema', '_values', '_extra')
+
+    def __init__(self, schema=_EMPTY_SCHEMA, values=()):
+        object.__setattr__(self, '_schema', schema)
+        object.__setattr__(self, '_values', values)
+        object.__setattr__(self, '_extra', None)
+
+    def __getattr__(self, name):
+        # only called for names that are not set slots
+        if name in Item.__slots__:
+            raise AttributeError(name)
+        position = self._schema.positions.get(name)
+        if position is not None:
+            return _resolve(self._values[position])
+        if self._extra is not None and name in self._extra:
+            return self._extra[name]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        position = self._schema.positions.get(name)
+        if position is not None:
+            values = list(self._values)
+            values[position] = value
+            object.__setattr__(self, '_values', tuple(values))
+            return
+        if self._extra is None:
+            object.__setattr__(self, '_extra', {})
+        self._extra[name] = value
+
+    def __delattr__(self, name):
+        position = self._schema.positions.get(name)
+        if position is not None:
+            fields = vars(self)
+            del fields[name]
+            self.__setstate__(fields)
+        elif self._extra is not None and name in self._extra:
+            del self._extra[name]
+        else:
+            raise AttributeError(name)
+
+    @property
+    def __dict__(self):
+        fields = dict(zip(self._schema.names,
+                          [_resolve(value) for value in self._values]))
+        if self._extra:
+            fields.update(self._extra)
+        return fields
+
+    def __getstate__(self):
+        return vars(self)
+
+    def __setstate__(self, state):
+        self.__init__(_get_schema(tuple(state)), tuple(state.itervalues()))
 
     def __repr__(self):
         return '\n' + pformat(vars(self), indent=4)
@@ -512,16 +947,26 @@ class ItemsAccumulator(object):
     be called before the first call to new_item. add_property being called
     multiple times with the same name within the same item indicates that
     the property is an array.
+
+    With lazy_datetimes Datetime properties are parsed when they are first
+    read instead of while the response is parsed, so a date that is not
+    valid raises ValueError then.
     """
 
-    def __init__(self):
+    def __init__(self, lazy_datetimes=False):
+        self.lazy_datetimes = lazy_datetimes
         self._items = []
+        # names, values and name positions of the item being built
+        self._names = None
+        self._values = None
+        self._positions = None
 
     @property
     def items(self):
         """
         The items contained in the response.
         """
+        self._finish_item()
         return self._items
 
     def new_item(self):
@@ -529,25 +974,189 @@ class ItemsAccumulator(object):
         Indicates that a new item was recognized in the response XML.
         Subsequent calls to add_property belong to this item.
         """
-        self._items.append(Item())
+        self._finish_item()
+        self._names = []
+        self._values = []
+        self._positions = {}
 
     def add_property(self, name, value):
         """
         Add a property to the current item. Includes special handling for array
         types.
         """
-        if not self._items:
+        if self._names is None:
             raise AddPropertyWithoutItemError(
                 "{0} = {1}".format(name, value))
-        item = self._items[-1]
-        prop = getattr(item, name, _MARKER)
-        if prop is _MARKER:
-            setattr(item, name, value)
+        position = self._positions.get(name)
+        if position is None:
+            self._positions[name] = len(self._names)
+            self._names.append(name)
+            self._values.append(value)
             return
+        prop = self._values[position]
         if isinstance(prop, list):
             prop.append(value)
             return
-        setattr(item, name, [prop, value])
+        self._values[position] = [prop, value]
+
+    def _finish_item(self):
+        if self._names is None:
+            return
+        self._items.append(
+            Item(_get_schema(tuple(self._names)), tuple(self._values)))
+        self._names = self._values = self._positions = None
+
+
+class ColumnAccumulator(object):
+    """
+    Accumulates the properties of the items of a response as columns of
+    raw values instead of Item instances. It has the interface of
+    ItemsAccumulator, and items returns the accumulator itself. len() is
+    the number of items. Values missing from an item are None. See
+    merge_columns for typed columns.
+    """
+
+    lazy_datetimes = False
+
+    def __init__(self):
+        self._count = 0
+        self.columns = OrderedDict()
+
+    @property
+    def items(self):
+        return self
+
+    def __len__(self):
+        return self._count
+
+    def new_item(self):
+        self._count += 1
+
+    def add_property(self, name, value):
+        if not self._count:
+            raise AddPropertyWithoutItemError(
+                "{0} = {1}".format(name, value))
+        column = self.columns.get(name)
+        if column is None:
+            column = self.columns[name] = []
+        elif len(column) == self._count:
+            # an array property
+            prop = column[-1]
+            if isinstance(prop, list):
+                prop.append(value)
+            else:
+                column[-1] = [prop, value]
+            return
+        if len(column) < self._count - 1:
+            column.extend([None] * (self._count - 1 - len(column)))
+        column.append(value)
+
+    def padded_columns(self):
+        """Return the columns padded to the number of items."""
+        for column in self.columns.itervalues():
+            if len(column) < self._count:
+                column.extend([None] * (self._count - len(column)))
+        return self.columns
+
+
+try:
+    array('q')
+    _INT_TYPECODE = 'q'
+except ValueError:
+    # python 2 has no 'q'. 'l' is 64 bit on LP64 platforms.
+    _INT_TYPECODE = 'l' if array('l').itemsize == 8 else None
+
+
+_CIM_INT_TYPES = frozenset([
+    'sint8', 'uint8', 'sint16', 'uint16', 'sint32', 'uint32', 'sint64',
+    'uint64'])
+_CIM_REAL_TYPES = frozenset(['real32', 'real64'])
+
+
+def _typed_column(values, cim_type):
+    """
+    Return the values of a property of CIM type cim_type as an array of
+    ints or floats, with 0 in place of None. Values of other types, and
+    values that do not convert, e.g. arrays or a uint64 beyond the range of
+    the array, stay a list.
+    """
+    if cim_type in _CIM_INT_TYPES and _INT_TYPECODE is not None:
+        typecode, convert = _INT_TYPECODE, int
+    elif cim_type in _CIM_INT_TYPES or cim_type in _CIM_REAL_TYPES:
+        typecode, convert = 'd', float
+    else:
+        return values
+    if values.count(None) == len(values):
+        return values
+    try:
+        return array(typecode, [0 if value is None else convert(value)
+                                for value in values])
+    except (ValueError, TypeError, OverflowError):
+        return values
+
+
+class Columns(object):
+    """
+    The result of a columnar enumeration. Each property is one column with
+    a value per item. WS-Management does not send the CIM types of the
+    properties, so the caller names them, see merge_columns: a property of
+    an integer CIM type such as uint64 is an array('q') (array('l') on
+    python 2), one of type real32 or real64 an array('d'), any other a list
+    of the strings received. A property that is nil or missing in some
+    items has a nil mask, array('b') with 1 for those items. Their values
+    are 0 in arrays and None in lists.
+    """
+
+    def __init__(self, count=0, columns=None, nils=None):
+        self.count = count
+        self.columns = columns if columns is not None else OrderedDict()
+        self.nils = nils if nils is not None else {}
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __repr__(self):
+        return '\n' + pformat(dict(self.columns), indent=4)
+
+
+def merge_columns(pages, column_types=None):
+    """
+    Return the Columns of the ColumnAccumulators of the pages. column_types
+    maps property names to CIM types, e.g. {'PercentProcessorTime':
+    'uint64'}. Only properties of numeric types become arrays.
+    """
+    column_types = column_types or {}
+    count = sum(len(page) for page in pages)
+    raw = OrderedDict()
+    offset = 0
+    for page in pages:
+        for name, column in page.padded_columns().iteritems():
+            values = raw.get(name)
+            if values is None:
+                values = raw[name] = [None] * offset
+            elif len(values) < offset:
+                values.extend([None] * (offset - len(values)))
+            values.extend(column)
+        offset += len(page)
+    result = Columns(count)
+    for name, values in raw.iteritems():
+        if len(values) < count:
+            values.extend([None] * (count - len(values)))
+        if None in values:
+            result.nils[name] = array(
+                'b', [value is None for value in values])
+        result.columns[name] = _typed_column(
+            values, column_types.get(name))
+    return result
 
 
 class TagStackStateError(Exception):
@@ -578,11 +1187,16 @@ class ItemsContentHandler(sax.handler.ContentHandler):
         </Items>
 
     """
-    def __init__(self, text_buffer):
+    def __init__(self, text_buffer, accumulator=None):
         self._text_buffer = text_buffer
-        self._accumulator = ItemsAccumulator()
+        if accumulator is None:
+            accumulator = ItemsAccumulator()
+        self._accumulator = accumulator
+        # the uri/localname pairs of the open elements
         self._tag_stack = deque()
         self._value = None
+        self._debug = log.isEnabledFor(logging.DEBUG)
+        self._lazy_datetimes = accumulator.lazy_datetimes
 
     @property
     def items(self):
@@ -599,20 +1213,22 @@ class ItemsContentHandler(sax.handler.ContentHandler):
         This instance manipulates the tag stack, creating a new instance if
         it's length is 1. Saves value as None if the nil attribute is present.
         """
-        log.debug('ItemsContentHandler startElementNS {0} v="{1}" t="{2}" {3}'
-                  .format(name, self._value, self._text_buffer.text,
-                          self._tag_stack))
-        tag = create_tag_comparer(name)
-        if len(self._tag_stack) > 3:
+        if self._debug:
+            log.debug(
+                'ItemsContentHandler startElementNS {0} v="{1}" t="{2}" {3}'
+                .format(name, self._value, self._text_buffer.text,
+                        self._tag_stack))
+        depth = len(self._tag_stack)
+        if depth > 3:
             raise Exception("tag stack too long: {0} {1}"
-                            .format([t.localname for t in self._tag_stack],
-                                    tag.localname))
-        if len(self._tag_stack) == 1:
+                            .format([t[1] for t in self._tag_stack],
+                                    name[1]))
+        if depth == 1:
             self._accumulator.new_item()
-        elif len(self._tag_stack) == 2:
-            if attrs.get((c.XML_NS_BUILTIN, c.BUILTIN_NIL), None) == 'true':
+        elif depth == 2:
+            if attrs.get(_NIL_ATTRIBUTE, None) == 'true':
                 self._value = (None,)
-        self._tag_stack.append(tag)
+        self._tag_stack.append(name)
 
     def endElementNS(self, name, qname):
         """
@@ -624,25 +1240,33 @@ class ItemsContentHandler(sax.handler.ContentHandler):
         the text as a date and saves it for later use when the properties
         element is closed.
         """
-        log.debug('ItemsContentHandler endElementNS {0} v="{1}" t="{2}" {3}'
-                  .format(name, self._value, self._text_buffer.text,
-                          self._tag_stack))
-        tag = create_tag_comparer(name)
+        if self._debug:
+            log.debug(
+                'ItemsContentHandler endElementNS {0} v="{1}" t="{2}" {3}'
+                .format(name, self._value, self._text_buffer.text,
+                        self._tag_stack))
         popped_tag = self._tag_stack.pop()
-        if not popped_tag.matches(tag.uri, tag.localname):
+        # the parser reports the same name for the start and end of an
+        # element, so there is no need for a case-insensitive comparison
+        if popped_tag != name:
             raise TagStackStateError(
                 "End of {0} when expecting {1}"
-                .format(tag.localname, popped_tag.localname))
-        log.debug("ItemsContentHandler endElementNS tag_stack: {0}"
-                  .format(self._tag_stack))
-        if len(self._tag_stack) == 2:
+                .format(name[1], popped_tag[1]))
+        if self._debug:
+            log.debug("ItemsContentHandler endElementNS tag_stack: {0}"
+                      .format(self._tag_stack))
+        depth = len(self._tag_stack)
+        if depth == 2:
             if self._value is None:
                 value = self._text_buffer.text
             else:
                 value = self._value[0]
-            self._accumulator.add_property(tag.localname, value)
+            self._accumulator.add_property(name[1], value)
             self._value = None
-        elif len(self._tag_stack) == 3:
-            if tag.matches(c.XML_NS_CIM_SCHEMA, "Datetime") \
-                    or tag.matches(None, "Datetime"):
-                self._value = (get_datetime(self._text_buffer.text),)
+        elif depth == 3:
+            if _lower_name(name) in _DATETIME_TAGS:
+                if self._lazy_datetimes:
+                    value = _LazyDatetime(self._text_buffer.text)
+                else:
+                    value = get_datetime(self._text_buffer.text)
+                self._value = (value,)
@@ -10,19 +10,29 @@
 import logging
 
 import collections
+import hashlib
 import os
 import re
+import struct
+import time
 
 from twisted.internet import defer, reactor
 from twisted.internet.protocol import ProcessProtocol
+from twisted.python.failure import Failure
 LOG = logging.getLogger('txwinrm.krb5')
 
 
 __all__ = [
     'kinit',
     'ccname',
+    'mark_used',
 ]
 
+# Renew a TGT this many seconds, or a fifth of its remaining lifetime if
+# that is longer, before it expires.
+RENEW_MARGIN = 300
+MIN_RENEW_DELAY = 60
+
 
 KRB5_CONF_TEMPLATE = (
     "# This file is managed by the txwinrm python module.\n"
@@ -93,13 +103,21 @@ class KlistProcessProtocol(ProcessProtocol):
 
 
 class Config(object):
-    """Manages KRB5_CONFIG."""
+    """Manages KRB5_CONFIG.
 
-    def __init__(self):
+    Changes are coalesced: save() schedules a single write for the end of
+    the current reactor tick. The file is replaced atomically and only when
+    its content changes. Call flush() before anything reads the file.
+    """
+
+    def __init__(self, clock=reactor):
         """Initialize instance with data from KRB5_CONFIG."""
         self.path = self.get_path()
         self.includedirs = set()
         self.disable_rdns = False
+        self._clock = clock
+        self._save_call = None
+        self._content_hash = None
         self.realms, self.admin_servers = self.load()
 
         # For further usage by kerberos python module.
@@ -112,6 +130,7 @@ class Config(object):
 
         self.includedirs.add(includedir)
         self.save()
+        self.flush()
         # test for valid directory
         klist = None
         for path in ('/usr/bin/klist', '/usr/kerberos/bin/klist'):
@@ -230,6 +249,8 @@ class Config(object):
             return realm_kdcs, realm_adminservers
 
         with open(self.path, 'r') as krb5_conf:
+            self._content_hash = hashlib.md5(krb5_conf.read()).digest()
+            krb5_conf.seek(0)
             in_realms_section = False
             in_realm = None
 
@@ -269,7 +290,20 @@ class Config(object):
         return realm_kdcs, realm_adminservers
 
     def save(self):
-        """Save current realm KDCs to KRB5_CONFIG."""
+        """Save current realm KDCs to KRB5_CONFIG at the end of this tick."""
+        if self._save_call is None:
+            self._save_call = self._clock.callLater(0, self.flush)
+
+    def flush(self):
+        """Write pending changes to KRB5_CONFIG now."""
+        if self._save_call is None:
+            return
+        if self._save_call.active():
+            self._save_call.cancel()
+        self._save_call = None
+        self._write()
+
+    def _write(self):
         realms_list = []
         domain_realm_list = []
         includedir_list = []
@@ -308,16 +342,23 @@ class Config(object):
                     includedir=includedir))
 
         disable_rdns = ' rdns = false\n' if self.disable_rdns else ''
+        content = KRB5_CONF_TEMPLATE.format(
+            disable_rdns=disable_rdns,
+            includedir=''.join(includedir_list),
+            realms_text=''.join(realms_list),
+            domain_realm_text=''.join(domain_realm_list))
+        content_hash = hashlib.md5(content).digest()
+        if content_hash == self._content_hash:
+            return
+
+        # imported here, util imports this module
+        from .util import write_file_atomically
         try:
-            with open(self.path, 'w') as krb5_conf:
-                krb5_conf.write(
-                    KRB5_CONF_TEMPLATE.format(
-                        disable_rdns=disable_rdns,
-                        includedir=''.join(includedir_list),
-                        realms_text=''.join(realms_list),
-                        domain_realm_text=''.join(domain_realm_list)))
-        except IOError as e:
-            pass
+            write_file_atomically(self.path, content)
+        except (IOError, OSError) as e:
+            LOG.warn('Unable to write {0}: {1}'.format(self.path, e))
+            return
+        self._content_hash = content_hash
 
 # Singleton. Loads from KRB5_CONFIG on import.
 config = Config()
@@ -354,8 +395,8 @@ class KinitProcessProtocol(ProcessProtocol):
 
 
 @defer.inlineCallbacks
-def kinit(username, password, kdc, includedir=None, disable_rdns=False):
-    """Perform kerberos initialization."""
+def _kinit(username, password, kdc, includedir=None, disable_rdns=False):
+    """Run the kinit command."""
     kinit = None
     for path in ('/usr/bin/kinit', '/usr/kerberos/bin/kinit'):
         if os.path.isfile(path):
@@ -377,6 +418,7 @@ def kinit(username, password, kdc, includedir=None, disable_rdns=False):
     if includedir:
         yield config.add_includedir(includedir)
     config.add_kdc(realm, kdc, disable_rdns)
+    config.flush()
 
     ccname = config.get_ccname(username)
     dirname = os.path.dirname(ccname)
@@ -397,6 +439,207 @@ def kinit(username, password, kdc, includedir=None, disable_rdns=False):
     defer.returnValue(results)
 
 
+class _CCacheReader(object):
+    """Reads the parts of a FILE credential cache (version 3 or 4)."""
+
+    def __init__(self, data):
+        self._data = data
+        self._offset = 0
+
+    def unpack(self, fmt):
+        values = struct.unpack_from(fmt, self._data, self._offset)
+        self._offset += struct.calcsize(fmt)
+        return values
+
+    def skip(self, length):
+        self._offset += length
+        if self._offset > len(self._data):
+            raise struct.error('truncated credential cache')
+
+    def data(self):
+        length, = self.unpack('>I')
+        value = self._data[self._offset:self._offset + length]
+        self.skip(length)
+        return value
+
+    def principal(self):
+        name_type, count = self.unpack('>II')
+        realm = self.data()
+        return realm, [self.data() for i in xrange(count)]
+
+    def at_end(self):
+        return self._offset >= len(self._data)
+
+
+def get_tgt_endtime(path):
+    """
+    Return the end time of the ticket granting ticket for the default
+    principal of the FILE credential cache at path, or None if there is
+    none or the cache can't be read.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return None
+    reader = _CCacheReader(data)
+    try:
+        version, = reader.unpack('>H')
+        if version not in (0x0503, 0x0504):
+            return None
+        if version == 0x0504:
+            reader.skip(reader.unpack('>H')[0])
+        realm, _ = reader.principal()
+        while not reader.at_end():
+            reader.principal()
+            server = reader.principal()
+            # keyblock enctype, repeated in version 3
+            reader.skip(4 if version == 0x0503 else 2)
+            reader.data()
+            authtime, starttime, endtime, renew_till = reader.unpack('>IIII')
+            # is_skey and ticket_flags
+            reader.skip(5)
+            for i in xrange(reader.unpack('>I')[0]):
+                reader.skip(2)
+                reader.data()
+            for i in xrange(reader.unpack('>I')[0]):
+                reader.skip(2)
+                reader.data()
+            reader.data()
+            reader.data()
+            if server == (realm, ['krbtgt', realm]):
+                return endtime
+    except struct.error:
+        LOG.debug('Unable to read credential cache {0}'.format(path))
+    return None
+
+
+def _get_principal(username):
+    try:
+        user, realm = username.split('@')
+    except ValueError:
+        return username
+    return '{0}@{1}'.format(user, realm.upper())
+
+
+class KinitManager(object):
+    """
+    Runs at most one kinit per principal, password and KDC at a time and
+    renews TGTs before they expire.
+
+    Callers asking for a principal while its kinit with the same password
+    and KDC is running wait for that kinit's result instead of starting
+    another. After a successful kinit the
+    TGT end time is read from the credential cache and a renewal is
+    scheduled ahead of it, so collection does not wait on kinit when the
+    ticket runs out. A TGT is only renewed if its principal was used, see
+    mark_used, since the previous kinit.
+    """
+
+    def __init__(self, clock=reactor):
+        self._clock = clock
+        # (principal, password hash, kdc) -> Deferreds waiting for the
+        # running kinit
+        self._pending = {}
+        # principal -> IDelayedCall of the scheduled renewal
+        self._renewals = {}
+        self._used = set()
+
+    def kinit(self, username, password, kdc, includedir=None,
+              disable_rdns=False):
+        principal = _get_principal(username)
+        self._used.add(principal)
+        return self._run(
+            principal, (username, password, kdc, includedir, disable_rdns))
+
+    def mark_used(self, username):
+        self._used.add(_get_principal(username))
+
+    def stop(self):
+        """Cancel all scheduled renewals."""
+        for principal in self._renewals.keys():
+            self._cancel_renewal(principal)
+
+    def _run(self, principal, args):
+        d = defer.Deferred()
+        password = args[1]
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        key = (principal, hashlib.sha256(password).digest(), args[2])
+        waiters = self._pending.get(key)
+        if waiters is not None:
+            waiters.append(d)
+            return d
+        self._pending[key] = [d]
+        self._cancel_renewal(principal)
+        _kinit(*args).addBoth(self._kinit_done, key, args)
+        return d
+
+    def _kinit_done(self, result, key, args):
+        for d in self._pending.pop(key):
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        if result is None:
+            self._schedule_renewal(key[0], args)
+
+    def _schedule_renewal(self, principal, args):
+        # renews with the credentials of the last successful kinit
+        self._cancel_renewal(principal)
+        endtime = get_tgt_endtime(config.get_ccname(args[0]))
+        if endtime is None:
+            return
+        lifetime = endtime - time.time()
+        delay = max(lifetime - max(RENEW_MARGIN, lifetime / 5),
+                    MIN_RENEW_DELAY)
+        self._renewals[principal] = self._clock.callLater(
+            delay, self._renew, principal, args)
+
+    def _cancel_renewal(self, principal):
+        call = self._renewals.pop(principal, None)
+        if call and call.active():
+            call.cancel()
+
+    def _renew(self, principal, args):
+        del self._renewals[principal]
+        if principal not in self._used:
+            LOG.debug('Not renewing unused TGT for {0}'.format(principal))
+            return
+        self._used.discard(principal)
+        LOG.debug('Renewing TGT for {0}'.format(principal))
+
+        def log_result(result):
+            if result:
+                LOG.warn('Unable to renew TGT for {0}: {1}'.format(
+                    principal, result.strip()))
+
+        def log_failure(failure):
+            LOG.warn('Unable to renew TGT for {0}: {1}'.format(
+                principal, failure.getErrorMessage()))
+
+        self._run(principal, args).addCallbacks(log_result, log_failure)
+
+
+# Singleton.
+kinit_manager = KinitManager()
+
+
+def kinit(username, password, kdc, includedir=None, disable_rdns=False):
+    """
+    Perform kerberos initialization. Concurrent calls for the same principal,
+    password and KDC share one kinit process.
+    """
+    return kinit_manager.kinit(
+        username, password, kdc, includedir=includedir,
+        disable_rdns=disable_rdns)
+
+
+def mark_used(username):
+    """Keep renewing the TGT of username."""
+    kinit_manager.mark_used(username)
+
+
 def ccname(username):
     """Return KRB5CCNAME value for username."""
     return config.get_ccname(username)
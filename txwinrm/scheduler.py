@@ -0,0 +1,171 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2017, all rights reserved.
+#
+# This content is made available according to terms specified in the LICENSE
+# file at the top-level directory of this package.
+#
+##############################################################################
+
+"""
+Schedules the conversations (an enumeration, a command) of the clients of
+one host.
+"""
+
+from collections import deque, namedtuple, OrderedDict
+
+from twisted.internet import defer, reactor
+
+# lower runs first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 10
+PRIORITY_LOW = 20
+
+
+class SchedulerStats(namedtuple('SchedulerStats', [
+        'slots',
+        'running',
+        'queued',
+        'queued_by_priority',
+        'max_queued',
+        'started',
+        'mean_wait'])):
+    """
+    queued_by_priority maps priority to the number of queued conversations.
+    mean_wait is the mean seconds the started conversations waited.
+    """
+
+
+class _Job(object):
+
+    __slots__ = ('owner', 'func', 'args', 'kwargs', 'd', 'queued_at',
+                 'reentrant')
+
+    def __init__(self, owner, func, args, kwargs, queued_at,
+                 reentrant=False):
+        self.owner = owner
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.d = None
+        self.queued_at = queued_at
+        self.reentrant = reentrant
+
+
+class RequestScheduler(object):
+    """
+    Runs at most slots conversations at a time, like a DeferredSemaphore
+    whose run method it shares. Queued conversations start by priority.
+    Within a priority the owners, usually clients, take turns so one client
+    with many queued conversations does not hold up the others.
+
+    A conversation started with run on a bound method holds its slot for
+    the method's object: what that object submits meanwhile runs in the
+    held slot instead of waiting for another.  So
+    sem.run(client.enumerate, ...) does not deadlock although enumerate
+    submits its own conversation.
+    """
+
+    def __init__(self, slots=1, clock=reactor):
+        self.slots = slots
+        self._clock = clock
+        self._running = 0
+        # priority -> owner -> deque of _Job
+        self._queues = {}
+        self._queued = 0
+        self._max_queued = 0
+        self._started = 0
+        self._total_wait = 0.0
+        # owner -> number of running reentrant conversations
+        self._holders = {}
+
+    def configure(self, slots=None):
+        if slots is not None:
+            self.slots = slots
+            self._start_queued()
+
+    def run(self, func, *args, **kwargs):
+        """Run func at normal priority when a slot is free."""
+        owner = getattr(func, '__self__', None)
+        return self._submit(_Job(
+            owner, func, args, kwargs, self._clock.seconds(),
+            reentrant=owner is not None), PRIORITY_NORMAL)
+
+    def submit(self, priority, owner, func, *args, **kwargs):
+        """
+        Run func with a slot once the conversations queued before it, or
+        with a lower priority value, have started. Returns a Deferred that
+        fires with its result.
+
+        If owner holds a slot through run, func runs in it right away.
+        """
+        if owner is not None and owner in self._holders:
+            return defer.maybeDeferred(func, *args, **kwargs)
+        return self._submit(
+            _Job(owner, func, args, kwargs, self._clock.seconds()), priority)
+
+    def _submit(self, job, priority):
+        job.d = defer.Deferred(lambda d: self._cancel(priority, job))
+        owners = self._queues.setdefault(priority, OrderedDict())
+        owners.setdefault(job.owner, deque()).append(job)
+        self._queued += 1
+        self._max_queued = max(self._max_queued, self._queued)
+        self._start_queued()
+        return job.d
+
+    def stats(self):
+        queued_by_priority = dict(
+            (priority, sum(len(jobs) for jobs in owners.itervalues()))
+            for priority, owners in self._queues.iteritems())
+        mean_wait = self._total_wait / self._started \
+            if self._started else 0.0
+        return SchedulerStats(
+            self.slots, self._running, self._queued, queued_by_priority,
+            self._max_queued, self._started, mean_wait)
+
+    def _next_job(self):
+        for priority in sorted(self._queues):
+            owners = self._queues[priority]
+            owner, jobs = owners.popitem(last=False)
+            job = jobs.popleft()
+            if jobs:
+                # the owner goes to the back of the line
+                owners[owner] = jobs
+            if not owners:
+                del self._queues[priority]
+            self._queued -= 1
+            return job
+        return None
+
+    def _start_queued(self):
+        while self._running < self.slots and self._queued:
+            job = self._next_job()
+            self._running += 1
+            self._started += 1
+            self._total_wait += self._clock.seconds() - job.queued_at
+            if job.reentrant:
+                self._holders[job.owner] = \
+                    self._holders.get(job.owner, 0) + 1
+            d = defer.maybeDeferred(job.func, *job.args, **job.kwargs)
+            d.addBoth(self._finished, job)
+
+    def _finished(self, result, job):
+        self._running -= 1
+        if job.reentrant:
+            self._holders[job.owner] -= 1
+            if not self._holders[job.owner]:
+                del self._holders[job.owner]
+        self._start_queued()
+        if not job.d.called:
+            job.d.callback(result)
+
+    def _cancel(self, priority, job):
+        owners = self._queues.get(priority)
+        jobs = owners.get(job.owner) if owners else None
+        if jobs and job in jobs:
+            jobs.remove(job)
+            self._queued -= 1
+            if not jobs:
+                del owners[job.owner]
+            if not owners:
+                del self._queues[priority]
@@ -7,17 +7,27 @@
 #
 ##############################################################################
 
+import os
+import json
 import logging
-from collections import namedtuple
-from twisted.internet import defer
+import tempfile
+from collections import namedtuple, OrderedDict
+from twisted.internet import defer, reactor
 from . import constants as c
-from .util import create_etree_request_sender, get_datetime
+from .util import (create_etree_request_sender, get_datetime, ET,
+                   RequestError, write_file_atomically)
 
 log = logging.getLogger('winrm')
 _MAX_PULL_REQUESTS_PER_BATCH = 999999
+# seconds between the Pulls of a channel of an EventCollector
+_MIN_PULL_INTERVAL = 1
+_MAX_PULL_INTERVAL = 60
+# events this many record ids below the newest seen are duplicates
+_DEDUP_WINDOW = 10000
 
 _EVENT_QUERY_FMT = '&lt;QueryList&gt;&lt;Query Path=&quot;{path}&quot;&gt;' \
     '&lt;Select&gt;{select}&lt;/Select&gt;&lt;/Query&gt;&lt;/QueryList&gt;'
+_BOOKMARK_FMT = '<w:Bookmark>{0}</w:Bookmark>'
 
 Event = namedtuple('Event', 'system data rendering_info')
 
@@ -78,6 +88,158 @@ def _safe_int(text, base=10):
     return None if text is None else int(text, base)
 
 
+_EVENT_PREFIX = '{%s}' % c.XML_NS_MSEVENT
+_EVENT_TAG = _EVENT_PREFIX + 'Event'
+_ENUMERATION_CONTEXT_TAG = '{%s}EnumerationContext' % c.XML_NS_ENUMERATION
+_BOOKMARK_TAG = '{%s}Bookmark' % c.XML_NS_WS_MAN
+# localname -> attribute kept from the elements under System
+_SYSTEM_ATTRS = {
+    'Provider': 'Name',
+    'EventID': 'Qualifiers',
+    'TimeCreated': 'SystemTime',
+    'Security': 'UserID',
+}
+
+
+class _EventTarget(object):
+    """
+    ElementTree parser target that builds the events of a Pull response in
+    one pass.  Like _find_events the first element of a name in the System
+    or RenderingInfo of an event is used.  bookmark is the content of the
+    response's bookmark as XML.
+    """
+
+    def __init__(self):
+        self.enumeration_context = None
+        self.events = []
+        self.bookmark = None
+        # builds the bookmark element while in it
+        self._bookmark_builder = None
+        self._text = []
+        self._in_context = False
+        # depth within the current event, 0 outside of events
+        self._depth = 0
+        self._section = None
+        # (section, localname) or (section, localname, attribute) -> value
+        self._fields = None
+        self._data = None
+        self._keywords = None
+
+    def start(self, tag, attrib):
+        self._text = []
+        if self._bookmark_builder is not None:
+            self._bookmark_builder.start(tag, attrib)
+            return
+        if not self._depth:
+            if tag == _EVENT_TAG:
+                self._depth = 1
+                self._fields = {}
+                self._data = None
+                self._keywords = []
+            elif tag == _ENUMERATION_CONTEXT_TAG:
+                self._in_context = True
+            elif tag == _BOOKMARK_TAG:
+                self._bookmark_builder = ET.TreeBuilder()
+                self._bookmark_builder.start(tag, attrib)
+            return
+        self._depth += 1
+        name = tag[len(_EVENT_PREFIX):] \
+            if tag.startswith(_EVENT_PREFIX) else tag
+        if self._depth == 2:
+            self._section = name
+            if name == 'RenderingInfo':
+                self._fields.setdefault(
+                    ('RenderingInfo', 'Culture'), attrib.get('Culture'))
+        elif self._section == 'System' and name in _SYSTEM_ATTRS:
+            attr = _SYSTEM_ATTRS[name]
+            self._fields.setdefault(('System', name, attr), attrib.get(attr))
+
+    def data(self, data):
+        self._text.append(data)
+        if self._bookmark_builder is not None:
+            self._bookmark_builder.data(data)
+
+    def end(self, tag):
+        if self._bookmark_builder is not None:
+            elem = self._bookmark_builder.end(tag)
+            if tag == _BOOKMARK_TAG:
+                self._bookmark_builder = None
+                for child in elem:
+                    child.tail = None
+                self.bookmark = ''.join(ET.tostring(child) for child in elem)
+            return
+        if not self._depth:
+            if self._in_context:
+                self.enumeration_context = ''.join(self._text).strip()
+                self._in_context = False
+            return
+        self._depth -= 1
+        if not self._depth:
+            self.events.append(self._build_event())
+            self._fields = None
+            return
+        text = ''.join(self._text)
+        self._text = []
+        name = tag[len(_EVENT_PREFIX):] \
+            if tag.startswith(_EVENT_PREFIX) else tag
+        if self._depth > 1:
+            self._fields.setdefault((self._section, name), text)
+            if name == 'Keyword' and self._section == 'RenderingInfo':
+                self._keywords.append(text or None)
+        if name == 'Data' and self._data is None:
+            self._data = text
+
+    def close(self):
+        return self.events
+
+    def _build_event(self):
+        fields = self._fields
+
+        def text(section, name):
+            value = fields.get((section, name))
+            return None if value is None else value.strip()
+
+        system = System(
+            provider=fields.get(('System', 'Provider', 'Name')),
+            event_id=_safe_int(text('System', 'EventID')),
+            event_id_qualifiers=_safe_int(
+                fields.get(('System', 'EventID', 'Qualifiers'))),
+            level=_safe_int(text('System', 'Level')),
+            task=_safe_int(text('System', 'Task')),
+            keywords=_safe_int(text('System', 'Keywords'), 16),
+            time_created=get_datetime(
+                fields.get(('System', 'TimeCreated', 'SystemTime'))),
+            event_record_id=_safe_int(text('System', 'EventRecordID')),
+            channel=text('System', 'Channel'),
+            computer=text('System', 'Computer'),
+            user_id=fields.get(('System', 'Security', 'UserID')))
+        if ('RenderingInfo', 'Culture') in fields:
+            rendering_info = RenderingInfo(
+                culture=fields[('RenderingInfo', 'Culture')],
+                message=text('RenderingInfo', 'Message'),
+                level=text('RenderingInfo', 'Level'),
+                opcode=text('RenderingInfo', 'Opcode'),
+                keywords=self._keywords)
+        else:
+            rendering_info = None
+        return Event(
+            system=system,
+            data=None if self._data is None else self._data.strip(),
+            rendering_info=rendering_info)
+
+
+def _parse_pull_response(xml_str):
+    """
+    Return the enumeration context, the events and the bookmark of a Pull
+    response.
+    """
+    target = _EventTarget()
+    parser = ET.XMLParser(target=target)
+    parser.feed(xml_str)
+    parser.close()
+    return target.enumeration_context, target.events, target.bookmark
+
+
 def _find_events(pull_resp_elem):
     event_elems = pull_resp_elem.findall('.//{%s}Event' % c.XML_NS_MSEVENT)
     for event_elem in event_elems:
@@ -119,54 +281,102 @@ class EventSubscription(object):
         self._sender = sender
         self._subscription_id = None
         self._enumeration_context = None
+        # the bookmark of the last event pulled, kept after unsubscribing
+        self.bookmark = None
+        # Deferred events of a Pull sent ahead of a failed consumer.  It
+        # fires with None if the Pull failed.
+        self._pulled_ahead = None
 
     @defer.inlineCallbacks
-    def subscribe(self, path='Application', select='*'):
+    def subscribe(self, path='Application', select='*', bookmark=None):
+        """
+        Subscribe to the events of path.  With a bookmark of an earlier
+        subscription the events after it are delivered first.
+        """
         if self._subscription_id is not None:
             raise Exception('You must unsubscribe first.')
         event_query = _EVENT_QUERY_FMT.format(path=path, select=select)
-        resp_elem = yield self._send_subscribe(event_query)
+        resp_elem = yield self._send_subscribe(event_query, bookmark)
         self._subscription_id = _find_subscription_id(resp_elem)
         self._enumeration_context = _find_enumeration_context(resp_elem)
+        self.bookmark = bookmark
 
     @defer.inlineCallbacks
-    def _send_subscribe(self, event_query):
+    def _send_subscribe(self, event_query, bookmark=None):
         resp_elem = yield self._sender.send_request(
-            'subscribe', event_query=event_query)
+            'subscribe', event_query=event_query,
+            bookmark=_BOOKMARK_FMT.format(bookmark) if bookmark else '')
         defer.returnValue(resp_elem)
 
     @defer.inlineCallbacks
     def pull_once(self, process_event_func):
         if self._subscription_id is None:
             raise Exception('You must subscribe first.')
-        resp_elem = yield self._send_pull(self._enumeration_context)
-        self._enumeration_context = _find_enumeration_context(resp_elem)
-        for event in _find_events(resp_elem):
+        events = yield self._next_events()
+        for event in events:
             process_event_func(event)
 
     @defer.inlineCallbacks
     def pull(self, process_event_func):
+        def process_events(events):
+            for event in events:
+                process_event_func(event)
+
+        yield self.pull_batches(process_events)
+
+    @defer.inlineCallbacks
+    def pull_batches(self, process_events_func):
+        """
+        Pull until a response has no events.  The events of each response
+        are handed to process_events_func as one list.  The next Pull is
+        sent before process_events_func is called, so the round trip
+        overlaps with processing.  If process_events_func returns a
+        Deferred, no more events are handed over and no further Pull is
+        sent until it fires.  If process_events_func fails, the events of
+        the Pull sent ahead are handed over by the next pull.
+
+        Returns the number of events.
+        """
         if self._subscription_id is None:
             raise Exception('You must subscribe first.')
-        request_count = 0
-        while request_count < _MAX_PULL_REQUESTS_PER_BATCH:
-            request_count += 1
-            resp_elem = yield self._send_pull(self._enumeration_context)
-            self._enumeration_context = _find_enumeration_context(resp_elem)
-            found_events = 0
-            for event in _find_events(resp_elem):
-                found_events += 1
-                process_event_func(event)
-            if not found_events:
-                break
-        else:
-            raise Exception('Reached max pull requests per batch.')
+        event_count = 0
+        events_d = self._next_events()
+        try:
+            for i in xrange(_MAX_PULL_REQUESTS_PER_BATCH):
+                events = yield events_d
+                events_d = None
+                if not events:
+                    break
+                event_count += len(events)
+                events_d = self._pull()
+                yield process_events_func(events)
+            else:
+                raise Exception('Reached max pull requests per batch.')
+        finally:
+            if events_d is not None:
+                # a Pull sent ahead of an error, its response has moved the
+                # enumeration context past its events
+                events_d.addErrback(lambda failure: None)
+                self._pulled_ahead = events_d
+        defer.returnValue(event_count)
+
+    def _next_events(self):
+        events_d, self._pulled_ahead = self._pulled_ahead, None
+        if events_d is None:
+            return self._pull()
+        events_d.addCallback(
+            lambda events: self._pull() if events is None else events)
+        return events_d
 
     @defer.inlineCallbacks
-    def _send_pull(self, enumeration_context):
-        resp_elem = yield self._sender.send_request(
-            'event_pull', enumeration_context=enumeration_context)
-        defer.returnValue(resp_elem)
+    def _pull(self):
+        xml_str = yield self._sender.send_request_text(
+            'event_pull', enumeration_context=self._enumeration_context)
+        self._enumeration_context, events, bookmark = \
+            _parse_pull_response(xml_str)
+        if bookmark:
+            self.bookmark = bookmark
+        defer.returnValue(events)
 
     @defer.inlineCallbacks
     def unsubscribe(self):
@@ -175,6 +385,7 @@ class EventSubscription(object):
         yield self._send_unsubscribe(self._subscription_id)
         self._subscription_id = None
         self._enumeration_context = None
+        self._pulled_ahead = None
 
     @defer.inlineCallbacks
     def _send_unsubscribe(self, subscription_id):
@@ -186,3 +397,256 @@ class EventSubscription(object):
 def create_event_subscription(conn_info):
     sender = create_etree_request_sender(conn_info)
     return EventSubscription(sender)
+
+
+class BookmarkStore(object):
+    """
+    Saves the bookmark and the newest event record id of each host, channel
+    and select query to a JSON file, so subscriptions resume where they
+    left off after a restart.  Changes are written at the end of the reactor tick.
+    """
+
+    def __init__(self, path=None, clock=reactor):
+        self.path = path or self.get_path()
+        self._clock = clock
+        self._save_call = None
+        # hostname -> channel -> select -> [bookmark, record id]
+        self._bookmarks = self._load()
+
+    def get_path(self):
+        """Return the path to the bookmark file.
+
+        Order of preference:
+            1. $ZENHOME/var/txwinrm_bookmarks.json
+            2. $HOME/.txwinrm/bookmarks.json
+            3. txwinrm_bookmarks.json in the temporary directory
+        """
+        if 'ZENHOME' in os.environ:
+            return os.path.join(
+                os.environ['ZENHOME'], 'var', 'txwinrm_bookmarks.json')
+
+        if 'HOME' in os.environ:
+            return os.path.join(
+                os.environ['HOME'], '.txwinrm', 'bookmarks.json')
+
+        return os.path.join(tempfile.gettempdir(), 'txwinrm_bookmarks.json')
+
+    def get(self, hostname, channel, select='*'):
+        """Return the bookmark and record id, or (None, None)."""
+        bookmark, record_id = self._bookmarks.get(hostname, {}).get(
+            channel, {}).get(select, (None, None))
+        return bookmark, record_id
+
+    def set(self, hostname, channel, select, bookmark, record_id):
+        self._bookmarks.setdefault(hostname, {}).setdefault(
+            channel, {})[select] = [bookmark, record_id]
+        self.save()
+
+    def save(self):
+        """Save the bookmarks at the end of this tick."""
+        if self._save_call is None:
+            self._save_call = self._clock.callLater(0, self.flush)
+
+    def flush(self):
+        """Write pending changes now."""
+        if self._save_call is None:
+            return
+        if self._save_call.active():
+            self._save_call.cancel()
+        self._save_call = None
+        self._write()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            if os.path.exists(self.path):
+                log.warn('Unable to read {0}: {1}'.format(self.path, e))
+            return {}
+
+    def _write(self):
+        dirname = os.path.dirname(self.path)
+        try:
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            write_file_atomically(
+                self.path, json.dumps(self._bookmarks), mode=0o600)
+        except (IOError, OSError) as e:
+            log.warn('Unable to write {0}: {1}'.format(self.path, e))
+
+
+class _Channel(object):
+
+    __slots__ = ('path', 'select', 'subscription', 'interval', 'due',
+                 'record_id')
+
+    def __init__(self, path, select, subscription, interval, due,
+                 record_id=None):
+        self.path = path
+        self.select = select
+        self.subscription = subscription
+        self.interval = interval
+        self.due = due
+        # the newest event record id seen
+        self.record_id = record_id
+
+
+class EventCollector(object):
+    """
+    Pulls the events of all subscriptions of one host through one
+    authenticated sender.  A single loop pulls the channel that is due
+    next, so the host has at most one Pull in flight.  A channel that
+    returned events is pulled again sooner, down to min_interval seconds,
+    and an empty channel less often, up to max_interval seconds.
+
+    With a bookmark_store each channel resumes from the bookmark of its
+    last pulled event.  Events up to dedup_window record ids below the
+    newest one seen on a channel are dropped as duplicates.  Events further
+    below are passed on because the channel's log has been cleared.
+    """
+
+    def __init__(self, conn_info, min_interval=_MIN_PULL_INTERVAL,
+                 max_interval=_MAX_PULL_INTERVAL, clock=reactor,
+                 sender=None, bookmark_store=None,
+                 dedup_window=_DEDUP_WINDOW):
+        self._hostname = conn_info.hostname
+        self._sender = sender or create_etree_request_sender(conn_info)
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._clock = clock
+        self._bookmark_store = bookmark_store
+        self._dedup_window = dedup_window
+        # (path, select) -> _Channel
+        self._channels = OrderedDict()
+        self._on_events = None
+        self._call = None
+        self._pull_d = None
+
+    @defer.inlineCallbacks
+    def subscribe(self, path='Application', select='*'):
+        if (path, select) in self._channels:
+            return
+        bookmark = record_id = None
+        if self._bookmark_store is not None:
+            bookmark, record_id = self._bookmark_store.get(
+                self._hostname, path, select)
+        subscription = EventSubscription(self._sender)
+        try:
+            yield subscription.subscribe(path, select, bookmark)
+        except RequestError as e:
+            if not bookmark:
+                raise
+            # e.g. the log has been cleared since
+            log.warn('{0} {1} unable to resume from bookmark: {2}'.format(
+                self._hostname, path, e))
+            yield subscription.subscribe(path, select)
+        self._channels[path, select] = _Channel(
+            path, select, subscription, self._min_interval,
+            self._clock.seconds(), record_id)
+        self._schedule()
+
+    @defer.inlineCallbacks
+    def unsubscribe(self, path='Application', select='*'):
+        channel = self._channels.pop((path, select), None)
+        if channel is not None:
+            yield channel.subscription.unsubscribe()
+            self._schedule()
+
+    def start(self, on_events):
+        """
+        Start pulling.  on_events(path, select, events) is called after
+        each Pull with the list of events, which may be empty.  If it
+        returns a Deferred no further Pull is sent until it fires.
+        """
+        self._on_events = on_events
+        self._schedule()
+
+    @defer.inlineCallbacks
+    def stop(self):
+        """Stop pulling and unsubscribe from all channels."""
+        self._on_events = None
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        if self._pull_d is not None:
+            yield self._pull_d
+        while self._channels:
+            path, select = next(iter(self._channels))
+            try:
+                yield self.unsubscribe(path, select)
+            except Exception as e:
+                log.error('{0} {1} {2}'.format(self._hostname, path, e))
+        if self._bookmark_store is not None:
+            self._bookmark_store.flush()
+        yield self._sender.close_connections()
+
+    def _schedule(self):
+        if self._on_events is None or self._pull_d is not None:
+            return
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        if not self._channels:
+            return
+        channel = min(self._channels.itervalues(),
+                      key=lambda channel: channel.due)
+        self._call = self._clock.callLater(
+            max(channel.due - self._clock.seconds(), 0), self._pull, channel)
+
+    def _pull(self, channel):
+        self._call = None
+        events = []
+        # set before the callbacks, of which _next clears it, are added as
+        # they run at once if the Pull has completed
+        d = self._pull_d = channel.subscription.pull_once(events.append)
+        d.addCallback(self._pulled, channel, events)
+        d.addErrback(self._pull_failed, channel)
+        d.addBoth(self._next, channel)
+
+    def _pulled(self, result, channel, events):
+        pulled_events = events
+        if events:
+            channel.interval = max(channel.interval / 2.0, self._min_interval)
+            events = self._new_events(channel, events)
+        else:
+            channel.interval = min(channel.interval * 2, self._max_interval)
+        if self._on_events is None:
+            return
+        d = defer.maybeDeferred(
+            self._on_events, channel.path, channel.select, events)
+        if pulled_events and self._bookmark_store is not None:
+            # only once the events have been processed, so a restart
+            # while processing pulls them again
+            d.addCallback(
+                self._save_bookmark, channel,
+                channel.subscription.bookmark, channel.record_id)
+        return d
+
+    def _save_bookmark(self, result, channel, bookmark, record_id):
+        self._bookmark_store.set(
+            self._hostname, channel.path, channel.select, bookmark,
+            record_id)
+
+    def _new_events(self, channel, events):
+        new_events = []
+        for event in events:
+            record_id = event.system.event_record_id
+            if record_id is not None:
+                if channel.record_id is not None and \
+                        channel.record_id - self._dedup_window < \
+                        record_id <= channel.record_id:
+                    continue
+                channel.record_id = record_id
+            new_events.append(event)
+        return new_events
+
+    def _pull_failed(self, failure, channel):
+        log.error('{0} {1} {2}'.format(
+            self._hostname, channel.path, failure.getErrorMessage()))
+        channel.interval = self._max_interval
+
+    def _next(self, result, channel):
+        channel.due = self._clock.seconds() + channel.interval
+        self._pull_d = None
+        self._schedule()
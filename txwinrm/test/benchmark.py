@@ -0,0 +1,213 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2017, all rights reserved.
+#
+# This content is made available according to terms specified in the LICENSE
+# file at the top-level directory of this package.
+#
+##############################################################################
+
+"""
+Microbenchmarks for hot paths that do not need a Windows host. Run with
+
+    python -m txwinrm.test.benchmark <name> [<name> ...]
+
+Every benchmark measures CPU time on a single core.
+"""
+
+import os
+import sys
+import time
+import base64
+from argparse import ArgumentParser
+
+ENVELOPE_SIZE = 512000
+
+
+def _cpu_rate(func, repeat):
+    """Return calls per CPU second of func."""
+    func()
+    start = time.clock()
+    for i in xrange(repeat):
+        func()
+    elapsed = time.clock() - start
+    return repeat / elapsed if elapsed else float('inf')
+
+
+def _report(name, rate, unit):
+    print '  {0:<40} {1:>14,.0f} {2}'.format(name, rate, unit)
+
+
+class _FakeKerberos(object):
+    """
+    Stands in for the kerberos module with an identity cipher.  Like the
+    C module it decodes the base64 input and encodes the output.
+    """
+
+    AUTH_GSS_COMPLETE = 1
+    GSSError = Exception
+
+    def authGSSClientWrapIov(self, context, data, conf_req):
+        context['response'] = base64.b64encode(base64.b64decode(data))
+        return self.AUTH_GSS_COMPLETE, 0
+
+    def authGSSClientUnwrapIov(self, context, data):
+        context['response'] = base64.b64encode(base64.b64decode(data))
+        return self.AUTH_GSS_COMPLETE
+
+    def authGSSClientResponse(self, context):
+        return context['response']
+
+    def authGSSClientClean(self, context):
+        return self.AUTH_GSS_COMPLETE
+
+
+def bench_gss(args):
+    """
+    AuthGSSClient.encrypt_body and decrypt_body on a fake context with an
+    identity cipher, for the base64 path through the kerberos module and
+    the raw path through txwinrm._gssiov. The cipher itself is identical
+    for both paths, so only the work around it is measured.
+    """
+    from .. import util, _gssiov
+    from .test_util import FakeGSSLibrary, fake_gss_client
+    size = args.size
+    body = os.urandom(size)
+    orig_kerberos, orig_lib = util.kerberos, _gssiov._lib
+    util.kerberos = _FakeKerberos()
+    _gssiov._lib = FakeGSSLibrary(cipher=lambda data: data)
+    try:
+        print 'gss ({0} byte envelopes)'.format(size)
+        for name, client in (
+                ('base64', fake_gss_client(iov_context=False, context={})),
+                ('raw', fake_gss_client())):
+            encrypted = client.encrypt_body(body)
+            rate = _cpu_rate(lambda: client.encrypt_body(body), args.repeat)
+            _report(name + ' encrypt', rate * size, 'bytes/s/core')
+            rate = _cpu_rate(lambda: client.decrypt_body(encrypted),
+                             args.repeat)
+            _report(name + ' decrypt', rate * size, 'bytes/s/core')
+            client._context = None
+    finally:
+        util.kerberos, _gssiov._lib = orig_kerberos, orig_lib
+
+
+def bench_templates(args):
+    """
+    Building an Enumerate, a Pull and a Command request the way it was done
+    before the compiled templates, with str.format on the raw template, versus
+    the compiled template.
+    """
+    from ..util import _get_request_template, _render_request_template
+    common = dict(envelope_size=args.size, locale='en-US', code_page=65001,
+                  resource_uri='http://schemas.microsoft.com/wbem/wsman/1/'
+                               'wmi/root/cimv2/*')
+    requests = (
+        ('enumerate', dict(common, max_elements=32000, operation_timeout=60,
+                           wql='select * from Win32_Service')),
+        ('pull', dict(common, max_elements=32000, operation_timeout=60,
+                      enumeration_context='uuid:6C4CF4FD-4CE2-4F4C-8B1D-'
+                                          '0E2B3B4B5A11')),
+        ('command', dict(common, shell_id='3F0B2C5A-D1E9-4D34-9E0A-'
+                                          'B1F6C2C4A8B1', timeout=60,
+                         command_line_elem='<rsp:CommandLine><rsp:Command>'
+                                           'typeperf</rsp:Command>'
+                                           '</rsp:CommandLine>')),
+    )
+    print 'templates'
+    for name, kwargs in requests:
+        _report('{0} format'.format(name),
+                _cpu_rate(
+                    lambda: _get_request_template(name).format(**kwargs),
+                    args.repeat),
+                'requests/s/core')
+        _report('{0} compiled'.format(name),
+                _cpu_rate(lambda: _render_request_template(name, **kwargs),
+                          args.repeat),
+                'requests/s/core')
+
+
+def bench_parse(args):
+    """
+    Parsing of the Enumerate/Pull responses under txwinrm/test/data into
+    items with each available XML parser backend.
+    """
+    from ..enumerate import create_parser_and_factory, get_parser_backends
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    texts = []
+    for dirpath, dirnames, filenames in os.walk(data_dir):
+        for filename in sorted(filenames):
+            if filename.endswith('.xml'):
+                with open(os.path.join(dirpath, filename)) as f:
+                    texts.append(f.read())
+    size = sum(len(text) for text in texts)
+
+    def parse(backend):
+        count = 0
+        for text in texts:
+            parser, factory = create_parser_and_factory(backend=backend)
+            parser.feed(text)
+            count += len(factory.items)
+        return count
+
+    count = parse(None)
+    print 'parse ({0} responses, {1} bytes, {2} items)'.format(
+        len(texts), size, count)
+    for backend in get_parser_backends():
+        rate = _cpu_rate(lambda: parse(backend), args.repeat)
+        _report(backend, rate * count, 'items/s/core')
+        _report(backend, rate * size, 'bytes/s/core')
+
+
+def bench_events(args):
+    """
+    Parsing of a Pull response of the event subscription into events by
+    searching an ElementTree versus the one-pass parser target.
+    """
+    from ..subscribe import (
+        _find_events, _find_enumeration_context, _parse_pull_response)
+    from ..util import ET
+    with open(os.path.join(os.path.dirname(__file__), 'data_subscribe',
+                           'pull_resp_01.xml')) as f:
+        text = f.read()
+    start = text.index('<Event ')
+    end = text.index('</Event>') + len('</Event>')
+    count = max(args.size // (end - start), 1)
+    text = text[:start] + text[start:end] * count + text[end:]
+
+    def find_events():
+        elem = ET.fromstring(text)
+        _find_enumeration_context(elem)
+        return list(_find_events(elem))
+
+    print 'events ({0} events, {1} bytes)'.format(count, len(text))
+    for name, func in (('etree search', find_events),
+                       ('parser target',
+                        lambda: _parse_pull_response(text))):
+        _report(name, _cpu_rate(func, args.repeat) * count, 'events/s/core')
+
+
+BENCHMARKS = dict(
+    events=bench_events,
+    gss=bench_gss,
+    parse=bench_parse,
+    templates=bench_templates,
+)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help=', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--size', type=int, default=ENVELOPE_SIZE)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: {0}'.format(name))
+    for name in args.names or sorted(BENCHMARKS):
+        BENCHMARKS[name](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2017, all rights reserved.
+#
+# This content is made available according to terms specified in the LICENSE
+# file at the top-level directory of this package.
+#
+##############################################################################
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from ..collect import FleetCollectClient, create_enum_info
+from ..util import ConnectionInfo, RequestError, UnauthorizedError
+
+
+def _conn_info(hostname, auth_type='basic', username='username'):
+    return ConnectionInfo(
+        hostname=hostname,
+        auth_type=auth_type,
+        username=username,
+        password='password',
+        scheme='http',
+        port=5985,
+        connectiontype='Keep-Alive',
+        keytab='',
+        dcip='')
+
+
+class FakeClient(object):
+    """Enumerations wait until the test fires them."""
+
+    def __init__(self, conn_info, pending):
+        self.conn_info = conn_info
+        self.pending = pending
+
+    def enumerate(self, wql, resource_uri, **kwargs):
+        d = defer.Deferred()
+        self.pending.append((self.conn_info.hostname, wql, d))
+        return d
+
+
+class TestFleetCollectClient(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.pending = []
+        self.wqls = [create_enum_info('select * from Win32_{0}'.format(n))
+                     for n in ('Process', 'Service', 'Volume')]
+
+    def _create_client(self, **kwargs):
+        return FleetCollectClient(
+            client_factory=lambda conn_info: FakeClient(
+                conn_info, self.pending),
+            clock=self.clock, **kwargs)
+
+    def _finish(self, index=0, result=None):
+        hostname, wql, d = self.pending.pop(index)
+        self.clock.advance(1)
+        if isinstance(result, Exception):
+            d.errback(result)
+        else:
+            d.callback(result or [wql])
+
+    def test_limits(self):
+        client = self._create_client(max_concurrent=3, max_per_host=2)
+        hosts = [_conn_info('host{0}'.format(i)) for i in xrange(3)]
+        results = []
+        d = client.do_collect(
+            dict((host, self.wqls) for host in hosts), results.append)
+        self.assertEqual(len(self.pending), 3)
+        hostnames = [p[0] for p in self.pending]
+        self.assertTrue(max(hostnames.count(h) for h in hostnames) <= 2)
+        while self.pending:
+            self._finish()
+            self.assertTrue(len(self.pending) <= 3)
+        self.assertEqual(len(results), 3)
+        by_host = self.successResultOf(d)
+        for host in hosts:
+            self.assertEqual(by_host[host].items, dict(
+                (w, [w.wql]) for w in self.wqls))
+            self.assertIsNone(by_host[host].error)
+            self.assertTrue(by_host[host].latency > 0)
+
+    def test_realm_limit(self):
+        client = self._create_client(max_per_realm=1)
+        hosts = [
+            _conn_info('host{0}'.format(i), 'kerberos', 'user@example.com')
+            for i in xrange(2)]
+        d = client.do_collect(dict((host, self.wqls[:1]) for host in hosts))
+        self.assertEqual(len(self.pending), 1)
+        self._finish()
+        self.assertEqual(len(self.pending), 1)
+        self._finish()
+        self.assertEqual(len(self.successResultOf(d)), 2)
+        self.assertEqual(client._realm_sems, {})
+
+    def test_errors(self):
+        client = self._create_client()
+        host = _conn_info('host')
+        d = client.do_collect({host: self.wqls})
+        self._finish(result=RequestError('Invalid class'))
+        self._finish(result=UnauthorizedError('Unauthorized'))
+        result = self.successResultOf(d)[host]
+        # the query error is skipped, the auth error stops the host
+        self.assertEqual(result.items, {})
+        self.assertTrue(result.error.check(UnauthorizedError))
+        self.assertEqual(self.pending, [])
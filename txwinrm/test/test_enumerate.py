@@ -13,14 +13,23 @@ This testing requires real Windows machines that are setup manually.
 
 import os
 import re
+import copy
+import pickle
 import unittest
+from array import array
 from itertools import izip
 from xml import sax
 from datetime import datetime
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+from .. import enumerate as enumerate_module
+from ..util import _BODY
 from ..enumerate import create_parser_and_factory, \
     ItemsContentHandler, ChainingContentHandler, TextBufferingContentHandler, \
     ItemsAccumulator, AddPropertyWithoutItemError, Item, TagStackStateError, \
-    TagComparer
+    TagComparer, ParserFeedingProtocol, ColumnAccumulator, merge_columns, \
+    get_parser_backends
 
 MAX_RESPONSE_FILES = 999
 
@@ -216,12 +225,50 @@ class TestWinrm(unittest.TestCase):
         return items
 
 
-def get_enumeration_contexts_and_items(xml_texts):
+class TestParserBackends(unittest.TestCase):
+
+    def test_backends(self):
+        self.assertEqual(get_parser_backends()[:2], ['sax', 'expat'])
+        self.assertRaises(ValueError, create_parser_and_factory,
+                          backend='minidom')
+        # lxml falls back to expat when it is not installed
+        parser, factory = create_parser_and_factory(backend='lxml')
+        parser.feed(XML_FRAGMENT_FMT.format(properties=NIL_XML_FRAGMENT))
+        self.assertEqual(vars(factory.items[0]), {'Access': None})
+
+    def test_same_results(self):
+        data_by_os_version = get_data_by_os_version()
+        for data_by_cim_class in data_by_os_version.itervalues():
+            for data in data_by_cim_class.itervalues():
+                for xml_texts in data['star'], data['all']:
+                    self._assert_same_results(xml_texts)
+
+    def test_same_results_for_types(self):
+        for properties in (DATETIME_CIM_CLASS, NIL_CIM_CLASS, EMPTY_CIM_CLASS,
+                           ARRAY_CIM_CLASS):
+            self._assert_same_results([CIM_CLASS_FMT.format(
+                cim_class='Win32_Blah', properties=properties)])
+
+    def _assert_same_results(self, xml_texts):
+        contexts, items = get_enumeration_contexts_and_items(xml_texts)
+        expected = (contexts, [vars(item) for item in items])
+        for backend in get_parser_backends():
+            for chunk_size in None, 100:
+                contexts, items = get_enumeration_contexts_and_items(
+                    xml_texts, backend, chunk_size)
+                self.assertEqual(
+                    (contexts, [vars(item) for item in items]), expected)
+
+
+def get_enumeration_contexts_and_items(xml_texts, backend=None,
+                                       chunk_size=None):
     enumeration_contexts = []
     items = []
     for xml_text in xml_texts:
-        parser, factory = create_parser_and_factory()
-        parser.feed(xml_text)
+        parser, factory = create_parser_and_factory(backend=backend)
+        chunk_size = chunk_size or len(xml_text)
+        for i in xrange(0, len(xml_text), chunk_size):
+            parser.feed(xml_text[i:i + chunk_size])
         enumeration_contexts.append(factory.enumeration_context)
         items.extend(factory.items)
     return enumeration_contexts, items
@@ -366,11 +413,11 @@ TOO_DEEP = """
 """
 
 
-def parse_xml_str(xml_str):
+def parse_xml_str(xml_str, accumulator=None):
     parser = sax.make_parser()
     parser.setFeature(sax.handler.feature_namespaces, True)
     text_buffer = TextBufferingContentHandler()
-    items_handler = ItemsContentHandler(text_buffer)
+    items_handler = ItemsContentHandler(text_buffer, accumulator)
     content_handler = ChainingContentHandler([text_buffer, items_handler])
     parser.setContentHandler(content_handler)
     parser.feed(xml_str)
@@ -402,6 +449,25 @@ class TestDataType(unittest.TestCase):
                  datetime(2013, 4, 9, 15, 42, 20, 412400))]
         self._do_test_of_prop_parsing(data)
 
+    def test_lazy_datetime(self):
+        xml_str = XML_FRAGMENT_FMT.format(properties=DATETIME_XML_FRAGMENT)
+        items = parse_xml_str(xml_str, ItemsAccumulator(lazy_datetimes=True))
+        self.assertEqual(items[0]._values[0].__class__.__name__,
+                         '_LazyDatetime')
+        expected = datetime(2013, 4, 9, 15, 42, 20, 412400)
+        self.assertEqual(items[0].CreationDate, expected)
+        self.assertEqual(vars(items[0]), {'CreationDate': expected})
+
+        xml_str = CIM_CLASS_FMT.format(
+            cim_class='Win32_Blah', properties=DATETIME_CIM_CLASS * 2)
+        items = parse_xml_str(xml_str, ItemsAccumulator(lazy_datetimes=True))
+        self.assertEqual(items[0].InstallDate,
+                         [datetime(2013, 3, 9, 3, 6, 25)] * 2)
+
+        xml_str = xml_str.replace('2013-03-09', 'not-a-date')
+        items = parse_xml_str(xml_str, ItemsAccumulator(lazy_datetimes=True))
+        self.assertRaises(ValueError, getattr, items[0], 'InstallDate')
+
     def test_nil(self):
         nil_1 = CIM_CLASS_FMT.format(
             cim_class="Win32_PerfRawData_Tcpip_NetworkInterface",
@@ -450,6 +516,100 @@ class TestDataType(unittest.TestCase):
         self.assertRaises(TagStackStateError, parser.feed, xml2)
 
 
+class TestTagComparer(unittest.TestCase):
+
+    def test_matches(self):
+        tag = TagComparer('URI', 'Items')
+        self.assertEqual(tag, ('URI', 'Items'))
+        self.assertEqual((tag.uri, tag.localname), ('URI', 'Items'))
+        self.assertTrue(tag.matches('uri', 'ITEMS'))
+        self.assertFalse(tag.matches(None, 'Items'))
+        self.assertTrue(
+            TagComparer(None, 'Datetime').matches(None, 'datetime'))
+        self.assertEqual(repr(tag), "('URI', 'Items')")
+
+    def test_text(self):
+        text_buffer = TextBufferingContentHandler()
+        for chunks, expected in (([], ''), ([u'ab', u'c'], 'abc'),
+                                 ([u'a\u2013b'], u'a\u2013b')):
+            text_buffer.startElementNS((None, 'Name'), None, {})
+            for chunk in chunks:
+                text_buffer.characters(chunk)
+            text_buffer.endElementNS((None, 'Name'), None)
+            self.assertEqual(text_buffer.text, expected)
+            self.assertEqual(type(text_buffer.text), type(expected))
+
+
+class FakeKerberosSender(object):
+    """Encryption is a simple reversal of the payload."""
+
+    def is_kerberos(self):
+        return True
+
+    def decrypt_payload(self, payload):
+        return payload[::-1]
+
+
+class TestParserFeedingProtocol(unittest.TestCase):
+
+    def test_kerberos_chunks(self):
+        data = get_data_by_os_version()['server_2008']['Win32_Service']
+        xml_text = data['star'][0]
+        body = _BODY.replace('\n', '\r\n').format(
+            original_length=len(xml_text), emsg=xml_text[::-1])
+        parser, factory = create_parser_and_factory()
+        proto = ParserFeedingProtocol(parser, FakeKerberosSender())
+        for i in xrange(0, len(body), 4096):
+            proto.dataReceived(body[i:i + 4096])
+        proto.connectionLost(Failure(ResponseDone()))
+        results = []
+        proto.d.addCallback(results.append)
+        self.assertEqual(results, [None])
+        expected_context, expected_items = \
+            get_enumeration_contexts_and_items([xml_text])
+        self.assertEqual(factory.enumeration_context, expected_context[0])
+        self.assertEqual([vars(i) for i in factory.items],
+                         [vars(i) for i in expected_items])
+
+    def test_kerberos_deferred_parsing(self):
+        data = get_data_by_os_version()['server_2008']['Win32_Service']
+        xml_text = data['star'][0]
+        body = _BODY.replace('\n', '\r\n').format(
+            original_length=len(xml_text), emsg=xml_text[::-1])
+        contexts = []
+        parser, factory = create_parser_and_factory(
+            lambda context: contexts.append((context, len(factory.items))))
+        proto = ParserFeedingProtocol(
+            parser, FakeKerberosSender(), defer_parsing=True)
+        clock = Clock()
+        reactor, enumerate_module.reactor = enumerate_module.reactor, clock
+        try:
+            proto.dataReceived(body)
+            proto.connectionLost(Failure(ResponseDone()))
+        finally:
+            enumerate_module.reactor = reactor
+        results = []
+        proto.d.addCallback(results.append)
+        self.assertEqual(contexts, [])
+        self.assertEqual(results, [])
+        clock.advance(0)
+        self.assertEqual(results, [None])
+        expected_context, expected_items = \
+            get_enumeration_contexts_and_items([xml_text])
+        # the context is reported before any item has been parsed
+        self.assertEqual(contexts, [(expected_context[0], 0)])
+        self.assertEqual(len(factory.items), len(expected_items))
+
+    def test_kerberos_truncated(self):
+        parser, factory = create_parser_and_factory()
+        proto = ParserFeedingProtocol(parser, FakeKerberosSender())
+        proto.dataReceived(_BODY.replace('\n', '\r\n')[:150])
+        proto.connectionLost(Failure(ResponseDone()))
+        errors = []
+        proto.d.addErrback(errors.append)
+        self.assertEqual(len(errors), 1)
+
+
 class TestItemsAccumulator(unittest.TestCase):
 
     def test_add_property_without_item(self):
@@ -463,6 +623,110 @@ class TestItem(unittest.TestCase):
         item = Item()
         self.assertEqual(repr(item), '\n{   }')
 
+    def _create_items(self):
+        accumulator = ItemsAccumulator()
+        for name in ('a', 'b'):
+            accumulator.new_item()
+            accumulator.add_property('Name', name)
+            accumulator.add_property('Array', '1')
+            accumulator.add_property('Array', '2')
+            accumulator.add_property('Nil', None)
+        return accumulator.items
+
+    def test_properties(self):
+        item_a, item_b = self._create_items()
+        self.assertEqual(item_a.Name, 'a')
+        self.assertEqual(item_b.Array, ['1', '2'])
+        self.assertIsNone(item_b.Nil)
+        self.assertRaises(AttributeError, getattr, item_a, 'Missing')
+        self.assertEqual(getattr(item_a, 'Missing', 'default'), 'default')
+        self.assertEqual(vars(item_b),
+                         {'Name': 'b', 'Array': ['1', '2'], 'Nil': None})
+        # items of the same shape share their schema
+        self.assertIs(item_a._schema, item_b._schema)
+
+    def test_set_and_delete(self):
+        item_a, item_b = self._create_items()
+        item_a.Name = 'c'
+        item_a.Added = 1
+        self.assertEqual(item_a.Name, 'c')
+        self.assertEqual(item_a.Added, 1)
+        self.assertEqual(item_b.Name, 'b')
+        self.assertFalse(hasattr(item_b, 'Added'))
+        del item_a.Array
+        del item_a.Added
+        self.assertEqual(vars(item_a), {'Name': 'c', 'Nil': None})
+        self.assertRaises(AttributeError, delattr, item_a, 'Added')
+
+    def test_pickle(self):
+        item = self._create_items()[0]
+        item.Added = 1
+        for protocol in (0, 2):
+            copied = pickle.loads(pickle.dumps(item, protocol))
+            self.assertEqual(vars(copied), vars(item))
+        self.assertEqual(vars(copy.deepcopy(item)), vars(item))
+
+
+class TestColumns(unittest.TestCase):
+
+    def _create_page(self, rows):
+        accumulator = ColumnAccumulator()
+        for row in rows:
+            accumulator.new_item()
+            for name, value in row:
+                accumulator.add_property(name, value)
+        return accumulator.items
+
+    def test_add_property_without_item(self):
+        self.assertRaises(AddPropertyWithoutItemError,
+                          ColumnAccumulator().add_property, "foo", "bar")
+
+    def test_merge(self):
+        page1 = self._create_page([
+            [('Name', 'a'), ('Count', '1'), ('Rate', '0.5'), ('Id', '007')],
+            [('Name', 'b'), ('Count', None), ('Rate', '2'), ('Id', '12')]])
+        page2 = self._create_page([
+            [('Name', 'c'), ('Rate', '1.5'), ('Roles', 'x'), ('Roles', 'y'),
+             ('Id', '1e5')]])
+        self.assertEqual(len(page1), 2)
+        columns = merge_columns([page1, page2], {
+            'Count': 'uint32', 'Rate': 'real64', 'Roles': 'uint8',
+            'Name': 'string'})
+        self.assertEqual(len(columns), 3)
+        self.assertEqual(list(columns),
+                         ['Name', 'Count', 'Rate', 'Id', 'Roles'])
+        self.assertEqual(columns['Name'], ['a', 'b', 'c'])
+        # properties of unknown type keep their strings
+        self.assertEqual(columns['Id'], ['007', '12', '1e5'])
+        self.assertIsInstance(columns['Count'], array)
+        self.assertEqual(columns['Count'].tolist(), [1, 0, 0])
+        self.assertEqual(columns.nils['Count'].tolist(), [0, 1, 1])
+        self.assertEqual(columns['Rate'].typecode, 'd')
+        self.assertEqual(columns['Rate'].tolist(), [0.5, 2.0, 1.5])
+        self.assertNotIn('Rate', columns.nils)
+        self.assertEqual(columns['Roles'], [None, None, ['x', 'y']])
+        self.assertEqual(columns.nils['Roles'].tolist(), [1, 1, 0])
+
+    def test_overflow(self):
+        page = self._create_page([[('Big', str(2 ** 70))], [('Big', '1')]])
+        self.assertEqual(merge_columns([page], {'Big': 'uint64'})['Big'],
+                         [str(2 ** 70), '1'])
+
+    def test_not_numeric(self):
+        page = self._create_page([[('Count', 'nan')], [('Count', '1')]])
+        self.assertEqual(merge_columns([page], {'Count': 'uint32'})['Count'],
+                         ['nan', '1'])
+
+    def test_parse(self):
+        xml_str = CIM_CLASS_FMT.format(
+            cim_class="Win32_PerfRawData_Tcpip_NetworkInterface",
+            properties=NIL_CIM_CLASS)
+        items = parse_xml_str(xml_str)
+        columns = merge_columns([parse_xml_str(xml_str, ColumnAccumulator())])
+        self.assertEqual(len(columns), 1)
+        self.assertEqual(list(columns), vars(items[0]).keys())
+        self.assertIsNone(columns['Caption'][0])
+
 if __name__ == '__main__':
     unittest.main()
     # suite = unittest.TestLoader().loadTestsFromTestCase(TestDataType)
@@ -0,0 +1,197 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2017, all rights reserved.
+#
+# This content is made available according to terms specified in the LICENSE
+# file at the top-level directory of this package.
+#
+##############################################################################
+
+import os
+import struct
+import tempfile
+import time
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from .. import krb5
+
+
+def _data(value):
+    return struct.pack('>I', len(value)) + value
+
+
+def _principal(realm, *components):
+    return struct.pack('>II', 1, len(components)) + _data(realm) + \
+        ''.join(_data(c) for c in components)
+
+
+def _credential(client, server, endtime):
+    return ''.join((
+        client,
+        server,
+        struct.pack('>H', 18), _data('k' * 32),
+        struct.pack('>IIII', endtime - 36000, endtime - 36000, endtime,
+                    endtime + 86400),
+        struct.pack('>BI', 0, 0),
+        struct.pack('>I', 0),
+        struct.pack('>I', 0),
+        _data('ticket'),
+        _data('')))
+
+
+def _ccache(realm, endtime):
+    client = _principal(realm, 'user')
+    header = struct.pack('>HH', 1, 8) + 'x' * 8
+    return ''.join((
+        struct.pack('>HH', 0x0504, len(header)), header,
+        client,
+        _credential(client, _principal(realm, 'HTTP', 'host'), endtime + 5),
+        _credential(client, _principal(realm, 'krbtgt', realm), endtime)))
+
+
+class TestCCache(unittest.TestCase):
+
+    def _write(self, data):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, data)
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_tgt_endtime(self):
+        path = self._write(_ccache('EXAMPLE.COM', 1500000000))
+        self.assertEqual(krb5.get_tgt_endtime(path), 1500000000)
+
+    def test_no_tgt(self):
+        data = _ccache('EXAMPLE.COM', 1500000000)
+        self.assertIsNone(krb5.get_tgt_endtime(self._write(data[:-40])))
+        self.assertIsNone(krb5.get_tgt_endtime(self._write('\x05\x02')))
+        self.assertIsNone(krb5.get_tgt_endtime('/nonexistent/krb5cc'))
+
+
+class TestKinitManager(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.endtime = None
+        self.patch(krb5, '_kinit', self._kinit)
+        self.patch(krb5, 'get_tgt_endtime', lambda path: self.endtime)
+        self.clock = Clock()
+        self.manager = krb5.KinitManager(clock=self.clock)
+
+    def _kinit(self, *args):
+        d = defer.Deferred()
+        self.calls.append(d)
+        return d
+
+    def test_single_flight(self):
+        d1 = self.manager.kinit('user@example.com', 'password', 'dc')
+        d2 = self.manager.kinit('user@EXAMPLE.COM', 'password', 'dc')
+        d3 = self.manager.kinit('other@EXAMPLE.COM', 'password', 'dc')
+        self.assertEqual(len(self.calls), 2)
+        self.calls[0].callback('error')
+        self.assertEqual(self.successResultOf(d1), 'error')
+        self.assertEqual(self.successResultOf(d2), 'error')
+        self.assertNoResult(d3)
+        self.manager.kinit('user@EXAMPLE.COM', 'password', 'dc')
+        self.assertEqual(len(self.calls), 3)
+
+    def test_single_flight_credentials(self):
+        d1 = self.manager.kinit('user@EXAMPLE.COM', 'password', 'dc')
+        d2 = self.manager.kinit('user@EXAMPLE.COM', 'changed', 'dc')
+        d3 = self.manager.kinit('user@EXAMPLE.COM', 'password', 'dc2')
+        self.assertEqual(len(self.calls), 3)
+        self.calls[0].callback('error')
+        self.assertEqual(self.successResultOf(d1), 'error')
+        self.assertNoResult(d2)
+        self.assertNoResult(d3)
+
+    def test_failure(self):
+        d1 = self.manager.kinit('user@EXAMPLE.COM', 'password', 'dc')
+        d2 = self.manager.kinit('user@EXAMPLE.COM', 'password', 'dc')
+        self.calls[0].errback(Exception('krb5-workstation is not installed'))
+        self.failureResultOf(d1, Exception)
+        self.failureResultOf(d2, Exception)
+
+    def test_renewal(self):
+        self.endtime = time.time() + 36000
+        self.manager.kinit('user@EXAMPLE.COM', 'password', 'dc')
+        self.calls[0].callback(None)
+        self.clock.advance(36000 * 0.8 - 10)
+        self.assertEqual(len(self.calls), 1)
+        self.clock.advance(20)
+        self.assertEqual(len(self.calls), 2)
+
+        # not used since the renewal
+        self.calls[1].callback(None)
+        self.clock.advance(36000)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_renewal_when_used(self):
+        self.endtime = time.time() + 36000
+        self.manager.kinit('user@EXAMPLE.COM', 'password', 'dc')
+        self.calls[0].callback(None)
+        self.clock.advance(30000)
+        self.manager.mark_used('user@example.com')
+        self.calls[1].callback(None)
+        self.clock.advance(30000)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_stop(self):
+        self.endtime = time.time() + 36000
+        self.manager.kinit('user@EXAMPLE.COM', 'password', 'dc')
+        self.calls[0].callback(None)
+        self.manager.stop()
+        self.clock.advance(36000)
+        self.assertEqual(len(self.calls), 1)
+
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.path = os.path.join(self.dirname, 'krb5.conf')
+        self.patch(os, 'environ', dict(os.environ, KRB5_CONFIG=self.path))
+        self.clock = Clock()
+        self.config = krb5.Config(clock=self.clock)
+        self.renames = []
+        rename = os.rename
+
+        def record_rename(src, dst):
+            self.renames.append(dst)
+            rename(src, dst)
+
+        self.patch(os, 'rename', record_rename)
+
+    def tearDown(self):
+        for dirpath, dirnames, filenames in os.walk(self.dirname, False):
+            for name in filenames:
+                os.remove(os.path.join(dirpath, name))
+            os.rmdir(dirpath)
+
+    def test_coalesced(self):
+        self.config.add_kdc('EXAMPLE.COM', '10.0.0.1')
+        self.config.add_kdc('OTHER.COM', '10.0.0.2')
+        self.assertFalse(os.path.exists(self.path))
+        self.clock.advance(0)
+        self.assertEqual(self.renames, [self.path])
+        self.assertEqual(sorted(os.listdir(self.dirname)), ['config', 'krb5.conf'])
+        realms, admin_servers = krb5.Config(clock=self.clock).load()
+        self.assertEqual(realms, {'EXAMPLE.COM': set(['10.0.0.1']),
+                                  'OTHER.COM': set(['10.0.0.2'])})
+
+    def test_unchanged(self):
+        self.config.add_kdc('EXAMPLE.COM', '10.0.0.1')
+        self.config.flush()
+        self.config.add_kdc('EXAMPLE.COM', '10.0.0.1, +10.0.0.2')
+        self.config.add_kdc('EXAMPLE.COM', '10.0.0.1, -10.0.0.2')
+        self.clock.advance(0)
+        self.assertEqual(self.renames, [self.path])
+
+        config = krb5.Config(clock=self.clock)
+        config.save()
+        self.clock.advance(0)
+        self.assertEqual(self.renames, [self.path])
@@ -0,0 +1,131 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2017, all rights reserved.
+#
+# This content is made available according to terms specified in the LICENSE
+# file at the top-level directory of this package.
+#
+##############################################################################
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from ..scheduler import (
+    RequestScheduler,
+    PRIORITY_HIGH,
+    PRIORITY_NORMAL,
+    PRIORITY_LOW,
+)
+
+
+class TestRequestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.scheduler = RequestScheduler(clock=self.clock)
+        self.started = []
+        self.pending = []
+
+    def _conversation(self, name):
+        self.started.append(name)
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+    def _finish(self, result=None):
+        self.clock.advance(1)
+        self.pending.pop(0).callback(result)
+
+    def test_run(self):
+        d = self.scheduler.run(self._conversation, 'a')
+        self.scheduler.run(self._conversation, 'b')
+        self.assertEqual(self.started, ['a'])
+        self._finish('done')
+        self.assertEqual(self.successResultOf(d), 'done')
+        self.assertEqual(self.started, ['a', 'b'])
+
+    def test_priority(self):
+        submit = self.scheduler.submit
+        submit(PRIORITY_NORMAL, None, self._conversation, 'running')
+        submit(PRIORITY_LOW, None, self._conversation, 'low')
+        submit(PRIORITY_NORMAL, None, self._conversation, 'normal')
+        submit(PRIORITY_HIGH, None, self._conversation, 'high')
+        while self.pending:
+            self._finish()
+        self.assertEqual(self.started, ['running', 'high', 'normal', 'low'])
+
+    def test_owners_take_turns(self):
+        self.scheduler.run(self._conversation, 'running')
+        for name in ('a1', 'a2', 'a3'):
+            self.scheduler.submit(
+                PRIORITY_NORMAL, 'a', self._conversation, name)
+        for name in ('b1', 'b2'):
+            self.scheduler.submit(
+                PRIORITY_NORMAL, 'b', self._conversation, name)
+        while self.pending:
+            self._finish()
+        self.assertEqual(
+            self.started, ['running', 'a1', 'b1', 'a2', 'b2', 'a3'])
+
+    def test_slots(self):
+        for name in 'abcd':
+            self.scheduler.run(self._conversation, name)
+        self.scheduler.configure(slots=3)
+        self.assertEqual(self.started, ['a', 'b', 'c'])
+        self._finish()
+        self.assertEqual(self.started, ['a', 'b', 'c', 'd'])
+
+    def test_failure(self):
+        def fail():
+            raise RuntimeError('boom')
+        d = self.scheduler.run(fail)
+        self.failureResultOf(d, RuntimeError)
+        self.scheduler.run(self._conversation, 'a')
+        self.assertEqual(self.started, ['a'])
+
+    def test_cancel(self):
+        self.scheduler.run(self._conversation, 'a')
+        d = self.scheduler.run(self._conversation, 'b')
+        self.scheduler.run(self._conversation, 'c')
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.scheduler.stats().queued, 1)
+        self._finish()
+        self.assertEqual(self.started, ['a', 'c'])
+
+    def test_reentrant(self):
+        scheduler = self.scheduler
+
+        class Client(object):
+
+            def outer(self):
+                return scheduler.submit(
+                    PRIORITY_NORMAL, self, lambda: 'inner')
+
+        client = Client()
+        d = scheduler.run(client.outer)
+        self.assertEqual(self.successResultOf(d), 'inner')
+        # other owners and later submits of the client still wait
+        scheduler.run(self._conversation, 'a')
+        d = scheduler.submit(PRIORITY_NORMAL, client, lambda: 'queued')
+        self.assertNoResult(d)
+        self._finish()
+        self.assertEqual(self.successResultOf(d), 'queued')
+
+    def test_stats(self):
+        self.scheduler.run(self._conversation, 'a')
+        self.scheduler.submit(PRIORITY_LOW, None, self._conversation, 'b')
+        self.scheduler.submit(PRIORITY_LOW, None, self._conversation, 'c')
+        stats = self.scheduler.stats()
+        self.assertEqual(stats.running, 1)
+        self.assertEqual(stats.queued, 2)
+        self.assertEqual(stats.queued_by_priority, {PRIORITY_LOW: 2})
+        while self.pending:
+            self._finish()
+        stats = self.scheduler.stats()
+        self.assertEqual((stats.running, stats.queued), (0, 0))
+        self.assertEqual(stats.max_queued, 2)
+        self.assertEqual(stats.started, 3)
+        # b waited 1 second and c 2 seconds
+        self.assertEqual(stats.mean_wait, 1.0)
@@ -0,0 +1,116 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2017, all rights reserved.
+#
+# This content is made available according to terms specified in the LICENSE
+# file at the top-level directory of this package.
+#
+##############################################################################
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from ..SessionManager import Session, SessionManager, _IdleReaper
+
+
+class FakeSession(Session):
+
+    logins = 0
+    logouts = 0
+
+    def _deferred_login(self, client):
+        FakeSession.logins += 1
+        return defer.succeed('token')
+
+    def _deferred_logout(self, client):
+        FakeSession.logouts += 1
+        return defer.succeed(None)
+
+
+class FakeClient(object):
+
+    def __init__(self, key):
+        self.key = key
+
+
+class TestIdleReaper(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.reaped = []
+        self.reaper = _IdleReaper(
+            self.reaped.append, self.clock, tick=1.0, buckets=8)
+
+    def test_schedule(self):
+        self.reaper.schedule('a', 3)
+        self.reaper.schedule('b', 1.5)
+        self.reaper.schedule('a', 1)
+        self.assertEqual(len(self.reaper), 2)
+        self.clock.advance(2)
+        self.assertEqual(self.reaped, ['b'])
+        self.clock.advance(1)
+        self.assertEqual(self.reaped, ['b', 'a'])
+        self.assertEqual(len(self.reaper), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_beyond_wheel(self):
+        self.reaper.schedule('a', 100)
+        self.clock.advance(8)
+        # reap is expected to check the due time and schedule again
+        self.assertEqual(self.reaped, ['a'])
+
+    def test_cancel(self):
+        self.reaper.schedule('a', 2)
+        self.reaper.cancel('a')
+        self.assertNotIn('a', self.reaper)
+        self.clock.advance(3)
+        self.assertEqual(self.reaped, [])
+
+
+class TestSessionManager(unittest.TestCase):
+
+    def setUp(self):
+        FakeSession.logins = FakeSession.logouts = 0
+        self.clock = Clock()
+        self.manager = SessionManager(idle_timeout=10, clock=self.clock)
+
+    def _connect(self, client):
+        self.successResultOf(
+            self.manager.init_connection(client, FakeSession))
+
+    def test_idle_close(self):
+        client = FakeClient('host')
+        self._connect(client)
+        self.manager.release_connection(client)
+        self.clock.advance(9)
+        self.assertIsNotNone(self.manager.get_connection('host'))
+        self.clock.advance(1)
+        self.assertIsNone(self.manager.get_connection('host'))
+        self.assertEqual(FakeSession.logouts, 1)
+
+    def test_reuse(self):
+        first, second = FakeClient('host'), FakeClient('host')
+        self._connect(first)
+        self.manager.release_connection(first)
+        self.clock.advance(5)
+        self._connect(second)
+        self.clock.advance(10)
+        # in use by second
+        self.assertIsNotNone(self.manager.get_connection('host'))
+        self.manager.release_connection(second)
+        self.clock.advance(9)
+        self.assertIsNotNone(self.manager.get_connection('host'))
+        self.clock.advance(2)
+        self.assertIsNone(self.manager.get_connection('host'))
+        self.assertEqual((FakeSession.logins, FakeSession.logouts), (1, 1))
+
+    def test_many_sessions(self):
+        clients = [FakeClient('host{0}'.format(i)) for i in xrange(10000)]
+        for client in clients:
+            self._connect(client)
+            self.manager.release_connection(client)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(10)
+        self.assertEqual(self.manager._sessions, {})
+        self.assertEqual(FakeSession.logouts, 10000)
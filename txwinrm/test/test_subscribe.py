@@ -11,31 +11,48 @@ import os
 from datetime import datetime
 from twisted.trial import unittest
 from twisted.internet import defer
+from twisted.internet.task import Clock
 from .tools import create_get_elem_func
 from ..subscribe import _find_subscription_id, _find_enumeration_context, \
-    _find_events, Event, System, RenderingInfo, EventSubscription
+    _find_events, _parse_pull_response, Event, System, RenderingInfo, \
+    EventSubscription, EventCollector, BookmarkStore
+from ..util import ConnectionInfo
 
 DATADIR = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), "data_subscribe")
 get_elem = create_get_elem_func(DATADIR)
 
 
+def get_text(filename):
+    with open(os.path.join(DATADIR, filename)) as f:
+        return f.read()
+
+
 class FakeRequestSender(object):
 
     hostname = 'fake_host'
 
+    def __init__(self):
+        self.pulls = 0
+        self.bookmarks = []
+
     def send_request(self, request_template_name, **kwargs):
         elem = None
         if request_template_name == 'subscribe':
+            self.bookmarks.append(kwargs['bookmark'])
             elem = get_elem('subscribe_resp.xml')
-        elif request_template_name == 'event_pull':
-            if kwargs['enumeration_context'] == \
-                    'uuid:05071354-C4AD-4745-AA80-1127029F660E':
-                elem = get_elem('pull_resp_02.xml')
-            else:
-                elem = get_elem('pull_resp_01.xml')
         return defer.succeed(elem)
 
+    def send_request_text(self, request_template_name, **kwargs):
+        self.pulls += 1
+        if kwargs['enumeration_context'] == \
+                'uuid:05071354-C4AD-4745-AA80-1127029F660E':
+            return defer.succeed(get_text('pull_resp_02.xml'))
+        return defer.succeed(get_text('pull_resp_01.xml'))
+
+    def close_connections(self):
+        return defer.succeed(None)
+
 
 class TestXmlParsing(unittest.TestCase):
 
@@ -79,6 +96,18 @@ class TestXmlParsing(unittest.TestCase):
         self.assertEqual(len(actual), len(expected))
         self.assertEqual(actual, expected)
 
+    def test_parse_pull_response(self):
+        for filename in ('pull_resp_01.xml', 'pull_resp_02.xml'):
+            context, events, bookmark = _parse_pull_response(
+                get_text(filename))
+            elem = get_elem(filename)
+            self.assertEqual(context, _find_enumeration_context(elem))
+            self.assertEqual(events, list(_find_events(elem)))
+        self.assertIsNone(bookmark)
+        bookmark = _parse_pull_response(get_text('pull_resp_01.xml'))[2]
+        self.assertTrue(bookmark.startswith('<BookmarkList>'))
+        self.assertIn('RecordId="3847"', bookmark)
+
 
 class TestEventSubscription(unittest.TestCase):
 
@@ -110,6 +139,62 @@ class TestEventSubscription(unittest.TestCase):
         self.assertTrue(events)
         self.assertEqual(1, len(events))
 
+    @defer.inlineCallbacks
+    def test_pull_batches(self):
+        yield self._subscription.subscribe()
+        batches = []
+        processed = defer.Deferred()
+
+        def process_events(events):
+            batches.append(events)
+            return processed
+
+        d = self._subscription.pull_batches(process_events)
+        self.assertEqual(len(batches), 1)
+        # the next Pull is sent ahead, then waits for the consumer
+        self.assertEqual(self._subscription._sender.pulls, 2)
+        self.assertNoResult(d)
+        processed.callback(None)
+        count = yield d
+        self.assertEqual(count, 1)
+        self.assertEqual(self._subscription._sender.pulls, 2)
+
+    @defer.inlineCallbacks
+    def test_pull_batches_consumer_fails(self):
+        yield self._subscription.subscribe()
+        sent = []
+
+        def send_request_text(request_template_name, **kwargs):
+            sent.append(kwargs['enumeration_context'])
+            return defer.succeed(get_text('pull_resp_01.xml'))
+
+        self._subscription._sender.send_request_text = send_request_text
+
+        def fail(events):
+            raise RuntimeError('consumer failed')
+
+        yield self.assertFailure(
+            self._subscription.pull_batches(fail), RuntimeError)
+        self.assertIsNotNone(self._subscription._pulled_ahead)
+        batches = []
+        yield self._subscription.pull_once(batches.append)
+        # the events of the Pull sent ahead are handed over without a new
+        # Pull
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(len(batches), 1)
+        self.assertIsNone(self._subscription._pulled_ahead)
+
+    @defer.inlineCallbacks
+    def test_bookmark(self):
+        yield self._subscription.subscribe()
+        yield self._subscription.pull(lambda event: None)
+        bookmark = self._subscription.bookmark
+        self.assertIn('RecordId="3847"', bookmark)
+        yield self._subscription.unsubscribe()
+        yield self._subscription.subscribe(bookmark=bookmark)
+        self.assertEqual(self._subscription._sender.bookmarks, [
+            '', '<w:Bookmark>{0}</w:Bookmark>'.format(bookmark)])
+
     def test_unsubscribe(self):
         self._subscription.subscribe()
 
@@ -122,5 +207,133 @@ class TestEventSubscription(unittest.TestCase):
         self.assertIsNone(self._subscription._enumeration_context)
 
 
+class TestBookmarkStore(unittest.TestCase):
+
+    def test_save(self):
+        clock = Clock()
+        path = os.path.join(self.mktemp(), 'bookmarks.json')
+        store = BookmarkStore(path, clock)
+        self.assertEqual(store.get('host', 'Application'), (None, None))
+        store.set('host', 'Application', '*', '<BookmarkList/>', 10)
+        store.set('host', 'Application', '*[System[Level=2]]',
+                  '<BookmarkList/>', 5)
+        store.set('host', 'System', '*', '<BookmarkList/>', 20)
+        self.assertFalse(os.path.exists(path))
+        clock.advance(0)
+        store = BookmarkStore(path, clock)
+        self.assertEqual(store.get('host', 'Application'),
+                         ('<BookmarkList/>', 10))
+        self.assertEqual(store.get('host', 'Application',
+                                   '*[System[Level=2]]'),
+                         ('<BookmarkList/>', 5))
+        self.assertEqual(store.get('host', 'System'),
+                         ('<BookmarkList/>', 20))
+        self.assertEqual(store.get('other', 'System'), (None, None))
+
+
+class TestEventCollector(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.sender = FakeRequestSender()
+        self.conn_info = ConnectionInfo(
+            'fake_host', 'basic', 'username', 'password', 'http', 5985,
+            'Keep-Alive', '', '')
+        # the fake sender repeats its event
+        self.collector = EventCollector(
+            self.conn_info, clock=self.clock, sender=self.sender,
+            dedup_window=0)
+        self.collector.subscribe('Application')
+        self.collector.subscribe('System')
+        self.pulls = []
+
+    def _on_events(self, path, select, events):
+        self.pulls.append((path, len(events)))
+
+    def test_adaptive_intervals(self):
+        self.collector.start(self._on_events)
+        self.clock.advance(0)
+        self.assertEqual(self.pulls, [('Application', 1), ('System', 1)])
+        self.clock.advance(1)
+        # both channels are empty now and back off to 2 seconds
+        self.assertEqual(self.pulls[2:], [('Application', 0), ('System', 0)])
+        self.clock.advance(1)
+        self.assertEqual(len(self.pulls), 4)
+        self.clock.advance(1)
+        self.assertEqual(self.pulls[4:], [('Application', 1), ('System', 1)])
+        # one sender for the host
+        self.assertEqual(self.sender.pulls, 6)
+
+    def test_backpressure(self):
+        processing = []
+
+        def on_events(path, select, events):
+            processing.append(defer.Deferred())
+            return processing[-1]
+
+        self.collector.start(on_events)
+        self.clock.advance(10)
+        self.assertEqual(self.sender.pulls, 1)
+        processing[0].callback(None)
+        self.clock.advance(0)
+        self.assertEqual(self.sender.pulls, 2)
+
+    def test_resume(self):
+        store = BookmarkStore(
+            os.path.join(self.mktemp(), 'bookmarks.json'), self.clock)
+        self.successResultOf(self.collector.stop())
+        self.collector = EventCollector(
+            self.conn_info, clock=self.clock, sender=self.sender,
+            bookmark_store=store)
+        self.collector.subscribe('Application')
+        self.collector.start(self._on_events)
+        self.clock.advance(0)
+        self.assertEqual(self.pulls, [('Application', 1)])
+        bookmark, record_id = store.get('fake_host', 'Application')
+        self.assertEqual(record_id, 3847)
+        self.successResultOf(self.collector.stop())
+
+        # a restart resumes from the bookmark and drops the seen event
+        self.collector = EventCollector(
+            self.conn_info, clock=self.clock, sender=self.sender,
+            bookmark_store=BookmarkStore(store.path, self.clock))
+        self.collector.subscribe('Application')
+        self.assertEqual(self.sender.bookmarks[-1],
+                         '<w:Bookmark>{0}</w:Bookmark>'.format(bookmark))
+        self.collector.start(self._on_events)
+        self.clock.advance(0)
+        self.assertEqual(self.pulls, [('Application', 1), ('Application', 0)])
+
+    def test_bookmark_after_processing(self):
+        store = BookmarkStore(
+            os.path.join(self.mktemp(), 'bookmarks.json'), self.clock)
+        self.collector = EventCollector(
+            self.conn_info, clock=self.clock, sender=self.sender,
+            bookmark_store=store)
+        self.collector.subscribe('Application')
+        processing = defer.Deferred()
+        self.collector.start(lambda path, select, events: processing)
+        self.clock.advance(0)
+        self.assertEqual(store.get('fake_host', 'Application'), (None, None))
+        processing.callback(None)
+        self.assertEqual(store.get('fake_host', 'Application')[1], 3847)
+
+    def test_subscribe_after_pull(self):
+        # the fake sender's Pulls complete at once
+        self.collector.start(self._on_events)
+        self.clock.advance(0)
+        self.collector.subscribe('Security')
+        self.clock.advance(0)
+        self.assertEqual(self.pulls[2:], [('Security', 1)])
+
+    def test_stop(self):
+        self.collector.start(self._on_events)
+        self.clock.advance(0)
+        self.successResultOf(self.collector.stop())
+        self.clock.advance(10)
+        self.assertEqual(len(self.pulls), 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
 if __name__ == '__main__':
     unittest.main()
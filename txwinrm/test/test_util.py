@@ -12,10 +12,21 @@ This testing requires real Windows machines that are setup manually.
 """
 
 import os
+import re
+import shutil
+import tempfile
+import struct
+import ctypes
 from datetime import datetime
 import unittest
+from twisted.internet.task import Clock
+from .. import _gssiov
 from ..util import _parse_error_message, _get_agent, _StringProducer, \
-    _get_request_template, get_datetime
+    _get_request_template, get_datetime, _parse_datetime, \
+    _EncryptedBodyReader, _BODY, \
+    AgentPool, ConnectionInfo, get_agent_pool_key, SecurityContextCache, \
+    _render_request_template, write_file_atomically, AuthGSSClient, \
+    _ConnectionPool
 
 
 class TestErrorReader(unittest.TestCase):
@@ -42,6 +53,162 @@ class TestAgent(unittest.TestCase):
         agent = _get_agent()
         self.assertIsNotNone(agent)
 
+    def test_pool_key(self):
+        conn_info = ConnectionInfo(
+            'host', 'basic', 'user', 'password', 'http', 5985, 'Keep-Alive',
+            '', '')
+        self.assertEqual(get_agent_pool_key(conn_info),
+                         ('http', 'host', 5985, 'basic', 'user'))
+        self.assertIsNone(get_agent_pool_key(
+            conn_info._replace(auth_type='kerberos')))
+        self.assertIsNone(get_agent_pool_key(None))
+
+
+class TestAgentPool(unittest.TestCase):
+
+    def test_shared(self):
+        pool = AgentPool(max_idle_connections=2, idle_timeout=30)
+        agent = pool.get_agent('a')
+        self.assertIs(pool.get_agent('a'), agent)
+        self.assertIsNot(pool.get_agent('b'), agent)
+        self.assertTrue(pool.is_shared(agent))
+        self.assertFalse(pool.is_shared(_get_agent()))
+        self.assertEqual(agent._pool.maxPersistentPerHost, 2)
+        self.assertEqual(agent._pool.cachedConnectionTimeout, 30)
+
+    def test_evict_least_recently_used(self):
+        pool = AgentPool(max_hosts=2)
+        agent_a = pool.get_agent('a')
+        pool.get_agent('b')
+        pool.get_agent('a')
+        pool.get_agent('c')
+        self.assertEqual(len(pool), 2)
+        self.assertIs(pool.get_agent('a'), agent_a)
+        self.assertIsNot(pool.get_agent('b'), agent_a)
+        self.assertEqual(len(pool), 2)
+
+    def test_discard(self):
+        pool = AgentPool()
+        agent = pool.get_agent('a')
+        pool.discard('a')
+        self.assertFalse(pool.is_shared(agent))
+        self.assertIsNot(pool.get_agent('a'), agent)
+
+
+class FakeConnection(object):
+
+    state = 'QUIESCENT'
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test_idle_connection(self):
+        pool = _ConnectionPool(Clock())
+        self.assertFalse(pool.has_idle_connection())
+        connection = FakeConnection()
+        pool._putConnection('key', connection)
+        self.assertTrue(pool.has_idle_connection())
+        # closed by the server
+        connection.state = 'CONNECTION_LOST'
+        self.assertFalse(pool.has_idle_connection())
+
+
+class FakePool(object):
+
+    def __init__(self):
+        self.idle = True
+        self.closed = False
+
+    def has_idle_connection(self):
+        return self.idle
+
+    def closeCachedConnections(self):
+        self.idle = False
+        self.closed = True
+
+
+class FakeAgent(object):
+
+    def __init__(self):
+        self._pool = FakePool()
+
+
+class FakeGSSClient(object):
+
+    cleaned = False
+
+    def cleanup(self):
+        self.cleaned = True
+
+
+KERBEROS_CONN_INFO = ConnectionInfo(
+    'host', 'kerberos', 'user@EXAMPLE.COM', 'password', 'http', 5985,
+    'Keep-Alive', '', '')
+
+
+class TestSecurityContextCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = SecurityContextCache(
+            max_size=2, timeout=60, clock=self.clock)
+
+    def test_checkout(self):
+        self.assertIsNone(self.cache.checkout(KERBEROS_CONN_INFO))
+        agent, gss_client = FakeAgent(), FakeGSSClient()
+        self.cache.checkin(KERBEROS_CONN_INFO, agent, gss_client)
+        other_host = KERBEROS_CONN_INFO._replace(ipaddress='10.0.0.2')
+        self.assertIsNone(self.cache.checkout(other_host))
+        self.assertEqual(self.cache.checkout(KERBEROS_CONN_INFO),
+                         (agent, gss_client))
+        self.assertIsNone(self.cache.checkout(KERBEROS_CONN_INFO))
+        self.assertFalse(gss_client.cleaned)
+
+    def test_connection_closed(self):
+        agent, gss_client = FakeAgent(), FakeGSSClient()
+        self.cache.checkin(KERBEROS_CONN_INFO, agent, gss_client)
+        agent._pool.idle = False
+        self.assertIsNone(self.cache.checkout(KERBEROS_CONN_INFO))
+        self.assertTrue(gss_client.cleaned)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_pruned(self):
+        closed, expired = FakeAgent(), FakeAgent()
+        self.cache.checkin(KERBEROS_CONN_INFO, expired, FakeGSSClient())
+        self.clock.advance(30)
+        self.cache.checkin(KERBEROS_CONN_INFO._replace(ipaddress='10.0.0.2'),
+                           closed, FakeGSSClient())
+        # dropped when another context is checked in
+        closed._pool.idle = False
+        self.cache.checkin(KERBEROS_CONN_INFO._replace(ipaddress='10.0.0.3'),
+                           FakeAgent(), FakeGSSClient())
+        self.assertEqual(len(self.cache), 2)
+        self.assertTrue(closed._pool.closed)
+        # dropped without further use of the cache
+        self.clock.advance(30)
+        self.assertEqual(len(self.cache), 1)
+        self.assertTrue(expired._pool.closed)
+        self.clock.advance(60)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_expired(self):
+        agent, gss_client = FakeAgent(), FakeGSSClient()
+        self.cache.checkin(KERBEROS_CONN_INFO, agent, gss_client)
+        self.clock.advance(61)
+        self.assertIsNone(self.cache.checkout(KERBEROS_CONN_INFO))
+        self.assertTrue(gss_client.cleaned)
+        self.assertTrue(agent._pool.closed)
+
+    def test_max_size(self):
+        entries = [(FakeAgent(), FakeGSSClient()) for i in xrange(3)]
+        for agent, gss_client in entries:
+            self.cache.checkin(KERBEROS_CONN_INFO, agent, gss_client)
+        self.assertEqual(len(self.cache), 2)
+        self.assertTrue(entries[0][1].cleaned)
+        self.assertEqual(self.cache.checkout(KERBEROS_CONN_INFO), entries[2])
+        self.assertEqual(self.cache.checkout(KERBEROS_CONN_INFO), entries[1])
+
 
 class TestStringProducer(unittest.TestCase):
 
@@ -61,6 +228,206 @@ class TestRequestTemplate(unittest.TestCase):
             'http://schemas.xmlsoap.org/ws/2004/09/enumeration/Enumerate',
             templ)
 
+    def test_render(self):
+        kwargs = dict(resource_uri='http://uri/*', envelope_size=512000,
+                      locale='en-US', code_page=65001, max_elements=32000,
+                      operation_timeout=60,
+                      wql='select * from Win32_Service')
+        expected = _get_request_template('enumerate').format(**kwargs)
+        request = _render_request_template('enumerate', **kwargs)
+        message_id = re.compile(r'uuid:[0-9A-F-]{36}')
+        self.assertEqual(message_id.sub('', request),
+                         message_id.sub('', expected))
+        self.assertNotEqual(message_id.findall(request),
+                            message_id.findall(expected))
+        self.assertNotEqual(
+            message_id.findall(request),
+            message_id.findall(
+                _render_request_template('enumerate', **kwargs)))
+
+    def test_render_escapes(self):
+        request = _render_request_template(
+            'subscribe', envelope_size=512000, locale='en"US',
+            event_query='&lt;QueryList/&gt;')
+        self.assertIn('xml:lang="en&quot;US"', request)
+        self.assertIn('>&lt;QueryList/&gt;<', request)
+        request = _render_request_template(
+            'enumerate', resource_uri='uri', envelope_size=512000,
+            locale='en-US', code_page=65001, max_elements=1,
+            operation_timeout=60,
+            wql=u"select * from Win32_Service where Name='a&b' and 1<2")
+        self.assertIn(u"Name='a&amp;b' and 1&lt;2", request)
+
+    def test_render_pull(self):
+        kwargs = dict(resource_uri='uri', envelope_size=512000,
+                      max_elements=1, operation_timeout=60)
+        first = _render_request_template(
+            'pull', enumeration_context='first', **kwargs)
+        second = _render_request_template(
+            'pull', enumeration_context='a<b', **kwargs)
+        self.assertIn('>first</n:EnumerationContext>', first)
+        self.assertIn('>a&lt;b</n:EnumerationContext>', second)
+        self.assertNotIn('first', second)
+
+    def test_render_missing_field(self):
+        self.assertRaises(KeyError, _render_request_template, 'pull')
+
+
+def _encrypted_body(payload):
+    body = _BODY.replace('\n', '\r\n')
+    return body.format(original_length=len(payload), emsg=payload)
+
+
+def _chunks(data, size):
+    return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+
+class TestEncryptedBodyReader(unittest.TestCase):
+
+    def _read(self, body, chunk_size):
+        decrypted = []
+        plaintext = []
+        reader = _EncryptedBodyReader(
+            lambda payload: decrypted.append(payload) or payload[::-1],
+            plaintext.append)
+        for chunk in _chunks(body, chunk_size):
+            reader.feed(chunk)
+        reader.close()
+        return decrypted, ''.join(plaintext)
+
+    def test_encrypted(self):
+        payload = '\x00\x01--Encrypted' + 'x' * 5000 + '-'
+        body = _encrypted_body(payload)
+        for chunk_size in (1, 7, 19, 20, 21, 64, len(body)):
+            decrypted, plaintext = self._read(body, chunk_size)
+            self.assertEqual(decrypted, [payload])
+            self.assertEqual(plaintext, payload[::-1])
+
+    def test_unencrypted(self):
+        for body in ('<s:Envelope/>', '<s:Envelope>' + 'x' * 10000 + '</s:Envelope>'):
+            for chunk_size in (3, 1000, len(body)):
+                decrypted, plaintext = self._read(body, chunk_size)
+                self.assertEqual(decrypted, [])
+                self.assertEqual(plaintext, body)
+
+    def test_missing_boundary(self):
+        body = _encrypted_body('payload')
+        reader = _EncryptedBodyReader(lambda payload: payload, lambda data: None)
+        reader.feed(body[:-len('--Encrypted Boundary\r\n')])
+        self.assertRaises(Exception, reader.close)
+
+
+class FakeGSSLibrary(object):
+    """
+    Stands in for libgssapi_krb5 in txwinrm._gssiov.  The cipher reverses
+    the data in place and wrap adds a fixed header and one byte of
+    padding, so the framing around it can run without a Kerberos context.
+    """
+
+    header = 'H' * 60
+    padding = '\x01'
+
+    def __init__(self, cipher=lambda data: data[::-1]):
+        self._cipher = cipher
+        self._buffers = []
+        self.released = 0
+
+    def _allocate(self, iov_buffer, data):
+        buf = ctypes.create_string_buffer(data, len(data))
+        self._buffers.append(buf)
+        iov_buffer.length = len(data)
+        iov_buffer.value = ctypes.addressof(buf)
+
+    def _transform(self, iov_buffer, length):
+        data = ctypes.string_at(iov_buffer.value, length)
+        ctypes.memmove(iov_buffer.value, self._cipher(data), length)
+
+    def gss_wrap_iov(self, minor, context, conf_req, qop, conf_state, iov,
+                     count):
+        self._allocate(iov[0].buffer, self.header)
+        self._transform(iov[1].buffer, iov[1].buffer.length)
+        self._allocate(iov[2].buffer, self.padding)
+        return 0
+
+    def gss_unwrap_iov(self, minor, context, conf_state, qop_state, iov,
+                       count):
+        header = ctypes.string_at(iov[0].buffer.value, iov[0].buffer.length)
+        if header != self.header:
+            # GSS_S_DEFECTIVE_TOKEN
+            return 0x90000
+        data = iov[1].buffer
+        data.length -= len(self.padding)
+        self._transform(data, data.length)
+        return 0
+
+    def gss_release_iov_buffer(self, minor, iov, count):
+        self.released += 1
+        del self._buffers[:]
+        return 0
+
+
+def fake_gss_client(iov_context=1, context=None):
+    """Return an AuthGSSClient on an established fake context."""
+    client = object.__new__(AuthGSSClient)
+    client._context = context
+    client._iov_context = iov_context
+    return client
+
+
+class TestGSSIov(unittest.TestCase):
+
+    def test_get_gss_context(self):
+        if not _gssiov.available():
+            raise unittest.SkipTest('GSSAPI library not available')
+        state = (ctypes.c_void_p * 2)(0x1234, 0x5678)
+        from_void_ptr = ctypes.pythonapi.PyCObject_FromVoidPtr
+        from_void_ptr.restype = ctypes.py_object
+        from_void_ptr.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        client_context = from_void_ptr(ctypes.addressof(state), None)
+        self.assertEqual(_gssiov.get_gss_context(client_context), 0x1234)
+        self.assertIsNone(_gssiov.get_gss_context(None))
+        self.assertIsNone(_gssiov.get_gss_context(object()))
+
+    def test_unwrap_malformed(self):
+        if not _gssiov.available():
+            raise unittest.SkipTest('GSSAPI library not available')
+        self.assertRaises(
+            _gssiov.GSSIovError, _gssiov.unwrap, 0, '\xff\x00\x00\x00abc')
+
+
+class TestGSSFraming(unittest.TestCase):
+
+    def setUp(self):
+        self.lib = FakeGSSLibrary()
+        self.orig_lib = _gssiov._lib
+        _gssiov._lib = self.lib
+        self.client = fake_gss_client()
+
+    def tearDown(self):
+        _gssiov._lib = self.orig_lib
+
+    def test_round_trip(self):
+        for body in ('', '<s:Envelope/>', '\x00\r\n--' * 10000):
+            encrypted = self.client.encrypt_body(body)
+            self.assertIn(
+                'Length={0}\r\n'.format(len(body) + 1), encrypted)
+            payload = encrypted.split(
+                'Content-Type: application/octet-stream\r\n')[1]
+            payload = payload[:-len('--Encrypted Boundary\r\n')]
+            self.assertEqual(
+                payload[:4], struct.pack('<I', len(FakeGSSLibrary.header)))
+            self.assertEqual(payload[4:64], FakeGSSLibrary.header)
+            self.assertEqual(payload[64:], body[::-1] + '\x01')
+            self.assertEqual(self.client.decrypt_body(encrypted), body)
+        self.assertEqual(self.lib.released, 3)
+
+    def test_bad_header_length(self):
+        payload = _gssiov.wrap(1, 'data')[0]
+        self.assertRaises(Exception, self.client.decrypt_payload,
+                          struct.pack('<I', 59) + payload[4:])
+        self.assertRaises(Exception, self.client.decrypt_payload,
+                          struct.pack('<I', 1000) + payload[4:])
+
 
 class TestGetDateTime(unittest.TestCase):
 
@@ -95,6 +462,73 @@ class TestGetDateTime(unittest.TestCase):
             actual = get_datetime(date_str)
             self.assertEqual(actual, expected)
 
+    def test_datetime_forms(self):
+        data = [("2013-04-09T15:42:20.412400123Z",
+                 datetime(2013, 4, 9, 15, 42, 20, 412400)),
+                ("04/11/2013 17:55:02.335",
+                 datetime(2013, 4, 11, 17, 55, 2, 335000)),
+                # not the usual forms, parsed with strptime
+                ("2013-4-9T15:42:20Z", datetime(2013, 4, 9, 15, 42, 20)),
+                ("4/11/2013 17:55:02.335",
+                 datetime(2013, 4, 11, 17, 55, 2, 335000)),
+                ]
+        for date_str, expected in data:
+            self.assertEqual(get_datetime(date_str), expected)
+            self.assertEqual(_parse_datetime(date_str), expected)
+        for date_str in ("2013-02-30T15:42:20Z",
+                         "2013-04-09T15:42:20.1234567Z",
+                         "2013-04-09T15:42:20Z\n", "04/11/2013 17:55:02",
+                         "garbage"):
+            self.assertRaises(ValueError, get_datetime, date_str)
+            self.assertRaises(ValueError, _parse_datetime, date_str)
+
+    def test_datetime_cache(self):
+        date_str = "2013-06-07T14:27:22.874-04:00"
+        self.assertIs(get_datetime(date_str), get_datetime(date_str))
+
+
+class TestWriteFileAtomically(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.path = os.path.join(self.dirname, 'file')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_write(self):
+        write_file_atomically(self.path, 'first')
+        os.chmod(self.path, 0o640)
+        write_file_atomically(self.path, 'second')
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'second')
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o640)
+        self.assertEqual(os.listdir(self.dirname), ['file'])
+
+    def test_symlink(self):
+        target = os.path.join(self.dirname, 'target')
+        write_file_atomically(target, 'first')
+        os.symlink(target, self.path)
+        write_file_atomically(self.path, 'second')
+        self.assertTrue(os.path.islink(self.path))
+        with open(target) as f:
+            self.assertEqual(f.read(), 'second')
+
+    def test_in_place(self):
+        write_file_atomically(self.path, 'first')
+        mkstemp = tempfile.mkstemp
+
+        def fail(*args, **kwargs):
+            raise OSError(13, 'Permission denied')
+
+        tempfile.mkstemp = fail
+        try:
+            write_file_atomically(self.path, 'second')
+        finally:
+            tempfile.mkstemp = mkstemp
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'second')
+
 if __name__ == '__main__':
     unittest.main()
     # suite = unittest.TestLoader().loadTestsFromTestCase(TestDataType)
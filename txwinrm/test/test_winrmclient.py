@@ -0,0 +1,639 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2017, all rights reserved.
+#
+# This content is made available according to terms specified in the LICENSE
+# file at the top-level directory of this package.
+#
+##############################################################################
+
+import base64
+from xml.etree import ElementTree as ET
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from .. import constants as c
+from ..util import ConnectionInfo, RequestError
+from ..WinRMClient import EnumerateClient, EnumInfo, _page_sizes, \
+    ShellPool, SingleCommandClient, MultiCommandClient, AssociatorClient, \
+    JoinClient
+from ..enumerate import ColumnAccumulator
+from ..scheduler import RequestScheduler, PRIORITY_NORMAL
+
+CONN_INFO = ConnectionInfo(
+    hostname='hostname',
+    auth_type='basic',
+    username='username',
+    password='password',
+    scheme='http',
+    port=5985,
+    connectiontype='Keep-Alive',
+    keytab='',
+    dcip='')
+
+
+class FakeResponse(object):
+
+    code = 200
+
+    def __init__(self, page):
+        self.page = page
+        self.discarded = False
+
+    def deliverBody(self, protocol):
+        self.discarded = True
+
+
+class FakeSession(object):
+    """Hands out one FakeResponse per Enumerate/Pull request."""
+
+    def __init__(self, page_count):
+        self.page_count = page_count
+        self.requests = []
+        self.responses = []
+        self.max_elements = []
+        self.sem = RequestScheduler()
+
+    def _send_request(self, request_template_name, client, **kwargs):
+        self.requests.append(
+            (request_template_name, kwargs['enumeration_context']))
+        self.max_elements.append(kwargs['max_elements'])
+        response = FakeResponse(len(self.requests) - 1)
+        self.responses.append(response)
+        return defer.succeed(response)
+
+
+class FakeHandler(object):
+    """
+    Returns page_size items per page and a context until the last page. The
+    last page reports a context before its end-of-sequence.
+    """
+
+    def __init__(self, page_count, page_size):
+        self.page_count = page_count
+        self.page_size = page_size
+
+    def handle_response(self, response, on_enumeration_context=None,
+                        columnar=False):
+        page = response.page
+        context = 'context{0}'.format(page)
+        if on_enumeration_context is not None:
+            on_enumeration_context(context)
+        items = ['{0}.{1}'.format(page, i) for i in xrange(self.page_size)]
+        if columnar:
+            accumulator = ColumnAccumulator()
+            for item in items:
+                accumulator.new_item()
+                accumulator.add_property('Value', item)
+            items = accumulator.items
+        if page + 1 == self.page_count:
+            context = None
+        return defer.succeed((context, items))
+
+
+def create_client(page_count, page_size, pipeline=False):
+    client = EnumerateClient(CONN_INFO, pipeline=pipeline)
+    client._session = FakeSession(page_count)
+    client._handler = FakeHandler(page_count, page_size)
+    client.init_connection = lambda: defer.succeed(None)
+    return client
+
+
+class TestEnumerateClient(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def test_enumerate(self):
+        client = create_client(3, 2)
+        items = yield client.enumerate('select * from Win32_Process')
+        self.assertEqual(items, ['0.0', '0.1', '1.0', '1.1', '2.0', '2.1'])
+        self.assertEqual(
+            client._session.requests,
+            [('enumerate', None), ('pull', 'context0'), ('pull', 'context1')])
+
+    @defer.inlineCallbacks
+    def test_enumerate_in_sem_run(self):
+        # the calling pattern of the old do_collect
+        client = create_client(2, 1)
+        items = yield client._session.sem.run(
+            client.enumerate, 'select * from Win32_Process')
+        self.assertEqual(items, ['0.0', '1.0'])
+
+    @defer.inlineCallbacks
+    def test_enumerate_iter(self):
+        client = create_client(3, 2)
+        pages = []
+        count = yield client.enumerate_iter(
+            'select * from Win32_Process', on_items=pages.append)
+        self.assertEqual(count, 6)
+        self.assertEqual(
+            pages, [['0.0', '0.1'], ['1.0', '1.1'], ['2.0', '2.1']])
+
+    @defer.inlineCallbacks
+    def test_enumerate_iter_waits_for_consumer(self):
+        client = create_client(2, 1)
+        consumer_d = defer.Deferred()
+        d = client.enumerate_iter(
+            'select * from Win32_Process', on_items=lambda items: consumer_d)
+        self.assertEqual(len(client._session.requests), 1)
+        self.assertFalse(d.called)
+        consumer_d.callback(None)
+        count = yield d
+        self.assertEqual(count, 2)
+        self.assertEqual(len(client._session.requests), 2)
+
+    @defer.inlineCallbacks
+    def test_pipeline(self):
+        client = create_client(3, 2, pipeline=True)
+        requests = client._session.requests
+        pages = []
+
+        def on_items(items):
+            pages.append((items, len(requests)))
+
+        count = yield client.enumerate_iter(
+            'select * from Win32_Process', on_items=on_items)
+        self.assertEqual(count, 6)
+        # each Pull was sent before the page before it was handed over
+        self.assertEqual(
+            pages,
+            [(['0.0', '0.1'], 2), (['1.0', '1.1'], 3), (['2.0', '2.1'], 4)])
+        self.assertEqual(
+            requests,
+            [('enumerate', None), ('pull', 'context0'), ('pull', 'context1'),
+             ('pull', 'context2')])
+        # the Pull sent ahead of the end-of-sequence is thrown away
+        self.assertEqual([r.discarded for r in client._session.responses],
+                         [False, False, False, True])
+
+    @defer.inlineCallbacks
+    def test_columnar(self):
+        client = create_client(2, 2, pipeline=True)
+        columns = yield client.enumerate(
+            'select * from Win32_PerfRawData_PerfOS_Processor', columnar=True,
+            column_types={'Value': 'real64'})
+        self.assertEqual(len(columns), 4)
+        self.assertEqual(columns['Value'].tolist(), [0.0, 0.1, 1.0, 1.1])
+
+    def test_enumerate_iter_requires_callback(self):
+        client = create_client(1, 1)
+        d = client.enumerate_iter('select * from Win32_Process')
+        return self.assertFailure(d, ValueError)
+
+
+class EnvelopeLimitedSession(FakeSession):
+    """Faults when more than fit items are asked for in one page."""
+
+    def __init__(self, fit):
+        super(EnvelopeLimitedSession, self).__init__(0)
+        self.fit = fit
+
+    def _send_request(self, request_template_name, client, **kwargs):
+        if kwargs['max_elements'] > self.fit:
+            self.max_elements.append(kwargs['max_elements'])
+            return defer.fail(RequestError(
+                'HTTP status: 500. The response that the WS-Management '
+                'service computed exceeds the maximum envelope size.'))
+        return super(EnvelopeLimitedSession, self)._send_request(
+            request_template_name, client, **kwargs)
+
+
+class PageSizeHandler(object):
+    """Pages hold max_elements items until total items have been sent."""
+
+    def __init__(self, session, total):
+        self.session = session
+        self.remaining = total
+
+    def handle_response(self, response):
+        count = min(self.session.max_elements[-1], self.remaining)
+        self.remaining -= count
+        context = 'context' if self.remaining else None
+        return defer.succeed((context, ['item'] * count))
+
+
+class TestPageSize(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(_page_sizes.clear)
+
+    def _create_client(self, fit, total):
+        client = create_client(0, 0)
+        client._session = EnvelopeLimitedSession(fit)
+        client._handler = PageSizeHandler(client._session, total)
+        return client
+
+    def test_defaults(self):
+        enum_info = EnumInfo('select * from Win32_Process', 'uri')
+        self.assertEqual(enum_info.max_elements, None)
+        self.assertEqual(enum_info.operation_timeout, None)
+        self.assertEqual(CONN_INFO.max_elements, 32000)
+        self.assertEqual(CONN_INFO.operation_timeout, 60)
+
+    @defer.inlineCallbacks
+    def test_shrink_on_envelope_fault(self):
+        client = self._create_client(fit=300, total=1000)
+        items = yield client.enumerate(
+            'select * from Win32_Process', max_elements=1000)
+        self.assertEqual(len(items), 1000)
+        self.assertEqual(client._session.max_elements[:3], [1000, 500, 250])
+        # full pages search for the largest size that fits
+        self.assertEqual(client._session.max_elements[3:],
+                         [375, 312, 281, 296, 304, 300])
+
+        # the next enumeration starts from the learned size
+        client = self._create_client(fit=300, total=1000)
+        yield client.enumerate(
+            'select * from Win32_Process', max_elements=1000)
+        self.assertEqual(client._session.max_elements,
+                         [296, 300, 302, 301, 300, 300])
+
+    @defer.inlineCallbacks
+    def test_other_faults(self):
+        client = self._create_client(fit=300, total=1000)
+        client._session._send_request = \
+            lambda *args, **kwargs: defer.fail(RequestError('Access denied'))
+        yield self.assertFailure(
+            client.enumerate('select * from Win32_Process'), RequestError)
+
+
+class FakeShellClient(SingleCommandClient):
+    """Records the shell requests instead of sending them."""
+
+    def __init__(self, shell_pool, gone=()):
+        super(FakeShellClient, self).__init__(CONN_INFO, shell_pool)
+        self.requests = []
+        self.gone = set(gone)
+        self.shell_count = 0
+        self._session = FakeSession(0)
+
+    def init_connection(self):
+        self.requests.append(('init',))
+        return defer.succeed(None)
+
+    def _create_shell(self):
+        self.shell_count += 1
+        shell_id = 'shell{0}'.format(self.shell_count)
+        self.requests.append(('create', shell_id))
+        return defer.succeed(shell_id)
+
+    def _run_command(self, shell_id, command_line):
+        self.requests.append(('command', shell_id))
+        if shell_id in self.gone:
+            return defer.fail(RequestError(
+                'HTTP status: 500. The request for the Windows Remote Shell '
+                'with ShellId {0} failed because the shell was not found on '
+                'the server.'.format(shell_id)))
+        return defer.succeed(command_line)
+
+    def _delete_shell(self, shell_id):
+        self.requests.append(('delete', shell_id))
+        return defer.succeed(None)
+
+    def close_connection(self):
+        self.requests.append(('close',))
+        return defer.succeed(None)
+
+
+class FakeItem(object):
+
+    def __init__(self, **properties):
+        self.__dict__.update(properties)
+
+
+class FakeQueries(object):
+    """Answers queries from a dict of wql to items or an error."""
+
+    def __init__(self, answers):
+        super(FakeQueries, self).__init__(CONN_INFO)
+        self.answers = answers
+        self.queries = []
+        self.closed = 0
+        self.session = FakeSession(0)
+
+    def init_connection(self):
+        self._session = self.session
+        return defer.succeed(None)
+
+    def close_connection(self):
+        self.closed += 1
+        return defer.succeed(None)
+
+    def enumerate(self, wql, resource_uri, **kwargs):
+        self.queries.append(wql)
+        answer = self.answers.get(wql, [])
+        if isinstance(answer, Exception):
+            return defer.fail(answer)
+        if isinstance(answer, defer.Deferred):
+            return answer
+        return defer.succeed(answer)
+
+
+class FakeAssociatorClient(FakeQueries, AssociatorClient):
+    pass
+
+
+class FakeJoinClient(FakeQueries, JoinClient):
+    pass
+
+
+class TestAssociatorClient(unittest.TestCase):
+
+    def setUp(self):
+        self.disks = [FakeItem(DeviceID='disk0'), FakeItem(DeviceID='disk1'),
+                      FakeItem(DeviceID='disk0')]
+        self.partitions = [FakeItem(DeviceID='part0', DiskID='disk0'),
+                           FakeItem(DeviceID='part1', DiskID='disk1')]
+        self.association = {'search_class': 'Win32_DiskDrive',
+                            'search_property': 'DeviceID',
+                            'return_class': 'Win32_DiskPartition',
+                            'where_type': 'ResultClass'}
+
+    def test_associators(self):
+        answers = {
+            'Select * from Win32_DiskDrive': self.disks,
+            "ASSOCIATORS of {Win32_DiskDrive.DeviceID='disk0'} WHERE "
+            "ResultClass=Win32_DiskPartition": self.partitions[:1],
+            "ASSOCIATORS of {Win32_DiskDrive.DeviceID='disk1'} WHERE "
+            "ResultClass=Win32_DiskPartition": RequestError('Invalid'),
+        }
+        client = FakeAssociatorClient(answers)
+        items = self.successResultOf(client.associate(
+            'Win32_DiskDrive', [self.association]))
+        # disk0 is only queried once
+        self.assertEqual(len(client.queries), 3)
+        self.assertEqual(client.closed, 1)
+        self.assertEqual(items['Win32_DiskDrive'], self.disks)
+        self.assertEqual(items['Win32_DiskPartition'], {
+            'disk0': self.partitions[:1], 'disk1': []})
+
+    def test_join(self):
+        answers = {
+            'Select * from Win32_DiskDrive': self.disks,
+            'Select * from Win32_DiskPartition': self.partitions,
+        }
+        client = FakeAssociatorClient(answers)
+        association = dict(self.association, join_property='DiskID')
+        items = self.successResultOf(client.associate(
+            'Win32_DiskDrive', [association]))
+        self.assertEqual(client.queries, sorted(answers))
+        self.assertEqual(items['Win32_DiskPartition'], {
+            'disk0': self.partitions[:1], 'disk1': self.partitions[1:]})
+
+    def test_concurrency(self):
+        disks = [FakeItem(DeviceID='disk{0}'.format(i)) for i in xrange(3)]
+        answers = {'Select * from Win32_DiskDrive': disks}
+        for disk in disks:
+            answers["ASSOCIATORS of {{Win32_DiskDrive.DeviceID='{0}'}} "
+                    "WHERE ResultClass=Win32_DiskPartition".format(
+                        disk.DeviceID)] = defer.Deferred()
+        client = FakeAssociatorClient(answers)
+        client.session.sem.configure(slots=2)
+        d = client.associate('Win32_DiskDrive', [self.association])
+        # as many queries as the session has slots
+        self.assertEqual(len(client.queries), 3)
+        answers[client.queries[1]].callback([])
+        self.assertEqual(len(client.queries), 4)
+        answers[client.queries[2]].callback([])
+        answers[client.queries[3]].callback([])
+        self.assertEqual(
+            self.successResultOf(d)['Win32_DiskPartition'],
+            {'disk0': [], 'disk1': [], 'disk2': []})
+
+    def test_no_seed(self):
+        client = FakeAssociatorClient(
+            {'Select * from Win32_DiskDrive': RequestError('Invalid')})
+        self.failureResultOf(client.associate(
+            'Win32_DiskDrive', [self.association]), Exception)
+        self.assertEqual(client.closed, 1)
+
+
+class TestJoinClient(unittest.TestCase):
+
+    def test_join(self):
+        disks = [FakeItem(Index=0), FakeItem(Index=1)]
+        partitions = [FakeItem(DiskIndex=0, Name='part0'),
+                      FakeItem(DiskIndex=0, Name='part1'),
+                      FakeItem(DiskIndex=1, Name='part2')]
+        volumes = [FakeItem(Partition='part1')]
+        answers = {
+            'Select * from Win32_DiskDrive': disks,
+            'Select * from Win32_DiskPartition': partitions,
+            "Select * from Volume where DriveType=3": volumes,
+        }
+        client = FakeJoinClient(answers)
+        items = self.successResultOf(client.join('Win32_DiskDrive', [
+            {'search_property': 'Index',
+             'return_class': 'Win32_DiskPartition',
+             'join_property': 'DiskIndex'},
+            {'search_property': 'Name',
+             'return_class': 'Volume',
+             'join_property': 'Partition',
+             'where': 'DriveType=3'}]))
+        self.assertEqual(sorted(client.queries), sorted(answers))
+        self.assertEqual(client.closed, 1)
+        self.assertEqual(items['Win32_DiskDrive'], disks)
+        self.assertEqual(items['Win32_DiskPartition'],
+                         {0: partitions[:2], 1: partitions[2:]})
+        self.assertEqual(items['Volume'],
+                         {'part0': [], 'part1': volumes, 'part2': []})
+
+    def test_no_seed(self):
+        client = FakeJoinClient(
+            {'Select * from Win32_DiskDrive': RequestError('Invalid')})
+        d = client.join('Win32_DiskDrive', [
+            {'search_property': 'Index',
+             'return_class': 'Win32_DiskPartition',
+             'join_property': 'DiskIndex'}])
+        self.failureResultOf(d, Exception)
+
+
+class TestShellPool(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.pool = ShellPool(max_shells=1, idle_ttl=60, clock=self.clock)
+
+    @defer.inlineCallbacks
+    def test_reuse(self):
+        client = FakeShellClient(self.pool)
+        yield client.run_single_command('dir')
+        yield client.run_single_command('dir')
+        self.assertEqual(client.requests, [
+            ('create', 'shell1'), ('command', 'shell1'), ('close',),
+            ('command', 'shell1'), ('close',)])
+        self.assertEqual(len(self.pool), 1)
+
+        # idle shells are deleted after the TTL, which is kept below the
+        # session idle timeout
+        del client.requests[:]
+        self.clock.advance(client.session_manager.idle_timeout / 2.0)
+        self.assertEqual(client.requests, [
+            ('init',), ('delete', 'shell1'), ('close',)])
+        self.assertEqual(len(self.pool), 0)
+
+    def test_expire_scheduled(self):
+        client = FakeShellClient(self.pool)
+        self.pool.checkin(client._shell_key, 'shell1', client)
+        running = defer.Deferred()
+        client._session.sem.submit(PRIORITY_NORMAL, None, lambda: running)
+        self.clock.advance(60)
+        # the delete waits for the running conversation
+        self.assertEqual(client.requests, [('init',)])
+        running.callback(None)
+        self.assertEqual(client.requests, [
+            ('init',), ('delete', 'shell1'), ('close',)])
+
+    @defer.inlineCallbacks
+    def test_max_shells(self):
+        client = FakeShellClient(self.pool)
+        key = client._shell_key
+        self.assertTrue(self.pool.checkin(key, 'shell1', client))
+        self.assertFalse(self.pool.checkin(key, 'shell2', client))
+        self.assertEqual(self.pool.checkout(key), 'shell1')
+        self.assertIsNone(self.pool.checkout(key))
+        self.pool.checkin(key, 'shell3', client)
+        yield self.pool.close()
+        self.assertEqual(client.requests, [
+            ('init',), ('delete', 'shell3'), ('close',)])
+        self.assertEqual(len(self.pool), 0)
+
+    @defer.inlineCallbacks
+    def test_shell_gone(self):
+        client = FakeShellClient(self.pool, gone=['old'])
+        self.pool.checkin(client._shell_key, 'old', client)
+        result = yield client.run_single_command('dir')
+        self.assertEqual(result, 'dir')
+        self.assertEqual(client.requests, [
+            ('command', 'old'), ('create', 'shell1'), ('command', 'shell1'),
+            ('close',)])
+        self.assertEqual(self.pool.checkout(client._shell_key), 'shell1')
+
+    @defer.inlineCallbacks
+    def test_disabled(self):
+        client = FakeShellClient(None)
+        yield client.run_single_command('dir')
+        self.assertEqual(client.requests, [
+            ('create', 'shell1'), ('command', 'shell1'),
+            ('delete', 'shell1'), ('close',)])
+
+
+def _receive_elem(command_id, stdout, exit_code=None):
+    state = ''
+    if exit_code is not None:
+        state = ('<rsp:CommandState CommandId="{0}"><rsp:ExitCode>{1}'
+                 '</rsp:ExitCode></rsp:CommandState>'.format(
+                     command_id, exit_code))
+    return ET.fromstring(
+        '<rsp:ReceiveResponse xmlns:rsp="{0}"><rsp:Stream Name="stdout" '
+        'CommandId="{1}">{2}</rsp:Stream>{3}</rsp:ReceiveResponse>'.format(
+            c.XML_NS_MSRSP, command_id, base64.b64encode(stdout), state))
+
+
+class FakeMultiCommandClient(MultiCommandClient):
+    """Commands print one line per Receive and exit after exit_after."""
+
+    def __init__(self, exit_after):
+        super(FakeMultiCommandClient, self).__init__(CONN_INFO)
+        self.exit_after = exit_after
+        self.requests = []
+        self._session = FakeSession(0)
+
+    def init_connection(self):
+        return defer.succeed(None)
+
+    def close_connection(self):
+        return defer.succeed(None)
+
+    def _create_shell(self):
+        self.requests.append('create')
+        return defer.succeed('shell')
+
+    def _send_command(self, shell_id, command_line):
+        command_id = 'cmd{0}'.format(len(self.exit_codes))
+        self.requests.append(('command', command_line, self.ps_script))
+        return defer.succeed(ET.fromstring(
+            '<rsp:CommandResponse xmlns:rsp="{0}"><rsp:CommandId>{1}'
+            '</rsp:CommandId></rsp:CommandResponse>'.format(
+                c.XML_NS_MSRSP, command_id)))
+
+    def _send_receive(self, shell_id, command_id):
+        count = self.requests.count(('receive', command_id)) + 1
+        self.requests.append(('receive', command_id))
+        exit_code = 0 if count >= self.exit_after.get(command_id, 99) \
+            else None
+        return defer.succeed(_receive_elem(
+            command_id, '{0} {1}'.format(command_id, count), exit_code))
+
+    def _signal_ctrl_c(self, shell_id, command_id):
+        self.requests.append(('ctrl_c', command_id))
+        return defer.succeed(None)
+
+    def _signal_terminate(self, shell_id, command_id):
+        self.requests.append(('terminate', command_id))
+        return defer.succeed(None)
+
+    def _delete_shell(self, shell_id):
+        self.requests.append('delete')
+        return defer.succeed(None)
+
+
+class TestMultiCommandClient(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def test_commands(self):
+        client = FakeMultiCommandClient({'cmd0': 1})
+        command_ids = yield client.start(
+            ['typeperf', ('powershell -Command', '"& {get-counter}"')])
+        self.assertEqual(command_ids, ['cmd0', 'cmd1'])
+        self.assertEqual(client.requests, [
+            'create', ('command', 'typeperf', None),
+            ('command', 'powershell -Command', '"& {get-counter}"')])
+
+        clock = Clock()
+        outputs = []
+        client.start_polling(10, outputs.append, clock)
+        clock.advance(10)
+        clock.advance(10)
+        self.assertEqual(outputs, [
+            {'cmd0': ([u'cmd0 1'], []), 'cmd1': ([u'cmd1 1'], [])},
+            {'cmd1': ([u'cmd1 2'], [])}])
+        self.assertEqual(client.exit_codes, {'cmd0': 0, 'cmd1': None})
+
+        sent = len(client.requests)
+        responses = yield client.stop()
+        self.assertEqual(client.requests[sent:], [
+            ('ctrl_c', 'cmd1'), ('receive', 'cmd1'), ('terminate', 'cmd1'),
+            'delete'])
+        self.assertEqual(responses['cmd1'].stdout, [u'cmd1 3'])
+        self.assertEqual(responses['cmd0'].exit_code, 0)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    @defer.inlineCallbacks
+    def test_receives_scheduled(self):
+        client = FakeMultiCommandClient({})
+        yield client.start(['typeperf', 'typeperf'])
+        sem = client._session.sem
+        sem.run(lambda: defer.Deferred())
+        d = client.receive()
+        self.assertNoResult(d)
+        self.assertEqual(sem.stats().queued, 2)
+
+    @defer.inlineCallbacks
+    def test_one_timer_per_host(self):
+        clients = [FakeMultiCommandClient({'cmd0': 2}) for i in xrange(3)]
+        for client in clients:
+            yield client.start(['typeperf'])
+        clock = Clock()
+        outputs = []
+        ds = [client.start_polling(10, outputs.append, clock)
+              for client in clients]
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        clock.advance(10)
+        self.assertEqual(len(outputs), 3)
+        clients[0].stop_polling()
+        self.assertIsNone(self.successResultOf(ds[0]))
+        clock.advance(10)
+        self.assertEqual(len(outputs), 5)
+        for client in clients[1:]:
+            client.stop_polling()
+        self.assertEqual(clock.getDelayedCalls(), [])
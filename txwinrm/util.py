@@ -9,11 +9,16 @@
 
 import os
 import re
+import uuid
+import string
+import operator
+import itertools
 import base64
 import logging
 import httplib
+import tempfile
 from datetime import datetime
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from xml.etree import cElementTree as ET
 from xml.etree.ElementTree import ParseError
 from twisted.internet import reactor, defer
@@ -23,8 +28,9 @@ from twisted.internet.ssl import ClientContextFactory
 from twisted.web.http_headers import Headers
 from twisted.internet.threads import deferToThread
 from . import constants as c
+from . import _gssiov
 
-from .krb5 import kinit, ccname, add_trusted_realm, config
+from .krb5 import kinit, ccname, add_trusted_realm, config, mark_used
 
 # ZEN-15434 lazy import to avoid segmentation fault during install
 kerberos = None
@@ -35,6 +41,10 @@ _AGENT = None
 _MAX_PERSISTENT_PER_HOST = 200
 _CACHED_CONNECTION_TIMEOUT = 24000
 _CONNECT_TIMEOUT = 500
+_MAX_POOLED_HOSTS = 1000
+_MAX_IDLE_PER_HOST = 4
+_IDLE_CONNECTION_TIMEOUT = 60
+_MAX_CACHED_CONTEXTS = 100
 _NANOSECONDS_PATTERN = re.compile(r'\.(\d{6})(\d{3})')
 _REQUEST_TEMPLATE_NAMES = (
     'enumerate', 'pull',
@@ -43,6 +53,25 @@ _REQUEST_TEMPLATE_NAMES = (
 _REQUEST_TEMPLATE_DIR = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), 'request')
 _REQUEST_TEMPLATES = {}
+_COMPILED_REQUEST_TEMPLATES = {}
+_MESSAGE_ID_PATTERN = re.compile(r'<a:MessageID>uuid:[^<]*</a:MessageID>')
+# fields whose values come from callers or servers and are XML-escaped.
+# The others are numbers, constants or XML already.
+_ESCAPED_TEMPLATE_FIELDS = frozenset([
+    'locale', 'resource_uri', 'wql', 'enumeration_context', 'shell_id',
+    'command_id', 'subscription_id'])
+# fields that differ for every request, so they are not part of the key of
+# cached requests.  Their values are strings, always XML-escaped.
+_PER_REQUEST_TEMPLATE_FIELDS = frozenset(['enumeration_context'])
+_MAX_CACHED_REQUESTS = 128
+# template name -> values of its optional fields
+_REQUEST_TEMPLATE_DEFAULTS = {'subscribe': {'bookmark': ''}}
+_XML_ESCAPES = (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'))
+# MessageIDs are a random per-process UUID prefix and a counter. Unique like
+# uuid4() per request, without its cost. The counter has the 12 digits of
+# the last UUID group, decimal digits being hex digits too.
+_MESSAGE_ID_PREFIX = 'uuid:{0}-'.format(str(uuid.uuid4()).upper()[:23])
+_message_ids = itertools.imap(str, itertools.count(10 ** 11))
 _CONTENT_TYPE = {'Content-Type': ['application/soap+xml;charset=UTF-8']}
 _MAX_KERBEROS_RETRIES = 3
 _MARKER = object()
@@ -59,6 +88,12 @@ Content-Type: application/octet-stream
 {emsg}--Encrypted Boundary
 """
 
+_ENCRYPTED_BOUNDARY = '--Encrypted Boundary'
+_ENCRYPTED_PAYLOAD_START = 'Content-Type: application/octet-stream\r\n'
+# The multipart header precedes the payload by a few hundred bytes.  A body
+# without the payload marker this far in is not encrypted.
+_MAX_ENCRYPTED_HEADER_SIZE = 4096
+
 _KRB_INTERNAL_CACHE_ERR = 'Internal credentials cache error while storing '\
     'credentials while getting initial credentials'
 
@@ -70,6 +105,49 @@ def _has_get_attr(obj, attr_name):
     return True, attr_value
 
 
+def write_file_atomically(path, content, mode=0o644):
+    """Replace the file at path with content.
+
+    The content goes to a temporary file in the same directory which is
+    then renamed over path, so readers never see a partial file.  A
+    symlink at path is followed and the file it points to replaced.  An
+    existing file keeps its permissions.  If the temporary file can't be
+    created or renamed, e.g. the directory isn't writable, path is
+    written in place.  Raises IOError or OSError.
+    """
+    path = os.path.realpath(path)
+    try:
+        mode = os.stat(path).st_mode & 0o777
+    except OSError:
+        pass
+    try:
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path),
+            prefix='.{0}.'.format(os.path.basename(path)))
+    except (IOError, OSError) as e:
+        log.debug('Unable to create a temporary file for {0}: {1}'.format(
+            path, e))
+        _write_file(path, content)
+        return
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        log.debug('Unable to replace {0}: {1}'.format(path, e))
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        _write_file(path, content)
+
+
+def _write_file(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
 class MyWebClientContextFactory(object):
 
     def __init__(self):
@@ -79,22 +157,297 @@ class MyWebClientContextFactory(object):
         return self._options.getContext()
 
 
-def _get_agent():
+try:
+    # HTTPConnectionPool has been present since Twisted version 12.1
+    from twisted.web.client import HTTPConnectionPool
+except ImportError:
+    HTTPConnectionPool = None
+else:
+    class _ConnectionPool(HTTPConnectionPool):
+        """
+        An HTTPConnectionPool that tells whether it holds an open idle
+        connection.
+        """
+
+        def has_idle_connection(self):
+            # a cached connection the server closed stays cached until
+            # its timeout, so check that it is still usable
+            return any(connection.state == 'QUIESCENT'
+                       for connections in self._connections.itervalues()
+                       for connection in connections)
+
+
+def _create_agent(max_persistent_per_host=_MAX_PERSISTENT_PER_HOST,
+                  cached_connection_timeout=_CACHED_CONNECTION_TIMEOUT):
     context_factory = MyWebClientContextFactory()
-    try:
-        # HTTPConnectionPool has been present since Twisted version 12.1
-        from twisted.web.client import HTTPConnectionPool
-        pool = HTTPConnectionPool(reactor, persistent=True)
-        pool.maxPersistentPerHost = _MAX_PERSISTENT_PER_HOST
-        pool.cachedConnectionTimeout = _CACHED_CONNECTION_TIMEOUT
+    if HTTPConnectionPool is not None:
+        pool = _ConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = max_persistent_per_host
+        pool.cachedConnectionTimeout = cached_connection_timeout
         agent = Agent(reactor, context_factory,
                       connectTimeout=_CONNECT_TIMEOUT, pool=pool)
-    except ImportError:
+    else:
         from _zenclient import ZenAgent
         agent = ZenAgent(reactor, context_factory, persistent=True, maxConnectionsPerHostName=1)
     return agent
 
 
+def _close_agent_connections(agent):
+    """
+    Close the cached connections of an agent. Agents shared through
+    AGENT_POOL keep their connections for other clients; their idle
+    connections are closed by the pool's idle timeout and LRU eviction.
+    Returns a Deferred.
+    """
+    if not agent or AGENT_POOL.is_shared(agent):
+        return defer.succeed(None)
+    if hasattr(agent, 'closeCachedConnections'):
+        # twisted 11 has no return and is part of the Agent
+        return defer.succeed(agent.closeCachedConnections())
+    # twisted 12 returns a Deferred
+    return agent._pool.closeCachedConnections()
+
+
+def get_agent_pool_key(conn_info):
+    """
+    Return the AGENT_POOL key for conn_info, or None if its connections
+    can't be shared. Kerberos security contexts are bound to a connection,
+    so only basic auth connections are shared between clients.
+    """
+    if conn_info is None or conn_info.auth_type != 'basic':
+        return None
+    return (conn_info.scheme, conn_info.ipaddress, conn_info.port,
+            conn_info.auth_type, conn_info.username)
+
+
+class AgentPool(object):
+    """
+    Process-wide Agents keyed by (scheme, ipaddress, port, auth identity).
+
+    Clients that talk to the same host as the same user share one Agent and
+    its HTTPConnectionPool, so short-lived clients reuse keep-alive
+    connections instead of paying a TCP (and TLS) handshake each. Each pool
+    keeps at most max_idle_connections idle connections which are closed
+    after idle_timeout seconds. When more than max_hosts keys are cached the
+    least recently used one is evicted and its idle connections closed.
+    """
+
+    def __init__(self, max_hosts=_MAX_POOLED_HOSTS,
+                 max_idle_connections=_MAX_IDLE_PER_HOST,
+                 idle_timeout=_IDLE_CONNECTION_TIMEOUT):
+        self.max_hosts = max_hosts
+        self.max_idle_connections = max_idle_connections
+        self.idle_timeout = idle_timeout
+        self._agents = OrderedDict()
+        self._keys = {}
+
+    def configure(self, max_hosts=None, max_idle_connections=None,
+                  idle_timeout=None):
+        """Change pool limits. Applies to agents created afterwards."""
+        if max_hosts is not None:
+            self.max_hosts = max_hosts
+        if max_idle_connections is not None:
+            self.max_idle_connections = max_idle_connections
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        self._evict()
+
+    def get_agent(self, key):
+        """Return the shared agent for key, creating it if necessary."""
+        agent = self._agents.pop(key, None)
+        if agent is None:
+            agent = _create_agent(self.max_idle_connections, self.idle_timeout)
+            if not hasattr(agent, '_pool'):
+                # without HTTPConnectionPool connections can't be shared
+                return agent
+            self._keys[id(agent)] = key
+        # most recently used keys live at the end
+        self._agents[key] = agent
+        self._evict()
+        return agent
+
+    def is_shared(self, agent):
+        return id(agent) in self._keys
+
+    def discard(self, key):
+        """
+        Drop the agent for key, closing its idle connections. The next
+        get_agent for key creates a new agent.
+        """
+        agent = self._agents.pop(key, None)
+        if agent is None:
+            return defer.succeed(None)
+        del self._keys[id(agent)]
+        return _close_agent_connections(agent)
+
+    def close(self):
+        """Drop all agents. Returns a Deferred."""
+        return defer.DeferredList(
+            [self.discard(key) for key in list(self._agents)])
+
+    def __len__(self):
+        return len(self._agents)
+
+    def _evict(self):
+        while len(self._agents) > self.max_hosts:
+            self.discard(next(iter(self._agents)))
+
+
+AGENT_POOL = AgentPool()
+
+
+def _has_idle_connection(agent):
+    pool = getattr(agent, '_pool', None)
+    return pool is not None and pool.has_idle_connection()
+
+
+def _get_service_principal(conn_info):
+    return '{0}@{1}'.format(conn_info.service.upper(), conn_info.hostname)
+
+
+def get_security_context_key(conn_info):
+    return (conn_info.username, _get_service_principal(conn_info),
+            conn_info.scheme, conn_info.ipaddress, conn_info.port)
+
+
+class SecurityContextCache(object):
+    """
+    Established Kerberos security contexts that are not in use.
+
+    WinRM binds a Kerberos security context to the connection it was
+    negotiated on, so a context is cached together with the Agent holding
+    that keep-alive connection. A client that checks out an entry skips the
+    GSSAPI handshake and owns the entry until it checks it back in. Entries
+    whose connection has been closed, or that have been idle for longer than
+    timeout seconds, are dropped at each checkin and as they expire.
+    Entries that were refused with a 401 must not be checked back in.
+    """
+
+    def __init__(self, max_size=_MAX_CACHED_CONTEXTS,
+                 timeout=_IDLE_CONNECTION_TIMEOUT, clock=reactor):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._clock = clock
+        # key -> list of (checkin time, agent, gss_client), oldest first
+        self._entries = OrderedDict()
+        self._size = 0
+        # IDelayedCall of the next _prune while there are entries
+        self._call = None
+
+    def checkout(self, conn_info):
+        """
+        Return (agent, gss_client) of an established context for conn_info,
+        or None if there is none.
+        """
+        key = get_security_context_key(conn_info)
+        entries = self._entries.get(key)
+        if not entries:
+            return None
+        expired = self._clock.seconds() - self.timeout
+        while entries:
+            checkin_time, agent, gss_client = entries.pop()
+            self._size -= 1
+            if checkin_time > expired and _has_idle_connection(agent):
+                break
+            self._close(agent, gss_client)
+        else:
+            agent = gss_client = None
+        if not entries:
+            del self._entries[key]
+        if gss_client is None:
+            return None
+        log.debug('reusing kerberos context for {0}'.format(key[1]))
+        return agent, gss_client
+
+    def checkin(self, conn_info, agent, gss_client):
+        """
+        Cache an established context and its agent for reuse. Closes the
+        agent's connections instead if its connection is gone. Returns a
+        Deferred.
+        """
+        self._prune()
+        if self.max_size < 1 or not _has_idle_connection(agent):
+            return self._close(agent, gss_client)
+        key = get_security_context_key(conn_info)
+        entries = self._entries.pop(key, [])
+        entries.append((self._clock.seconds(), agent, gss_client))
+        # most recently used keys live at the end
+        self._entries[key] = entries
+        self._size += 1
+        while self._size > self.max_size:
+            oldest = next(iter(self._entries))
+            entries = self._entries[oldest]
+            self._close(*entries.pop(0)[1:])
+            self._size -= 1
+            if not entries:
+                del self._entries[oldest]
+        self._schedule_expiry()
+        return defer.succeed(None)
+
+    def clear(self):
+        """Drop all cached contexts. Returns a Deferred."""
+        ds = []
+        for entries in self._entries.itervalues():
+            ds.extend(self._close(agent, gss_client)
+                      for _, agent, gss_client in entries)
+        self._entries.clear()
+        self._size = 0
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        return defer.DeferredList(ds)
+
+    def __len__(self):
+        return self._size
+
+    def _schedule_expiry(self):
+        if self._call is not None or not self._entries:
+            return
+        # each key's entries are oldest first
+        oldest = min(entries[0][0] for entries in self._entries.itervalues())
+        self._call = self._clock.callLater(
+            max(oldest + self.timeout - self._clock.seconds(), 0),
+            self._expire)
+
+    def _expire(self):
+        self._call = None
+        self._prune()
+        self._schedule_expiry()
+
+    def _prune(self):
+        """Drop the entries that are expired or whose connection is gone."""
+        expired = self._clock.seconds() - self.timeout
+        for key in list(self._entries):
+            entries = self._entries[key]
+            for entry in list(entries):
+                checkin_time, agent, gss_client = entry
+                if checkin_time <= expired or \
+                        not _has_idle_connection(agent):
+                    entries.remove(entry)
+                    self._size -= 1
+                    self._close(agent, gss_client)
+            if not entries:
+                del self._entries[key]
+
+    def _close(self, agent, gss_client):
+        gss_client.cleanup()
+        return _close_agent_connections(agent)
+
+
+SECURITY_CONTEXT_CACHE = SecurityContextCache()
+
+
+def _get_agent(conn_info=None):
+    """
+    Return an agent for conn_info. Connections are shared through AGENT_POOL
+    when possible, otherwise a private agent is returned.
+    """
+    key = get_agent_pool_key(conn_info)
+    if key is None:
+        return _create_agent()
+    return AGENT_POOL.get_agent(key)
+
+
 class _StringProducer(object):
     """
     The length attribute must be a non-negative integer or the constant
@@ -160,6 +513,99 @@ class _ErrorReader(Protocol):
         self.d.callback(message)
 
 
+class _EncryptedBodyReader(object):
+    """
+    Locates the encrypted payload of a multipart/encrypted response body as
+    chunks arrive.  Payload chunks are kept until the closing boundary shows
+    up, then joined once, decrypted and handed to sink.  Bodies that turn out
+    not to be encrypted are passed through to sink as they arrive.
+    """
+
+    def __init__(self, decrypt_payload, sink):
+        self._decrypt_payload = decrypt_payload
+        self._sink = sink
+        self._head = ''
+        self._parts = None
+        self._carry = ''
+        self._passthrough = False
+        self.done = False
+
+    def feed(self, data):
+        if self.done:
+            return
+        if self._passthrough:
+            self._sink(data)
+        elif self._parts is None:
+            self._feed_head(data)
+        else:
+            self._feed_payload(data)
+
+    def close(self):
+        """
+        Called once the whole body has been fed.  Raises if the closing
+        boundary of an encrypted payload never arrived.
+        """
+        if self.done or self._passthrough:
+            return
+        if self._parts is None:
+            # Unencrypted data, hand over the body
+            head, self._head = self._head, ''
+            if head:
+                self._sink(head)
+            return
+        raise Exception('Encrypted message is missing the closing boundary')
+
+    def _feed_head(self, data):
+        self._head += data
+        try:
+            start = self._head.index(_ENCRYPTED_PAYLOAD_START)
+        except ValueError:
+            if len(self._head) > _MAX_ENCRYPTED_HEADER_SIZE:
+                self._passthrough = True
+                head, self._head = self._head, ''
+                self._sink(head)
+            return
+        rest = self._head[start + len(_ENCRYPTED_PAYLOAD_START):]
+        self._head = ''
+        self._parts = []
+        if rest:
+            self._feed_payload(rest)
+
+    def _feed_payload(self, data):
+        boundary = _ENCRYPTED_BOUNDARY
+        n = len(boundary) - 1
+        # The boundary may straddle the previous chunk and this one.
+        window = self._carry + data[:n]
+        end = window.find(boundary)
+        if end >= 0:
+            self._parts.append(window[:end])
+            self._finish()
+            return
+        end = data.find(boundary)
+        if end >= 0:
+            self._parts.append(self._carry)
+            self._parts.append(data[:end])
+            self._finish()
+            return
+        if len(data) >= n:
+            self._parts.append(self._carry)
+            self._parts.append(data[:-n])
+            self._carry = data[-n:]
+        else:
+            window = self._carry + data
+            self._parts.append(window[:-n])
+            self._carry = window[-n:]
+
+    def _finish(self):
+        self.done = True
+        payload = ''.join(self._parts)
+        self._parts = None
+        self._carry = ''
+        plaintext = self._decrypt_payload(payload)
+        del payload
+        self._sink(plaintext)
+
+
 class RequestError(Exception):
     pass
 
@@ -183,6 +629,130 @@ def _get_request_template(name):
     return _REQUEST_TEMPLATES[name]
 
 
+def _escape_xml(value):
+    for char, entity in _XML_ESCAPES:
+        if char in value:
+            value = value.replace(char, entity)
+    return value
+
+
+def _template_value(value, escaped):
+    if not isinstance(value, basestring):
+        return str(value)
+    if escaped and ('&' in value or '<' in value or '>' in value or
+                    '"' in value):
+        return _escape_xml(value)
+    return value
+
+
+class _CompiledRequestTemplate(object):
+    """
+    A request template split once into its literal text and fields.
+
+    A request is the literal text joined with the field values, of which
+    those of _ESCAPED_TEMPLATE_FIELDS are XML-escaped where needed, and a
+    new MessageID.  The text around the MessageID and the field of
+    _PER_REQUEST_TEMPLATE_FIELDS, if any, is kept in requests for the last
+    _MAX_CACHED_REQUESTS combinations of the other field values, so a
+    repeated request, e.g. the Enumerate of a query every collection cycle
+    or the Receive of a polled command, only costs a lookup.
+    """
+
+    def __init__(self, text, defaults=None):
+        text = _MESSAGE_ID_PATTERN.sub(
+            '<a:MessageID>{0}{{message_id}}</a:MessageID>'.format(
+                _MESSAGE_ID_PREFIX), text)
+        self._defaults = (defaults or {}).items()
+        # literal text with None for the fields
+        self._segments = []
+        # (segment index, field name, escaped) of the cached fields
+        self._fields = []
+        # the field of _PER_REQUEST_TEMPLATE_FIELDS, after the MessageID
+        self.per_request_field = None
+        field_names = []
+        message_id = False
+        for literal, field_name, format_spec, conversion in \
+                string.Formatter().parse(text):
+            if format_spec or conversion:
+                raise ValueError(
+                    'Unsupported template field: {0}'.format(field_name))
+            self._segments.append(literal)
+            if field_name is None:
+                continue
+            if field_name == 'message_id':
+                message_id = True
+            elif field_name in _PER_REQUEST_TEMPLATE_FIELDS:
+                if self.per_request_field or not message_id:
+                    raise ValueError(
+                        'Unsupported template field: {0}'.format(field_name))
+                self.per_request_field = field_name
+            else:
+                self._fields.append((len(self._segments), field_name,
+                                     field_name in _ESCAPED_TEMPLATE_FIELDS))
+                if field_name not in field_names:
+                    field_names.append(field_name)
+            self._segments.append(None)
+        if not message_id:
+            raise ValueError('Request template without a MessageID')
+        self.get_key = operator.itemgetter(*field_names) \
+            if field_names else (lambda kwargs: None)
+        # values of the cached fields -> the text before the MessageID, the
+        # text after it, and if there is a per request field the text after
+        # that
+        self.requests = {}
+
+    def add_request(self, kwargs):
+        """
+        Fill in the defaults in the dict kwargs, and return the request for
+        it from requests, adding it if needed.
+        """
+        for field_name, value in self._defaults:
+            kwargs.setdefault(field_name, value)
+        key = self.get_key(kwargs)
+        if key in self.requests:
+            return self.requests[key]
+        segments = list(self._segments)
+        for index, field_name, escaped in self._fields:
+            segments[index] = _template_value(kwargs[field_name], escaped)
+        request = []
+        text = []
+        for segment in segments:
+            if segment is None:
+                request.append(''.join(text))
+                text = []
+            else:
+                text.append(segment)
+        request.append(''.join(text))
+        request = tuple(request)
+        if len(self.requests) >= _MAX_CACHED_REQUESTS:
+            self.requests.clear()
+        self.requests[key] = request
+        return request
+
+
+def _render_request_template(name, **kwargs):
+    """Return the request for template name with kwargs filled in."""
+    # the cost of every request, so the common case is kept in this frame
+    try:
+        template = _COMPILED_REQUEST_TEMPLATES[name]
+        request = template.requests[template.get_key(kwargs)]
+    except KeyError:
+        template = _COMPILED_REQUEST_TEMPLATES.get(name)
+        if template is None:
+            template = _COMPILED_REQUEST_TEMPLATES[name] = \
+                _CompiledRequestTemplate(
+                    _get_request_template(name),
+                    _REQUEST_TEMPLATE_DEFAULTS.get(name))
+        request = template.add_request(kwargs)
+    field_name = template.per_request_field
+    if field_name is None:
+        return request[0] + next(_message_ids) + request[1]
+    value = kwargs[field_name]
+    if '&' in value or '<' in value or '>' in value or '"' in value:
+        value = _escape_xml(value)
+    return request[0] + next(_message_ids) + request[1] + value + request[2]
+
+
 def _get_basic_auth_header(conn_info):
     authstr = "{0}:{1}".format(conn_info.username, conn_info.password)
     return 'Basic {0}'.format(base64.encodestring(authstr).strip())
@@ -217,9 +787,11 @@ class AuthGSSClient(object):
         self._realm = conn_info.username.split('@')[1].upper()
         self._dcip = conn_info.dcip
         self._include_dir = conn_info.include_dir
+        self._iov_context = None
         gssflags = kerberos.GSS_C_CONF_FLAG | kerberos.GSS_C_MUTUAL_FLAG | kerberos.GSS_C_SEQUENCE_FLAG | kerberos.GSS_C_INTEG_FLAG
 
         os.environ['KRB5CCNAME'] = ccname(conn_info.username)
+        mark_used(conn_info.username)
         if conn_info.trusted_realm and conn_info.trusted_kdc:
             add_trusted_realm(conn_info.trusted_realm, conn_info.trusted_kdc)
         if hasattr(kerberos, 'authGSSClientWrapIov'):
@@ -246,6 +818,8 @@ class AuthGSSClient(object):
         @return:          a result code
         """
         log.debug('GSSAPI step challenge="{0}"'.format(challenge))
+        # the kerberos library reads KRB5_CONFIG from the step's thread
+        config.flush()
         return deferToThread(kerberos.authGSSClientStep, self._context, challenge)
 
     @defer.inlineCallbacks
@@ -303,7 +877,31 @@ class AuthGSSClient(object):
                             .format(result_code, challenge))
         defer.returnValue(kerberos.authGSSClientUserName(self._context))
 
+    def _get_iov_context(self):
+        """
+        Return the raw gss_ctx_id_t when the binary-safe wrap/unwrap shim
+        can be used with this context, otherwise None.
+        """
+        if self._iov_context is None and self._context is not None:
+            if not _gssiov.available() or \
+                    not hasattr(kerberos, 'authGSSClientWrapIov'):
+                self._iov_context = False
+            else:
+                # stays None until the context has been established
+                self._iov_context = _gssiov.get_gss_context(self._context)
+        return self._iov_context or None
+
     def encrypt_body(self, body):
+        gss_context = self._get_iov_context()
+        if gss_context is None:
+            return self._encrypt_body_base64(body)
+        try:
+            payload, pad_len = _gssiov.wrap(gss_context, body)
+        except _gssiov.GSSIovError as e:
+            raise Exception(str(e))
+        return _frame_encrypted_body(len(body) + pad_len, payload)
+
+    def _encrypt_body_base64(self, body):
         # get original length of body. wrap will encrypt in place
         orig_len = len(body)
         # encode before sending to wrap func
@@ -325,21 +923,30 @@ class AuthGSSClient(object):
         ewrap = kerberos.authGSSClientResponse(self._context)
         # decode wrapped request
         payload = bytes(base64.b64decode(ewrap))
-        # add carriage returns to body
-        body = _BODY.replace('\n', '\r\n')
-        body = bytes(body.format(original_length=orig_len + pad_len, emsg=payload))
-        return body
+        return _frame_encrypted_body(orig_len + pad_len, payload)
 
     def decrypt_body(self, body):
         try:
-            b_start = body.index("Content-Type: application/octet-stream") + \
-                len("Content-Type: application/octet-stream\r\n")
+            b_start = body.index(_ENCRYPTED_PAYLOAD_START) + \
+                len(_ENCRYPTED_PAYLOAD_START)
         except ValueError:
             # Unencrypted data, return body
             return body
-        b_end = body.index("--Encrypted Boundary", b_start)
-        ebody = body[b_start:b_end]
-        ebody = base64.b64encode(ebody)
+        b_end = body.index(_ENCRYPTED_BOUNDARY, b_start)
+        return self.decrypt_payload(body[b_start:b_end])
+
+    def decrypt_payload(self, payload):
+        """Decrypt the octet-stream part of a multipart/encrypted body."""
+        gss_context = self._get_iov_context()
+        if gss_context is None:
+            return self._decrypt_payload_base64(payload)
+        try:
+            return _gssiov.unwrap(gss_context, payload)
+        except _gssiov.GSSIovError as e:
+            raise Exception(str(e))
+
+    def _decrypt_payload_base64(self, payload):
+        ebody = base64.b64encode(payload)
         try:
             rc = kerberos.authGSSClientUnwrapIov(self._context, ebody)
         except kerberos.GSSError as e:
@@ -355,6 +962,13 @@ class AuthGSSClient(object):
     def cleanup(self):
         kerberos.authGSSClientClean(self._context)
         self._context = None
+        self._iov_context = None
+
+
+def _frame_encrypted_body(original_length, payload):
+    # add carriage returns to body
+    body = _BODY.replace('\n', '\r\n')
+    return bytes(body.format(original_length=original_length, emsg=payload))
 
 
 def get_auth_details(auth_header=''):
@@ -372,7 +986,7 @@ def get_auth_details(auth_header=''):
 
 @defer.inlineCallbacks
 def _authenticate_with_kerberos(conn_info, url, agent, gss_client=None):
-    service = '{0}@{1}'.format(conn_info.service.upper(), conn_info.hostname)
+    service = _get_service_principal(conn_info)
     if gss_client is None:
         gss_client = AuthGSSClient(
             service,
@@ -438,11 +1052,15 @@ class ConnectionInfo(namedtuple(
         'code_page',
         'locale',
         'include_dir',
-        'disable_rdns'])):
+        'disable_rdns',
+        'max_elements',
+        'operation_timeout',
+        'max_conversations'])):
     def __new__(cls, hostname, auth_type, username, password, scheme, port,
                 connectiontype, keytab, dcip, timeout=60, trusted_realm='',
                 trusted_kdc='', ipaddress='', service='', envelope_size=512000,
-                code_page=65001, locale='en-US', include_dir=None, disable_rdns=False):
+                code_page=65001, locale='en-US', include_dir=None, disable_rdns=False,
+                max_elements=32000, operation_timeout=60, max_conversations=1):
         if not ipaddress:
             ipaddress = hostname
         if not service:
@@ -454,7 +1072,9 @@ class ConnectionInfo(namedtuple(
                                                   trusted_realm, trusted_kdc,
                                                   ipaddress, service,
                                                   envelope_size, code_page, locale,
-                                                  include_dir, disable_rdns)
+                                                  include_dir, disable_rdns,
+                                                  max_elements, operation_timeout,
+                                                  max_conversations)
 
 
 def verify_include_dir(conn_info):
@@ -476,6 +1096,24 @@ def verify_envelope_size(conn_info):
         raise Exception("envelope_size must be an integer")
 
 
+def verify_max_elements(conn_info):
+    has_max_elements, max_elements = _has_get_attr(conn_info, 'max_elements')
+    if has_max_elements and (not isinstance(max_elements, int) or max_elements < 1):
+        raise Exception("max_elements must be a positive integer")
+
+
+def verify_operation_timeout(conn_info):
+    has_timeout, timeout = _has_get_attr(conn_info, 'operation_timeout')
+    if has_timeout and (not isinstance(timeout, int) or timeout < 1):
+        raise Exception("operation_timeout must be a positive integer")
+
+
+def verify_max_conversations(conn_info):
+    has_max, max_conversations = _has_get_attr(conn_info, 'max_conversations')
+    if has_max and (not isinstance(max_conversations, int) or max_conversations < 1):
+        raise Exception("max_conversations must be a positive integer")
+
+
 def verify_hostname(conn_info):
     has_hostname, hostname = _has_get_attr(conn_info, 'hostname')
     if not has_hostname or not hostname:
@@ -557,6 +1195,9 @@ def verify_conn_info(conn_info):
     verify_connectiontype(conn_info)
     verify_timeout(conn_info)
     verify_include_dir(conn_info)
+    verify_max_elements(conn_info)
+    verify_operation_timeout(conn_info)
+    verify_max_conversations(conn_info)
 
 
 class RequestSender(object):
@@ -567,11 +1208,11 @@ class RequestSender(object):
         self._url = None
         self._headers = None
         self.gssclient = None
-        self.agent = _get_agent()
+        self.agent = _get_agent(conn_info)
         self.authorized = False
 
     @defer.inlineCallbacks
-    def _get_url_and_headers(self):
+    def _get_url_and_headers(self, use_cached_context=True):
         url = "{c.scheme}://{c.ipaddress}:{c.port}/wsman".format(c=self._conn_info)
         if self._conn_info.auth_type == 'basic':
             headers = Headers(_CONTENT_TYPE)
@@ -584,14 +1225,23 @@ class RequestSender(object):
             headers = Headers(_ENCRYPTED_CONTENT_TYPE)
             headers.addRawHeader('Connection', self._conn_info.connectiontype)
             if self.gssclient is None:
-                self.gssclient = yield _authenticate_with_kerberos(self._conn_info, url, self.agent)
+                cached = None
+                if use_cached_context:
+                    cached = SECURITY_CONTEXT_CACHE.checkout(self._conn_info)
+                if cached:
+                    self.agent, self.gssclient = cached
+                else:
+                    if self.agent is None:
+                        self.agent = _get_agent(self._conn_info)
+                    self.gssclient = yield _authenticate_with_kerberos(self._conn_info, url, self.agent)
         else:
             raise Exception('unknown auth type: {0}'.format(self._conn_info.auth_type))
         defer.returnValue((url, headers))
 
     @defer.inlineCallbacks
-    def _set_url_and_headers(self):
-        self._url, self._headers = yield self._get_url_and_headers()
+    def _set_url_and_headers(self, use_cached_context=True):
+        self._url, self._headers = yield self._get_url_and_headers(
+            use_cached_context)
 
     @property
     def hostname(self):
@@ -603,6 +1253,9 @@ class RequestSender(object):
     def decrypt_body(self, body):
         return self.gssclient.decrypt_body(body)
 
+    def decrypt_payload(self, payload):
+        return self.gssclient.decrypt_payload(payload)
+
     @defer.inlineCallbacks
     def send_request(self, request_template_name, **kwargs):
         log.debug('sending request: {0} {1}'.format(
@@ -610,9 +1263,13 @@ class RequestSender(object):
         kwargs['envelope_size'] = getattr(self._conn_info, 'envelope_size', 512000)
         kwargs['locale'] = getattr(self._conn_info, 'locale', 'en-US')
         kwargs['code_page'] = getattr(self._conn_info, 'code_page', 65001)
+        if not kwargs.get('max_elements'):
+            kwargs['max_elements'] = getattr(self._conn_info, 'max_elements', 32000)
+        if not kwargs.get('operation_timeout'):
+            kwargs['operation_timeout'] = getattr(self._conn_info, 'operation_timeout', 60)
         if not self._url or self._conn_info.auth_type == 'kerberos':
             yield self._set_url_and_headers()
-        request = _get_request_template(request_template_name).format(**kwargs)
+        request = _render_request_template(request_template_name, **kwargs)
         if self.is_kerberos():
             encrypted_request = self.gssclient.encrypt_body(request)
             if not encrypted_request.startswith("--Encrypted Boundary"):
@@ -630,12 +1287,14 @@ class RequestSender(object):
         if response.code == httplib.UNAUTHORIZED or response.code == httplib.BAD_REQUEST:
             # check to see if we need to re-authorize due to lost connection or bad request error
             if self.gssclient is not None:
-                self.agent = _get_agent()
+                # the context is no longer accepted on this connection
+                _close_agent_connections(self.agent)
+                self.agent = _get_agent(self._conn_info)
                 # do some cleanup first.  memory leaks were occurring
                 self.gssclient.cleanup()
                 self.gssclient = None
                 try:
-                    yield self._set_url_and_headers()
+                    yield self._set_url_and_headers(use_cached_context=False)
                     encrypted_request = self.gssclient.encrypt_body(request)
                     if not encrypted_request.startswith("--Encrypted Boundary"):
                         self._headers.setRawHeaders('Content-Type', _CONTENT_TYPE['Content-Type'])
@@ -674,15 +1333,13 @@ class RequestSender(object):
     def close_connections(self):
         # close connections
         # return a Deferred()
-        if self.agent and hasattr(self.agent, 'closeCachedConnections'):
-            # twisted 11 has no return and is part of the Agent
-            return defer.succeed(self.agent.closeCachedConnections())
-        elif self.agent:
-            # twisted 12 returns a Deferred
-            return self.agent._pool.closeCachedConnections()
-        else:
-            # no agent
-            return defer.succeed(None)
+        if self.gssclient is not None:
+            # keep the established context for the next client
+            d = SECURITY_CONTEXT_CACHE.checkin(
+                self._conn_info, self.agent, self.gssclient)
+            self.agent = self.gssclient = None
+            return d
+        return _close_agent_connections(self.agent)
 
 
 class _StringProtocol(Protocol):
@@ -706,6 +1363,13 @@ class EtreeRequestSender(object):
 
     @defer.inlineCallbacks
     def send_request(self, request_template_name, **kwargs):
+        xml_str = yield self.send_request_text(
+            request_template_name, **kwargs)
+        defer.returnValue(ET.fromstring(xml_str))
+
+    @defer.inlineCallbacks
+    def send_request_text(self, request_template_name, **kwargs):
+        """Return the decrypted response XML without parsing it."""
         resp = yield self._sender.send_request(
             request_template_name, **kwargs)
         proto = _StringProtocol()
@@ -722,7 +1386,7 @@ class EtreeRequestSender(object):
                 log.debug(xml.toprettyxml())
             except:
                 log.debug('Could not prettify response XML: "{0}"'.format(xml_str))
-        defer.returnValue(ET.fromstring(xml_str))
+        defer.returnValue(xml_str)
 
     @defer.inlineCallbacks
     def close_connections(self):
@@ -736,12 +1400,58 @@ def create_etree_request_sender(conn_info):
 
 
 TZOFFSET_PATTERN = re.compile(r'[-+]\d+:\d\d$')
+# The forms WinRM sends. The time zone offset is ignored like in
+# _parse_datetime. A fraction of 9 digits is in nanoseconds.
+_ISO_DATETIME_PATTERN = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)'
+    r'(?:\.(\d{1,6}|\d{9}))?(?:Z|[-+]\d+:\d\d)\Z')
+_US_DATETIME_PATTERN = re.compile(
+    r'(\d\d)/(\d\d)/(\d{4}) (\d\d):(\d\d):(\d\d)\.(\d{1,6})\Z')
+_MAX_CACHED_DATETIMES = 4096
+_datetimes = {}
 
 
 def get_datetime(text):
     """
     Parse the date from a WinRM response and return a datetime object.
+    Raises ValueError if text is not a date.
+
+    Results are cached because the same timestamps recur across items and
+    polls.
+    """
+    dt = _datetimes.get(text)
+    if dt is None:
+        dt = _parse_datetime_fast(text)
+        if dt is None:
+            dt = _parse_datetime(text)
+        if len(_datetimes) >= _MAX_CACHED_DATETIMES:
+            _datetimes.clear()
+        _datetimes[text] = dt
+    return dt
+
+
+def _parse_datetime_fast(text):
+    """
+    Parse the usual forms of dates without strptime. Returns None for any
+    other form.
     """
+    match = _ISO_DATETIME_PATTERN.match(text)
+    if match is not None:
+        year, month, day, hour, minute, second, fraction = match.groups()
+    else:
+        match = _US_DATETIME_PATTERN.match(text)
+        if match is None:
+            return None
+        month, day, year, hour, minute, second, fraction = match.groups()
+    if fraction:
+        microsecond = int(fraction[:6].ljust(6, '0'))
+    else:
+        microsecond = 0
+    return datetime(int(year), int(month), int(day), int(hour), int(minute),
+                    int(second), microsecond)
+
+
+def _parse_datetime(text):
     text2 = TZOFFSET_PATTERN.sub('Z', text)
     if text2.endswith('Z'):
         if '.' in text2:
@@ -10,9 +10,10 @@
 import sys
 import logging
 from collections import namedtuple
-from twisted.internet import defer, task, reactor
+from functools import partial
+from twisted.internet import defer
 from . import app
-from .subscribe import create_event_subscription
+from .subscribe import EventCollector, BookmarkStore
 
 log = logging.getLogger('winrm')
 SubscriptionInfo = namedtuple('SubscriptionInfo', ['path', 'select'])
@@ -39,51 +40,68 @@ class WecutilStrategy(object):
     def __init__(self):
         self._event_count = 0
         self._d = defer.Deferred()
-        self._subscriptions_dct = {}
+        # hostname -> EventCollector
+        self._collectors = {}
+        # (hostname, subscr_info) -> number of batches pulled
+        self._pull_counts = {}
+        # (hostname, subscr_info) of the batches being pulled
+        self._pulling = set()
+        # Deferreds of the collectors being stopped
+        self._stopping = []
 
     @property
     def count_summary(self):
         return '{0} events'.format(self._event_count)
 
-    @defer.inlineCallbacks
-    def _do_pull(
-            self, i, num_pulls, hostname, subscr_info):
+    def _on_events(self, hostname, num_pulls, path, select, events):
+        subscr_info = SubscriptionInfo(path, select)
         prefix = "{0} {1}".format(hostname, subscr_info)
-        subscription = self._subscriptions_dct[(hostname, subscr_info)]
-        if num_pulls > 0 and i == num_pulls:
-            yield subscription.unsubscribe()
-            del self._subscriptions_dct[(hostname, subscr_info)]
-            if not self._subscriptions_dct:
-                self._d.callback(None)
-            return
-        i += 1
-        sys.stdout.write('{0} pull #{1}'.format(prefix, i))
-        if num_pulls > 0:
-            sys.stdout.write(' of {0}'.format(num_pulls))
-        print
-
-        def print_event(event):
+        key = (hostname, subscr_info)
+        if key not in self._pulling:
+            self._pulling.add(key)
+            sys.stdout.write('{0} pull #{1}'.format(
+                prefix, self._pull_counts[key] + 1))
+            if num_pulls > 0:
+                sys.stdout.write(' of {0}'.format(num_pulls))
+            print
+        for event in events:
             self._event_count += 1
             print "{0} {1}".format(prefix, event)
-
-        log.debug("subscription.pull- {0} {1} (start)"
-                  .format(hostname, subscr_info))
-        yield subscription.pull(print_event)
-        log.debug("subscription.pull- {0} {1} (finished)"
-                  .format(hostname, subscr_info))
-        task.deferLater(reactor, 0, self._do_pull, i, num_pulls, hostname,
-                        subscr_info)
+        if events:
+            return
+        # a batch ends with an empty Pull, like EventSubscription.pull
+        self._pulling.discard(key)
+        self._pull_counts[key] += 1
+        if num_pulls > 0 and self._pull_counts[key] == num_pulls:
+            del self._pull_counts[key]
+            d = self._collectors[hostname].unsubscribe(path, select)
+            d.addCallback(self._unsubscribed, hostname)
+            return d
+
+    def _unsubscribed(self, result, hostname):
+        if not any(key[0] == hostname for key in self._pull_counts):
+            # not returned, stop waits for the Pull being handled
+            self._stopping.append(self._collectors.pop(hostname).stop())
+            if not self._collectors:
+                d = defer.DeferredList(self._stopping, consumeErrors=True)
+                d.addCallback(lambda results: self._d.callback(None))
 
     @defer.inlineCallbacks
     def act(self, good_conn_infos, args, config):
+        bookmark_store = BookmarkStore(args.bookmarks) \
+            if args.bookmarks else None
         for conn_info in good_conn_infos:
             hostname = conn_info.hostname
+            # all subscriptions of a host share one session and pull loop
+            collector = EventCollector(
+                conn_info, bookmark_store=bookmark_store)
+            self._collectors[hostname] = collector
             for subscr_info in config.subscr_infos:
-                subscription = create_event_subscription(conn_info)
-                self._subscriptions_dct[(hostname, subscr_info)] = subscription
-                yield subscription.subscribe(
+                yield collector.subscribe(
                     subscr_info.path, subscr_info.select)
-                self._do_pull(0, args.num_pulls, hostname, subscr_info)
+                self._pull_counts[(hostname, subscr_info)] = 0
+            collector.start(partial(
+                self._on_events, hostname, args.num_pulls))
         yield self._d
 
 
@@ -92,7 +110,12 @@ class WecUtility(app.ConfigDrivenUtility):
     def add_args(self, parser):
         parser.add_argument("--path", "-p", default='Application')
         parser.add_argument("--select", "-s", default='*')
-        parser.add_argument("--num-pulls", "-n", type=int, default=2)
+        parser.add_argument(
+            "--num-pulls", "-n", type=int, default=2,
+            help="batches of events to pull per subscription, each until "
+                 "no more events are returned, 0 for no limit")
+        parser.add_argument("--bookmarks", "-b",
+                            help="file to resume subscriptions from")
 
     def check_args(self, args):
         return True
@@ -102,7 +102,7 @@ def batch_main(args):
 @defer.inlineCallbacks
 def single_shot_main(args):
     try:
-        client = SingleCommandClient(args.conn_info)
+        client = SingleCommandClient(args.conn_info, shell_pool=None)
         results = yield client.run_command(args.command)
         pprint(results)
     finally: